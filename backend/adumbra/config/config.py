@@ -1,3 +1,4 @@
+import os
 import re
 import typing as t
 
@@ -44,6 +45,103 @@ class CelerySettings(BaseSettings):
     result_backend: str = "mongodb://database/flask"
 
 
+class CocoSettings(BaseSettings):
+    export_batch_size: int = 500
+    """Number of images whose annotations are fetched with one query during export"""
+
+    import_bulk: bool = True
+    """
+    Import annotations with batched `insert_many`/`bulk_write` calls instead of one
+    query and one save per annotation
+    """
+
+    import_chunk_size: int = 1000
+    """Number of writes sent to MongoDB per batch during a bulk import"""
+
+
+class ScanSettings(BaseSettings):
+    batch_size: int = 1000
+    """Number of new images read and inserted together during a dataset scan"""
+
+    threads: int = 8
+    """Files whose headers are read in parallel during a dataset scan"""
+
+    shards: int = 8
+    """
+    Most subtasks a dataset scan is split into, each scanning some of the top-level
+    folders on any worker; 1 scans every folder in a single task
+    """
+
+    queue: str = "celery"
+    """
+    Celery queue of the scan subtasks, so a dedicated worker (`celery worker -Q`) can
+    bound how many of them run at once with its `--concurrency`
+    """
+
+
+class ThumbnailSettings(BaseSettings):
+    batch_size: int = 100
+    """Number of images whose thumbnails are regenerated by one task"""
+
+    debounce: float = 5.0
+    """
+    Seconds a thumbnail requested by an annotator save waits before rendering, so
+    that further saves of the image are coalesced into the same render
+    """
+
+    requeue_after: float = 600.0
+    """Seconds after which an image whose queued batch never ran is queued again"""
+
+    max_attempts: int = 3
+    """Renders of a thumbnail tried in a row before it is left until requested again"""
+
+    retry_after: float = 60.0
+    """Seconds before a thumbnail that could not be rendered is tried again"""
+
+    threads: int = 4
+    """Thumbnails rendered in parallel by one worker task"""
+
+
+class TaskSettings(BaseSettings):
+    log_batch_size: int = 100
+    """Number of log lines of a task written together"""
+
+    log_flush_interval: float = 2.0
+    """Most seconds a log line of a task is buffered for, checked when logging"""
+
+    max_log_lines: int = 10000
+    """Log lines stored per task, later lines are only counted"""
+
+    progress_step: float = 1.0
+    """Smallest change of a task's progress, in percent, that is written and emitted"""
+
+    progress_interval: float = 1.0
+    """Least seconds between two progress writes of a task"""
+
+
+class WatcherSettings(BaseSettings):
+    debounce: float = 2.0
+    """Seconds without filesystem events after which pending events are applied"""
+
+    max_delay: float = 30.0
+    """Most seconds an event waits while others keep coming in"""
+
+    batch_size: int = 10000
+    """Number of pending paths after which events are applied without waiting"""
+
+
+class ImageCacheSettings(BaseSettings):
+    directory: str | None = None
+    """
+    Where images resized to non-standard sizes are stored; shared by every webserver
+    worker using the same directory. Defaults to `.cache/images` in the dataset
+    directory
+    """
+
+    max_size: int = 2 * 1024 * 1024 * 1024  # 2GB
+    """Bytes the cache may use before its least recently used entries are evicted"""
+
+
 class IASettings(BaseSettings):
     device: DeviceStr = "cpu"
 
@@ -80,12 +178,15 @@ class Config(BaseSettings):
     Can be set to False to disable connecting to MongoDB; helpful for local testing
     """
 
+    ensure_indexes: bool = True
+    """Create the indexes declared by the models when the webserver starts"""
+
     name: str = "Adumbra"
     version: str = version_info.get_tag()
     log_level: str = "DEBUG"
 
-    ### File Watcher
-    file_watcher: bool = False
+    ### File Watcher, run with `python -m adumbra.watcher`
+    watcher: WatcherSettings = WatcherSettings()
     ignore_directories: list[str] = ["_thumbnail", "_settings"]
 
     # Flask/Gunicorn
@@ -112,9 +213,35 @@ class Config(BaseSettings):
     ### Workers
     celery: CelerySettings = CelerySettings()
 
+    ### COCO Import/Export
+    coco: CocoSettings = CocoSettings()
+
     ### Dataset Options
     dataset_directory: str = "/datasets/"
     initialize_from_file: str | None = None
+    neighbor_cache_ttl: float = 30.0
+    """Seconds a computed window of neighboring images is reused for navigation"""
+    count_cache_ttl: float = 60.0
+    """
+    Seconds the number of images matching a dataset browser query is reused; any
+    write recorded with `DatasetModel.mark_modified` invalidates it earlier
+    """
+    stats_cache_ttl: float = 300.0
+    """
+    Seconds dataset statistics are reused; any write recorded with
+    `DatasetModel.mark_modified` invalidates them earlier
+    """
+    image_cache_max_age: int = 24 * 60 * 60
+    """Seconds browsers may reuse a served image without revalidating it"""
+    image_cache: ImageCacheSettings = ImageCacheSettings()
+    thumbnails: ThumbnailSettings = ThumbnailSettings()
+    scan: ScanSettings = ScanSettings()
+    tasks: TaskSettings = TaskSettings()
+    tile_min_size: int = 4096
+    """
+    Images with a side at least this long get a tile pyramid, which the annotator
+    loads tile by tile instead of as a whole
+    """
 
     ### User Options
     login_disabled: bool = False
@@ -122,5 +249,10 @@ class Config(BaseSettings):
 
     ia: IASettings = IASettings()
 
+    def get_image_cache_directory(self) -> str:
+        return self.image_cache.directory or os.path.join(
+            self.dataset_directory, ".cache", "images"
+        )
+
 
 CONFIG = Config()
@@ -3,15 +3,18 @@ import typing as t
 
 from mongoengine import DynamicDocument, QuerySet, connect
 from mongoengine.base import BaseField
+from mongoengine.connection import get_db
+from pymongo import ReturnDocument
 
 from adumbra.config import CONFIG
 from adumbra.database.categories import CategoryModel
 from adumbra.database.datasets import DatasetModel
 from adumbra.database.events import Event, SessionEvent
 from adumbra.database.exports import ExportModel
+from adumbra.database.folders import FolderModel
 from adumbra.database.images import AnnotationModel, ImageModel
 from adumbra.database.lisence import LicenseModel
-from adumbra.database.tasks import TaskModel
+from adumbra.database.tasks import TaskLogModel, TaskModel
 from adumbra.database.users import UserModel
 
 FieldBase_T = t.TypeVar("FieldBase_T", bound=type[BaseField])
@@ -46,6 +49,53 @@ def upsert(model, query=None, update=None) -> t.Optional[DynamicDocument]:
     return new_model
 
 
+def revision_filter(revision) -> dict:
+    """
+    Raw query matching documents at `revision`. Documents written before revisions
+    were tracked have no such field and count as revision 0.
+    """
+    if not revision:
+        return {"revision": {"$in": [0, None]}}
+    return {"revision": revision}
+
+
+def reserve_ids(model, count) -> range:
+    """
+    Reserves `count` consecutive values of a model's `SequenceField` primary key in a
+    single round trip, so documents can be written with `insert_many`.
+    """
+    # pylint: disable-next=protected-access
+    field = model._fields["id"]
+    collection = get_db(alias=field.db_alias)[field.collection_name]
+    counter = collection.find_one_and_update(
+        filter={"_id": f"{field.get_sequence_name()}.{field.name}"},
+        update={"$inc": {"next": count}},
+        return_document=ReturnDocument.AFTER,
+        upsert=True,
+    )
+    return range(counter["next"] - count + 1, counter["next"] + 1)
+
+
+def insert_many(model, documents) -> list[int]:
+    """
+    Validates and inserts unsaved model instances with one `insert_many` call. Unlike
+    `save`, no per-document hooks run, so defaults must already be applied.
+    """
+    if not documents:
+        return []
+
+    ids = list(reserve_ids(model, len(documents)))
+    for document, document_id in zip(documents, ids):
+        document.id = document_id
+        document.validate()
+
+    # pylint: disable-next=protected-access
+    model._get_collection().insert_many(
+        [document.to_mongo() for document in documents], ordered=False
+    )
+    return ids
+
+
 def fix_ids(q):
     json_obj = json.loads(q.to_json().replace('"_id"', '"id"'))
     return json_obj
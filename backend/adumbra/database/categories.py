@@ -18,6 +18,15 @@ class CategoryModel(ShimmedDynamicDocument):
         "keypoint_colors",
     ]
 
+    meta = {
+        "indexes": [
+            # Undo list
+            ("deleted", "-deleted_date"),
+            # Categories of a user, the unique (name, creator) index leads with name
+            "creator",
+        ]
+    }
+
     id = fields.SequenceField(primary_key=True)
     name = fields.StringField(required=True, unique_with=["creator"])
     supercategory = fields.StringField(default="")
@@ -32,6 +41,9 @@ class CategoryModel(ShimmedDynamicDocument):
     keypoint_labels = fields.ListField(default=[])
     keypoint_colors = fields.ListField(default=[])
 
+    # Counter maintained by `adumbra.database.counters`, missing until first computed
+    num_annotations = fields.IntField()
+
     @classmethod
     def bulk_create(cls, categories):
 
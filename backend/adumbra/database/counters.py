@@ -0,0 +1,155 @@
+"""
+Denormalized counters shown by the dataset and category listings. Write sites adjust
+them with `$inc`; a counter that was never computed (missing from the document) is left
+alone until it is filled in by `refresh_dataset_counters`/`refresh_category_counters`,
+which is also how drifted counters are repaired.
+"""
+
+import typing as t
+
+from pymongo import UpdateOne
+
+from adumbra.database.categories import CategoryModel
+from adumbra.database.datasets import DatasetModel
+from adumbra.database.folders import FolderModel
+from adumbra.database.images import AnnotationModel, ImageModel
+
+DATASET_COUNTERS = ("num_images", "num_annotated", "first_image_id")
+
+
+def inc_dataset_counters(dataset_id: int, images: int = 0, annotated: int = 0) -> None:
+    """Adjusts the image counters of a dataset whose counters are already computed"""
+    if images == 0 and annotated == 0:
+        return
+
+    DatasetModel.objects(id=dataset_id, num_images__exists=True).update(
+        inc__num_images=images, inc__num_annotated=annotated
+    )
+
+
+def add_dataset_images(
+    dataset_id: int, image_ids: t.Sequence[int], annotated: int = 0
+) -> None:
+    """
+    Counts images added to a dataset, either newly created or restored; `annotated` of
+    them are annotated
+    """
+    if not image_ids:
+        return
+
+    DatasetModel.objects(id=dataset_id, num_images__exists=True).update(
+        inc__num_images=len(image_ids),
+        inc__num_annotated=annotated,
+        min__first_image_id=min(image_ids),
+    )
+
+
+def remove_dataset_image(image: ImageModel) -> None:
+    """Uncounts an image removed from its dataset, once it is marked as deleted"""
+    inc_dataset_counters(image.dataset_id, images=-1, annotated=-int(image.annotated))
+    FolderModel.count_image(image, -1)
+
+    # The next first image is not known without a query
+    if DatasetModel.objects(id=image.dataset_id, first_image_id=image.id).count():
+        refresh_dataset_counters([image.dataset_id])
+
+
+def inc_category_counters(counts: t.Mapping[int, int]) -> None:
+    """Adjusts the annotation counters of categories, given as `{category_id: delta}`"""
+    for category_id, count in counts.items():
+        if count == 0 or category_id is None:
+            continue
+
+        CategoryModel.objects(id=category_id, num_annotations__exists=True).update(
+            inc__num_annotations=count
+        )
+
+
+def refresh_dataset_counters(dataset_ids: t.Iterable[int]) -> None:
+    """Recomputes the image counters of datasets with one aggregation"""
+    dataset_ids = list(dataset_ids)
+    if not dataset_ids:
+        return
+
+    counts = {
+        group["_id"]: group
+        for group in ImageModel.objects(
+            dataset_id__in=dataset_ids, deleted=False
+        ).aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": "$dataset_id",
+                        "num_images": {"$sum": 1},
+                        "num_annotated": {
+                            "$sum": {"$cond": [{"$eq": ["$annotated", True]}, 1, 0]}
+                        },
+                        "first_image_id": {"$min": "$_id"},
+                    }
+                }
+            ]
+        )
+    }
+
+    for dataset_id in dataset_ids:
+        group = counts.get(dataset_id, {})
+        update = {
+            "set__num_images": group.get("num_images", 0),
+            "set__num_annotated": group.get("num_annotated", 0),
+        }
+        if group.get("first_image_id") is None:
+            update["unset__first_image_id"] = True
+        else:
+            update["set__first_image_id"] = group["first_image_id"]
+
+        DatasetModel.objects(id=dataset_id).update(**update)
+
+
+def refresh_category_counters(category_ids: t.Iterable[int]) -> None:
+    """Recomputes the annotation counters of categories with one aggregation"""
+    category_ids = list(category_ids)
+    if not category_ids:
+        return
+
+    counts = {
+        group["_id"]: group["count"]
+        for group in AnnotationModel.objects(
+            category_id__in=category_ids, deleted=False
+        ).aggregate([{"$group": {"_id": "$category_id", "count": {"$sum": 1}}}])
+    }
+
+    for category_id in category_ids:
+        CategoryModel.objects(id=category_id).update(
+            set__num_annotations=counts.get(category_id, 0)
+        )
+
+
+def refresh_folder_counters(dataset_id: int) -> None:
+    """Recomputes the image counts of every folder of a dataset"""
+    counts = {
+        group["_id"]: group["count"]
+        for group in ImageModel.objects(dataset_id=dataset_id, deleted=False).aggregate(
+            [
+                {"$unwind": "$folders"},
+                {"$group": {"_id": "$folders", "count": {"$sum": 1}}},
+            ]
+        )
+    }
+
+    requests = [
+        UpdateOne(
+            {"_id": folder["_id"]},
+            {"$set": {"num_images": counts.get(folder["path"], 0)}},
+        )
+        for folder in FolderModel.objects(dataset_id=dataset_id)
+        .only("id", "path")
+        .as_pymongo()
+    ]
+    if requests:
+        # pylint: disable-next=protected-access
+        FolderModel._get_collection().bulk_write(requests, ordered=False)
+
+
+def missing_counters(documents: t.Iterable[dict], counter: str) -> list[int]:
+    """Ids of the (JSON) documents whose `counter` was never computed"""
+    return [document["id"] for document in documents if counter not in document]
@@ -1,3 +1,4 @@
+import datetime
 import os
 
 from flask_login import current_user
@@ -9,6 +10,16 @@ from adumbra.database.mongo_shim import ShimmedDynamicDocument
 
 class DatasetModel(ShimmedDynamicDocument):
 
+    meta = {
+        "indexes": [
+            # Datasets a user owns or is shared with
+            "owner",
+            "users",
+            # Undo list
+            ("deleted", "-deleted_date"),
+        ]
+    }
+
     id = fields.SequenceField(primary_key=True)
     name = fields.StringField(required=True, unique=True)
     directory = fields.StringField()
@@ -25,6 +36,20 @@ class DatasetModel(ShimmedDynamicDocument):
     deleted = fields.BooleanField(default=False)
     deleted_date = fields.DateTimeField()
 
+    # Last time images or annotations of the dataset were written, so results derived
+    # from them (e.g. statistics) can be cached until it changes
+    last_modified = fields.DateTimeField()
+
+    # Counters maintained by `adumbra.database.counters`, missing until first computed
+    num_images = fields.IntField()
+    num_annotated = fields.IntField()
+    first_image_id = fields.IntField()
+
+    @classmethod
+    def mark_modified(cls, dataset_id):
+        """Records that images or annotations of a dataset were written"""
+        cls.objects(id=dataset_id).update(set__last_modified=datetime.datetime.utcnow())
+
     def save(self, *args, **kwargs):
 
         directory = os.path.join(CONFIG.dataset_directory, str(self.name) + "/")
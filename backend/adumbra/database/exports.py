@@ -7,6 +7,13 @@ from adumbra.database.mongo_shim import ShimmedDynamicDocument
 
 class ExportModel(ShimmedDynamicDocument):
 
+    meta = {
+        "indexes": [
+            # Latest exports of a dataset
+            ("dataset_id", "-created_at"),
+        ]
+    }
+
     id = fields.SequenceField(primary_key=True)
     dataset_id = fields.IntField(required=True)
     path = fields.StringField(required=True)
@@ -0,0 +1,132 @@
+import os
+
+from mongoengine import fields
+from pymongo import UpdateOne
+
+from adumbra.database.mongo_shim import ShimmedDynamicDocument
+
+
+def folder_of(directory, path):
+    """Folder of a file, relative to the dataset `directory`"""
+    folder = os.path.relpath(os.path.dirname(path), directory)
+    return "" if folder == "." else folder.strip("/") + "/"
+
+
+def folder_ancestors(folder):
+    """All folders containing `folder`, from the dataset root down to itself"""
+    parts = [part for part in folder.split("/") if part]
+    return [""] + ["/".join(parts[: i + 1]) + "/" for i in range(len(parts))]
+
+
+def image_folders(directory, path):
+    """Value of `ImageModel.folders` for the image at `path`"""
+    return folder_ancestors(folder_of(directory, path))
+
+
+class FolderModel(ShimmedDynamicDocument):
+    """
+    A folder of a dataset directory, so the dataset browser can list folders and
+    filter images without touching the filesystem. Paths are relative to the dataset
+    directory and end with a slash; the dataset root is the empty path.
+    """
+
+    meta = {
+        "indexes": [
+            {"fields": ("dataset_id", "path"), "unique": True},
+            ("dataset_id", "parent", "name"),
+        ]
+    }
+
+    dataset_id = fields.IntField(required=True)
+    path = fields.StringField(default="")
+    parent = fields.StringField()
+    name = fields.StringField(default="")
+
+    # Images in the folder and its subfolders
+    num_images = fields.IntField(default=0)
+
+    # Snapshot of the folder when it was last listed by a scan, which skips listing
+    # it again while its modification time stays the same
+    mtime = fields.FloatField()
+    entries = fields.IntField()
+
+    @classmethod
+    def add(cls, dataset_id, folders):
+        """Creates the folders (and their ancestors) that do not exist yet"""
+        paths = {path for folder in folders for path in folder_ancestors(folder)}
+        if not paths:
+            return
+
+        requests = []
+        for path in sorted(paths):
+            parent = None
+            if path:
+                parent = folder_ancestors(path)[-2]
+
+            requests.append(
+                UpdateOne(
+                    {"dataset_id": dataset_id, "path": path},
+                    {
+                        "$setOnInsert": {
+                            "parent": parent,
+                            "name": path.rstrip("/").rsplit("/", 1)[-1],
+                            "num_images": 0,
+                        }
+                    },
+                    upsert=True,
+                )
+            )
+
+        # pylint: disable-next=protected-access
+        cls._get_collection().bulk_write(requests, ordered=False)
+
+    @classmethod
+    def snapshot(cls, dataset_id, snapshots):
+        """Records the `(mtime, entries)` of scanned folders, given by path"""
+        requests = [
+            UpdateOne(
+                {"dataset_id": dataset_id, "path": path},
+                {"$set": {"mtime": mtime, "entries": entries}},
+            )
+            for path, (mtime, entries) in snapshots.items()
+        ]
+        if requests:
+            # pylint: disable-next=protected-access
+            cls._get_collection().bulk_write(requests, ordered=False)
+
+    @classmethod
+    def remove(cls, dataset_id, folder):
+        """Removes a folder and its subfolders"""
+        folders = cls.objects(dataset_id=dataset_id)
+        if folder:
+            folders = folders.filter(path__startswith=folder)
+        folders.delete()
+
+    @classmethod
+    def inc_images(cls, dataset_id, folders, count):
+        """Adjusts the image counts of the given folders"""
+        if folders and count:
+            cls.objects(dataset_id=dataset_id, path__in=folders).update(
+                inc__num_images=count
+            )
+
+    @classmethod
+    def count_image(cls, image, count=1):
+        """
+        Counts an image added to (`count=1`) or removed from (`count=-1`) its folders,
+        creating the folders of a new image if the dataset is indexed
+        """
+        if not image.folders:
+            return
+
+        if count > 0 and cls.is_indexed(image.dataset_id):
+            cls.add(image.dataset_id, image.folders[-1:])
+        cls.inc_images(image.dataset_id, image.folders, count)
+
+    @classmethod
+    def is_indexed(cls, dataset_id):
+        """Whether the folders of a dataset were indexed by a scan"""
+        return cls.objects(dataset_id=dataset_id, path="").count() > 0
+
+
+__all__ = ["FolderModel"]
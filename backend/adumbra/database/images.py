@@ -12,8 +12,10 @@ from PIL import Image, ImageFile
 from adumbra.database.categories import CategoryModel
 from adumbra.database.datasets import DatasetModel
 from adumbra.database.events import Event, SessionEvent
+from adumbra.database.folders import image_folders
 from adumbra.database.mongo_shim import ShimmedDynamicDocument
 from adumbra.services.thumbnail import delete_thumbnail
+from adumbra.services.tiles import delete_tiles
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -22,6 +24,21 @@ class ImageModel(ShimmedDynamicDocument):
     # -- Private
     _dataset = None
 
+    meta = {
+        "indexes": [
+            # Dataset browsing and previous/next navigation in the annotator
+            ("dataset_id", "deleted", "file_name"),
+            # Dataset browsing within a folder
+            ("dataset_id", "deleted", "folders", "file_name"),
+            # Scans and folder browsing, which match on a path prefix
+            ("dataset_id", "path"),
+            # Undo list
+            ("deleted", "-deleted_date"),
+            # Pending thumbnails, regenerated on startup
+            "regenerate_thumbnail",
+        ]
+    }
+
     # -- Database
     id = fields.SequenceField(primary_key=True)
     dataset_id = fields.IntField(required=True)
@@ -29,9 +46,15 @@ class ImageModel(ShimmedDynamicDocument):
 
     # Absolute path to image file
     path = fields.StringField(required=True, unique=True)
+    # Folders containing the image relative to the dataset directory, from the
+    # dataset root ("") down to the image's own folder (e.g. "a/b/")
+    folders = fields.ListField(fields.StringField())
     width = fields.IntField(required=True)
     height = fields.IntField(required=True)
     file_name = fields.StringField()
+    # Size and modification time of the file when last read, to detect modified files
+    file_size = fields.IntField()
+    file_mtime = fields.FloatField()
 
     # True if the image is annotated
     annotated = fields.BooleanField(default=False)
@@ -53,29 +76,46 @@ class ImageModel(ShimmedDynamicDocument):
     milliseconds = fields.IntField(default=0)
     events = fields.EmbeddedDocumentListField(Event)
     regenerate_thumbnail = fields.BooleanField(default=False)
+    # When a thumbnail batch including the image was queued, unset once it runs
+    thumbnail_queued_at = fields.DateTimeField()
+    # Renders of the thumbnail that failed since the last one that succeeded
+    thumbnail_attempts = fields.IntField(default=0)
+
+    # Incremented on every annotator save and annotation copy, returned to the client
+    # as a version token
+    revision = fields.IntField(default=0)
 
     # TODO: determine how to accomplish this without overriding the delete method
     def delete(self, *args, **kwargs):
         delete_thumbnail(self.path)
+        delete_tiles(self.path)
         AnnotationModel.objects(image_id=self.id).delete()
         return super(ImageModel, self).delete(*args, **kwargs)
 
     @classmethod
-    def create_from_path(cls, path, dataset_id):
+    def create_from_path(cls, path, dataset_id, directory=None):
         if not dataset_id:
             raise ValueError("Dataset ID is required")
 
-        pil_image = Image.open(path)
+        if directory is None:
+            directory = DatasetModel.objects(id=dataset_id).only("directory").first()
+            directory = directory.directory
+
+        stat = os.stat(path)
+        # Opening only parses the header, the pixels are never decoded
+        with Image.open(path) as pil_image:
+            width, height = pil_image.size
 
         image = cls()
         image.file_name = os.path.basename(path)
         image.path = path
-        image.width = pil_image.size[0]
-        image.height = pil_image.size[1]
+        image.width = width
+        image.height = height
+        image.file_size = stat.st_size
+        image.file_mtime = stat.st_mtime
         image.regenerate_thumbnail = True
         image.dataset_id = dataset_id
-
-        pil_image.close()
+        image.folders = image_folders(directory, path)
 
         return image
 
@@ -123,6 +163,20 @@ class AnnotationModel(ShimmedDynamicDocument):
         "isbbox",
     ]
 
+    meta = {
+        "indexes": [
+            # Annotations of an image, e.g. in the annotator
+            ("image_id", "deleted"),
+            # Exports and per-category counts within a dataset
+            ("dataset_id", "category_id", "deleted"),
+            # Per-category counts across datasets
+            ("category_id", "deleted"),
+            # Undo list
+            ("deleted", "-deleted_date"),
+            "creator",
+        ]
+    }
+
     id = fields.SequenceField(primary_key=True)
     image_id = fields.IntField(required=True)
     category_id = fields.IntField(required=True)
@@ -151,6 +205,9 @@ class AnnotationModel(ShimmedDynamicDocument):
     milliseconds = fields.IntField(default=0)
     events = fields.EmbeddedDocumentListField(Event)
 
+    # Incremented on every update, used to reject writes based on stale data
+    revision = fields.IntField(default=0)
+
     def __init__(self, image_id=None, **data):
 
         if image_id is not None:
@@ -164,19 +221,40 @@ class AnnotationModel(ShimmedDynamicDocument):
 
         super(AnnotationModel, self).__init__(**data)
 
+    @classmethod
+    def for_image(cls, image, **data):
+        """
+        Creates an annotation from an already loaded image (model or raw document),
+        without the image lookup done by `__init__`
+        """
+        annotation = cls(**data)
+        annotation.image_id = image["_id"] if isinstance(image, dict) else image.id
+        annotation.width = image["width"]
+        annotation.height = image["height"]
+        annotation.dataset_id = image["dataset_id"]
+        return annotation
+
+    def set_defaults(self, default_metadata=None):
+        """Fills in the values `save` would, given the dataset's default metadata"""
+        if default_metadata is not None:
+            self.metadata = default_metadata.copy()
+
+        if self.color is None:
+            self.color = im.Color.random().hex
+
+        if not self.creator:
+            self.creator = current_user.username if current_user else "system"
+
     def save(self, *args, copy=False, **kwargs):
 
+        default_metadata = None
         if self.dataset_id and not copy:
             dataset = DatasetModel.objects(id=self.dataset_id).first()
 
             if dataset is not None:
-                self.metadata = dataset.default_annotation_metadata.copy()
+                default_metadata = dataset.default_annotation_metadata
 
-        if self.color is None:
-            self.color = im.Color.random().hex
-
-        if not self.creator:
-            self.creator = current_user.username if current_user else "system"
+        self.set_defaults(default_metadata)
 
         return super(AnnotationModel, self).save(*args, **kwargs)
 
@@ -197,6 +275,7 @@ class AnnotationModel(ShimmedDynamicDocument):
         """Creates a clone"""
         create = json.loads(self.to_json())
         del create["_id"]
+        create.pop("revision", None)
 
         return AnnotationModel(**create)
 
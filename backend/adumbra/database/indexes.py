@@ -0,0 +1,94 @@
+"""
+Creation and validation of the MongoDB indexes declared in the models' `meta`. Both
+operations are idempotent: existing indexes are left untouched.
+
+Run `python -m adumbra.database.indexes` to create missing indexes, or add `--check` to
+only report differences between the declared and the existing indexes.
+"""
+
+import argparse
+import logging
+import sys
+
+from adumbra.database import (
+    AnnotationModel,
+    CategoryModel,
+    DatasetModel,
+    ExportModel,
+    FolderModel,
+    ImageModel,
+    TaskLogModel,
+    TaskModel,
+    UserModel,
+    connect_mongo,
+)
+
+logger = logging.getLogger(__name__)
+
+MODELS = (
+    AnnotationModel,
+    CategoryModel,
+    DatasetModel,
+    ExportModel,
+    FolderModel,
+    ImageModel,
+    TaskLogModel,
+    TaskModel,
+    UserModel,
+)
+
+
+def ensure_indexes(models=MODELS) -> None:
+    """Creates the declared indexes of `models` that do not exist yet"""
+    for model in models:
+        model.ensure_indexes()
+
+
+def check_indexes(models=MODELS) -> dict[str, dict[str, list]]:
+    """
+    Compares the declared indexes of `models` with the ones in the database.
+
+    Returns
+    -------
+    dict[str, dict[str, list]]
+        The `missing` and `extra` indexes of every model whose indexes differ
+    """
+    report = {}
+    for model in models:
+        difference = model.compare_indexes()
+        if difference["missing"] or difference["extra"]:
+            report[model.__name__] = difference
+    return report
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Only report missing and extra indexes, exit with 1 if any index is missing",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    connect_mongo("indexes")
+
+    if not args.check:
+        ensure_indexes()
+
+    report = check_indexes()
+    for model, difference in report.items():
+        for index in difference["missing"]:
+            logger.warning(f"{model}: missing index {index}")
+        for index in difference["extra"]:
+            logger.info(f"{model}: undeclared index {index}")
+
+    if any(difference["missing"] for difference in report.values()):
+        return 1
+
+    logger.info("All declared indexes exist")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,10 @@ from mongoengine import DynamicDocument, QuerySet
 
 
 class ShimmedDynamicDocument(DynamicDocument):
-    """Provides type hinting on `objects`, nothing more."""
+    """
+    Provides type hinting on `objects`, and builds the indexes declared in `meta` in
+    the background so creating them on a large collection does not block MongoDB
+    """
 
-    meta = {"abstract": True}
+    meta = {"abstract": True, "index_background": True}
     objects: QuerySet
@@ -1,12 +1,36 @@
 import datetime
-import typing as t
+import time
 
 from mongoengine import fields
 
+from adumbra.config import CONFIG
 from adumbra.database.mongo_shim import ShimmedDynamicDocument
 
+# Tasks with buffered log lines by `id()`, since documents of the same task compare
+# equal; flushed by `flush_task_logs` when a worker finishes. The references are
+# strong so lines logged through a document dropped before then are not lost.
+_unflushed = {}
+
+
+class TaskLogModel(ShimmedDynamicDocument):
+    """A log line of a task, paginated in insertion order by `/tasks/<id>/logs`"""
+
+    meta = {"indexes": [("task_id", "id"), ("task_id", "level", "id")]}
+
+    task_id = fields.IntField(required=True)
+    level = fields.StringField(required=True)
+    message = fields.StringField()
+
 
 class TaskModel(ShimmedDynamicDocument):
+    meta = {
+        "indexes": [
+            # Tasks of a dataset, e.g. a running scan or import
+            ("dataset_id", "group"),
+            "creator",
+        ]
+    }
+
     id = fields.SequenceField(primary_key=True)
 
     # Type of task: Importer, Exporter, Scanner, etc.
@@ -32,7 +56,10 @@ class TaskModel(ShimmedDynamicDocument):
 
     progress = fields.FloatField(default=0, min_value=0, max_value=100)
 
+    # Logs of tasks created before logs were stored in `TaskLogModel`
     logs = fields.ListField(default=[])
+    # Lines logged, of which the first `CONFIG.tasks.max_log_lines` are stored
+    num_logs = fields.IntField(default=0)
     errors = fields.IntField(default=0)
     warnings = fields.IntField(default=0)
 
@@ -40,8 +67,13 @@ class TaskModel(ShimmedDynamicDocument):
 
     metadata = fields.DictField(default={})
 
-    _update_every = 10
-    _progress_update = 0
+    # Log lines and counts not written yet
+    _log_buffer = None
+    _log_counts = None
+    _log_flushed = 0.0
+    # Progress and time of the last progress write
+    _progress_written = None
+    _progress_time = 0.0
 
     def error(self, string):
         self._log(string, level="ERROR")
@@ -52,50 +84,113 @@ class TaskModel(ShimmedDynamicDocument):
     def info(self, string):
         self._log(string, level="INFO")
 
-    def _log(self, string, level):
+    def delete(self, *args, **kwargs):
+        TaskLogModel.objects(task_id=self.id).delete()
+        return super().delete(*args, **kwargs)
 
+    def _log(self, string, level):
+        """
+        Buffers a log line, written with others once `CONFIG.tasks.log_batch_size`
+        lines are buffered or `CONFIG.tasks.log_flush_interval` seconds passed.
+        Errors are written right away.
+        """
         level = level.upper()
         date = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
 
-        message = f"[{date}] [{level}] {string}"
-
-        statment: dict[str, t.Any] = {"push__logs": message}
+        if self._log_buffer is None:
+            self._log_buffer = []
+            self._log_counts = {"ERROR": 0, "WARNING": 0}
+            self._log_flushed = time.monotonic()
+        self._log_buffer.append(
+            {"level": level, "message": f"[{date}] [{level}] {string}"}
+        )
+        _unflushed[id(self)] = self
 
         if level == "ERROR":
-            statment["inc__errors"] = 1
+            self._log_counts[level] += 1
             self.errors += 1
-
-        if level == "WARNING":
-            statment["inc__warnings"] = 1
+        elif level == "WARNING":
+            self._log_counts[level] += 1
             self.warnings += 1
 
-        self.update(**statment)
+        if (
+            level == "ERROR"
+            or len(self._log_buffer) >= CONFIG.tasks.log_batch_size
+            or time.monotonic() - self._log_flushed >= CONFIG.tasks.log_flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered log lines and error and warning counts"""
+        if not self._log_buffer:
+            return
+
+        lines, counts = self._log_buffer, self._log_counts
+        self._log_buffer = []
+        self._log_counts = {"ERROR": 0, "WARNING": 0}
+        self._log_flushed = time.monotonic()
+        _unflushed.pop(id(self), None)
+
+        # Lines past the limit are only counted, so a task document stays small and
+        # its logs bounded however many items it processes
+        task = (
+            type(self)
+            .objects(id=self.id)
+            .modify(
+                inc__num_logs=len(lines),
+                inc__errors=counts["ERROR"],
+                inc__warnings=counts["WARNING"],
+                new=True,
+            )
+        )
+        stored = max(0, CONFIG.tasks.max_log_lines - (task.num_logs - len(lines)))
+        if stored:
+            # pylint: disable-next=protected-access
+            TaskLogModel._get_collection().insert_many(
+                [{"task_id": self.id, **line} for line in lines[:stored]],
+                ordered=True,
+            )
 
     def set_progress(self, percent, socket=None):
-
-        self.update(progress=int(percent), completed=percent >= 100)
-
-        # Send socket update every 10%
-        if self._progress_update < percent or percent >= 100:
-
-            if socket is not None:
-                # logger.debug(f"Emitting {percent} progress update for task {self.id}")
-
-                socket.emit(
-                    "taskProgress",
-                    {
-                        "id": self.id,
-                        "progress": percent,
-                        "errors": self.errors,
-                        "warnings": self.warnings,
-                    },
-                )
-                # }, broadcast=True) # dunno why this seem's to not exists anymore !?
-
-            self._progress_update += self._update_every
+        """
+        Records the progress of the task and emits it to clients, skipping updates
+        smaller than `CONFIG.tasks.progress_step` percent or less than
+        `CONFIG.tasks.progress_interval` seconds after the previous one
+        """
+        completed = percent >= 100
+        now = time.monotonic()
+        if not completed and self._progress_written is not None:
+            if (
+                percent - self._progress_written < CONFIG.tasks.progress_step
+                or now - self._progress_time < CONFIG.tasks.progress_interval
+            ):
+                return
+
+        self._progress_written = percent
+        self._progress_time = now
+        if completed:
+            self.flush()
+        self.update(progress=int(percent), completed=completed)
+
+        if socket is not None:
+            socket.emit(
+                "taskProgress",
+                {
+                    "id": self.id,
+                    "progress": percent,
+                    "errors": self.errors,
+                    "warnings": self.warnings,
+                },
+            )
 
     def api_json(self):
         return {"id": self.id, "name": self.name}
 
 
-__all__ = ["TaskModel"]
+def flush_task_logs():
+    """Writes the buffered log lines of every task of this process"""
+    for task in list(_unflushed.values()):
+        task.flush()
+
+
+__all__ = ["TaskLogModel", "TaskModel"]
@@ -0,0 +1,7 @@
+from PIL import Image
+
+# Dataset images are trusted, and the largest ones are what tile pyramids exist for.
+# Pillow's decompression bomb limit is lifted once, for every reader of the services
+# (headers, thumbnails, previews and tiles), rather than swapped around reads, which
+# other threads would see.
+Image.MAX_IMAGE_PIXELS = None
@@ -0,0 +1,166 @@
+"""
+A bounded on-disk cache of rendered images, shared by every process using the same
+directory. Entries are addressed by a hash of everything that determines their
+content, so a changed source file simply misses and its old entries age out.
+"""
+
+import fcntl
+import hashlib
+import os
+import threading
+import typing as t
+from dataclasses import asdict, dataclass
+
+# Fraction of `max_size` the cache is trimmed down to once it grows past it, so
+# eviction does not run again on the next write
+EVICTION_TARGET = 0.9
+
+
+@dataclass
+class ImageCacheStats:
+    """Counters of one process using the cache"""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class ImageCache:
+    """
+    Stores rendered images under `directory`, keeping at most `max_size` bytes by
+    evicting the least recently used entries. Reads bump an entry's modification time,
+    which is what recency is measured by, since access times are often not tracked.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.stats = ImageCacheStats()
+
+        self._lock = threading.Lock()
+        # Bytes written since the size on disk was last measured
+        self._written = 0
+        self._size = None
+
+    @staticmethod
+    def key(source_path: str, *params: t.Any) -> str:
+        """
+        Key of a rendering of `source_path`, which changes with the file's modification
+        time and with the rendering `params` (e.g. size, format and quality)
+        """
+        parts = [source_path, os.path.getmtime(source_path), *params]
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def path(self, key: str, extension: str = ".jpg") -> str:
+        return os.path.join(self.directory, key[:2], key + extension)
+
+    def get_or_create(
+        self,
+        key: str,
+        render: t.Callable[[str], None],
+        extension: str = ".jpg",
+    ) -> str:
+        """
+        Return the path of the entry `key`, calling `render` with a path to write it
+        to when it is missing
+        """
+        path = self.path(key, extension)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        else:
+            self._count("hits")
+            return path
+
+        self._count("misses")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Render to a temporary file so no process ever sends a partial entry
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            render(temporary_path)
+            size = os.path.getsize(temporary_path)
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+        with self._lock:
+            self._written += size
+            must_evict = self._size is None or self._size + self._written > (
+                self.max_size
+            )
+        if must_evict:
+            self.evict()
+
+        return path
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache fits in its size limit.
+        Only one process evicts at a time; others skip eviction while it runs.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(
+            os.path.join(self.directory, ".lock"), "w", encoding="utf-8"
+        ) as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            entries = self._entries()
+            size = sum(entry_size for _, _, entry_size in entries)
+            removed = 0
+            if size > self.max_size:
+                for _, path, entry_size in sorted(entries):
+                    if size <= self.max_size * EVICTION_TARGET:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        continue
+                    size -= entry_size
+                    removed += 1
+
+        with self._lock:
+            self._size = size
+            self._written = 0
+            self.stats.evictions += removed
+
+    def usage(self) -> dict:
+        """Size on disk and counters of this process, e.g. for monitoring"""
+        entries = self._entries()
+        return {
+            "entries": len(entries),
+            "size": sum(entry_size for _, _, entry_size in entries),
+            "max_size": self.max_size,
+            **self.stats.to_dict(),
+        }
+
+    def _entries(self) -> list[tuple[float, str, int]]:
+        """Modification time, path and size of every entry"""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.startswith(".") or file.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+
+        return entries
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self.stats, counter, getattr(self.stats, counter) + 1)
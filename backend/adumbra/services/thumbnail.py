@@ -1,6 +1,11 @@
+import glob
+import math
 import os
+import tempfile
+from collections import defaultdict
 
-import imantics
+import cv2
+import numpy as np
 from PIL import Image, ImageFile
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -10,6 +15,18 @@ THUMBNAIL_DIRECTORY = ".thumbnail"
 # Set maximum thumbnail size (h x w) to use on dataset page
 MAX_THUMBNAIL_DIM = (1024, 1024)
 
+# Resized copies of images, next to the image like thumbnails
+VARIANT_DIRECTORY = ".variants"
+
+# Longest sides of the resized copies pre-generated by the thumbnail worker
+VARIANT_SIZES = (256, 512, 1024)
+
+# Quality of the JPEGs written for resized copies
+JPEG_QUALITY = 80
+
+# Extensions of images sent to browsers without converting them
+BROWSER_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+
 # TODO: add typing when TER-83 is completed
 
 
@@ -20,13 +37,7 @@ def get_thumbnail_path(image_path):
     folders = image_path.split("/")
     folders.insert(len(folders) - 1, THUMBNAIL_DIRECTORY)
 
-    thumbnail_path = "/" + os.path.join(*folders)
-    directory = os.path.dirname(thumbnail_path)
-
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    return thumbnail_path
+    return "/" + os.path.join(*folders)
 
 
 def open_thumbnail(image_path):
@@ -42,27 +53,274 @@ def open_thumbnail(image_path):
 
 def delete_thumbnail(image_path):
     """
-    Delete thumbnail
+    Delete thumbnail and the resized copies of the image and thumbnail
     """
     thumbnail_path = get_thumbnail_path(image_path)
     if os.path.isfile(thumbnail_path):
         os.remove(thumbnail_path)
 
+    for thumbnail in (False, True):
+        prefix, extension = os.path.splitext(
+            get_variant_path(image_path, "", thumbnail)
+        )
+        for variant_path in glob.glob(f"{glob.escape(prefix)}*{extension}"):
+            os.remove(variant_path)
+
 
-def create_thumbnail(image_path, annotations):
-    image = imantics.Image.from_path(image_path)
+def get_variant_path(image_path, size, thumbnail=False):
+    """
+    Return the path of a resized copy of an image, or of its thumbnail. `size` is
+    one of `VARIANT_SIZES` or any other label of the size
+    """
+    directory, file_name = os.path.split(image_path)
+    directory = os.path.join(
+        directory, THUMBNAIL_DIRECTORY if thumbnail else VARIANT_DIRECTORY
+    )
+    return os.path.join(directory, f"{file_name}@{size}.jpg")
+
+
+def _is_fresh(path, source_path):
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(
+        source_path
+    )
+
+
+def _write_jpeg(pil_image, path):
+    pil_image.convert("RGB").save(
+        path, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True
+    )
+
+
+def _write_atomically(path, write):
+    """
+    Call `write` with a unique temporary path next to `path`, then move it in place
+    so a file being served is never partial
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(file_descriptor)
+    try:
+        write(temporary_path)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def _save_jpeg(pil_image, path):
+    _write_atomically(
+        path, lambda temporary_path: _write_jpeg(pil_image, temporary_path)
+    )
+
+
+def open_reduced(image_path, box):
+    """
+    Open an image to be fit in `box`, decoding no more pixels than needed: JPEGs are
+    decoded at 1/2, 1/4 or 1/8 scale and multi-resolution TIFFs from their smallest
+    level that is still large enough. Other images are decoded in full.
+    """
+    pil_image = Image.open(image_path)
+    if box is None:
+        return pil_image
+
+    width, height = pil_image.size
+    scale = min(box[0] / width, box[1] / height)
+    if scale >= 1:
+        return pil_image
+    target = (math.ceil(width * scale), math.ceil(height * scale))
+
+    if pil_image.format == "JPEG":
+        pil_image.draft("RGB", target)
+    elif pil_image.format == "TIFF" and getattr(pil_image, "n_frames", 1) > 1:
+        # Pyramidal TIFFs store each level as a page; pick the smallest level that
+        # keeps the aspect ratio and covers the target size
+        level, level_size = 0, pil_image.size
+        for frame in range(1, pil_image.n_frames):
+            pil_image.seek(frame)
+            frame_width, frame_height = pil_image.size
+            if (
+                target[0] <= frame_width < level_size[0]
+                and target[1] <= frame_height
+                and abs(frame_width / frame_height - width / height) < 0.01
+            ):
+                level, level_size = frame, pil_image.size
+        pil_image.seek(level)
+
+    return pil_image
+
+
+def _resize(source_path, box, path):
+    with open_reduced(source_path, box) as pil_image:
+        if box is not None:
+            pil_image.thumbnail(box, Image.Resampling.LANCZOS)
+        _write_jpeg(pil_image, path)
+
+
+def save_variants(image_path, thumbnail=False):
+    """
+    Pre-generate the `VARIANT_SIZES` copies of an image (or its thumbnail) that are
+    older than it. Each copy is resized from the previous, larger one.
+    """
+    source_path = get_thumbnail_path(image_path) if thumbnail else image_path
+    paths = {
+        size: get_variant_path(image_path, size, thumbnail) for size in VARIANT_SIZES
+    }
+    if all(_is_fresh(path, source_path) for path in paths.values()):
+        return
+
+    largest = max(VARIANT_SIZES)
+    with open_reduced(source_path, (largest, largest)) as pil_image:
+        pil_image = pil_image.convert("RGB")
+        for size in sorted(VARIANT_SIZES, reverse=True):
+            pil_image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            _save_jpeg(pil_image, paths[size])
+
+
+def get_image_file(
+    image_path, width=None, height=None, *, thumbnail=False, cache=None, image_size=None
+):
+    """
+    Return the path of a file showing the image (or its thumbnail when available)
+    fit in `width` x `height`, for sending as is. A missing bound leaves that side
+    unconstrained.
+
+    Requests with a single bound, or a square one, use the smallest pre-generated
+    copy of `VARIANT_SIZES` that is not smaller than the image fit in the request,
+    found from `image_size` (read from the file when not given). Other sizes are
+    resized once and stored in `cache` (an `ImageCache`), or next to the image
+    without one. Without a size, browser-friendly images are sent unchanged.
+    """
+    source_path = image_path
+    if thumbnail and os.path.exists(get_thumbnail_path(image_path)):
+        source_path = get_thumbnail_path(image_path)
+    else:
+        thumbnail = False
+
+    if not width and not height:
+        if source_path.lower().endswith(BROWSER_EXTENSIONS):
+            return source_path
+        size, box = "full", None
+    else:
+        size = f"{width or 0}x{height or 0}"
+        box = (width or 1 << 16, height or 1 << 16)
+
+        if not width or not height or width == height:
+            if image_size is None:
+                with Image.open(source_path) as pil_image:
+                    image_size = pil_image.size
+            # Copies hold the image fit in a square, so the one reaching the long
+            # side of the image fit in the box is at least as large as requested
+            scale = min(box[0] / image_size[0], box[1] / image_size[1], 1)
+            long_side = math.ceil(max(image_size) * scale)
+            if long_side <= max(VARIANT_SIZES):
+                size = min(s for s in VARIANT_SIZES if s >= long_side)
+                box = (size, size)
+
+    if cache is not None and size not in VARIANT_SIZES:
+        key = cache.key(source_path, box, "JPEG", JPEG_QUALITY)
+        return cache.get_or_create(key, lambda path: _resize(source_path, box, path))
+
+    path = get_variant_path(image_path, size, thumbnail)
+    if not _is_fresh(path, source_path):
+        _write_atomically(
+            path, lambda temporary_path: _resize(source_path, box, temporary_path)
+        )
+
+    return path
+
+
+def _hex_to_rgb(color):
+    color = (color or "").lstrip("#")
+    if len(color) != 6:
+        return None
+    return tuple(int(color[i : i + 2], 16) for i in (0, 2, 4))
+
+
+def _annotation_shapes(annotations, categories, scale):
+    """
+    Polygons and bounding boxes of the annotations in image coordinates scaled by
+    `scale`, grouped by color, along with the category labels to write
+    """
+    polygons = defaultdict(list)
+    boxes = defaultdict(list)
+    labels = []
     for annotation in annotations:
-        if not annotation.is_empty():
-            # TODO: pull __call__ from annotation
-            image.add(annotation())
+        if len(annotation.segmentation) == 0 or annotation.area == 0:
+            continue
+
+        category = categories.get(annotation.category_id)
+        color = _hex_to_rgb(category.color if category else None) or _hex_to_rgb(
+            annotation.color
+        )
+        if color is None:
+            color = (255, 255, 255)
+
+        for segmentation in annotation.segmentation:
+            if len(segmentation) >= 6:
+                points = np.asarray(segmentation, dtype=np.float64).reshape(-1, 2)
+                polygons[color].append(np.rint(points * scale).astype(np.int32))
+
+        if len(annotation.bbox) == 4:
+            x, y, width, height = (value * scale for value in annotation.bbox)
+            corners = [[x, y], [x + width, y], [x + width, y + height], [x, y + height]]
+            boxes[color].append(np.rint(corners).astype(np.int32))
+            if category is not None:
+                labels.append((category.name, (int(x), int(y))))
+
+    return polygons, boxes, labels
+
+
+def create_thumbnail(image_path, annotations, categories, box=MAX_THUMBNAIL_DIM):
+    """
+    Draw the annotations of an image over it, fit in `box` (full size without one).
+
+    The image is downsampled before drawing and the annotations are scaled to it, so
+    the cost depends on the output size. Shapes are drawn with one OpenCV call per
+    color: masks blended at half opacity, then outlines and bounding boxes.
+    `categories` maps category ids to categories, whose colors and names are used.
+    """
+    with Image.open(image_path) as pil_image:
+        full_width = pil_image.width
+
+    with open_reduced(image_path, box) as pil_image:
+        if box is not None:
+            pil_image.thumbnail(box, Image.Resampling.LANCZOS)
+        array = np.array(pil_image.convert("RGB"))
+
+    scale = array.shape[1] / full_width
+    polygons, boxes, labels = _annotation_shapes(annotations, categories, scale)
+
+    overlay = array.copy()
+    for color, color_polygons in polygons.items():
+        cv2.fillPoly(overlay, color_polygons, color)
+    array = cv2.addWeighted(overlay, 0.5, array, 0.5, 0)
+
+    thickness = max(1, round(3 * scale))
+    for color, color_polygons in polygons.items():
+        cv2.polylines(array, color_polygons, True, color, thickness)
+    for color, color_boxes in boxes.items():
+        cv2.polylines(array, color_boxes, True, color, max(1, round(2 * scale)))
+
+    for name, position in labels:
+        for color, width in (((0, 0, 0), 2), ((255, 255, 255), 1)):
+            cv2.putText(
+                array,
+                name,
+                position,
+                cv2.FONT_HERSHEY_PLAIN,
+                0.5,
+                color,
+                width,
+                cv2.LINE_AA,
+            )
 
-    drawn_thumbnail = image.draw(color_by_category=True, bbox=True)
-    return Image.fromarray(drawn_thumbnail)
+    return Image.fromarray(array)
 
 
-def save_thumbnail(image_path, annotations):
+def save_thumbnail(image_path, annotations, categories):
     thumbnail_path = get_thumbnail_path(image_path)
-    pil_image = create_thumbnail(image_path, annotations)
+    pil_image = create_thumbnail(image_path, annotations, categories)
     pil_image = pil_image.convert("RGB")
 
     # Resize image to fit in MAX_THUMBNAIL_DIM envelope as necessary
@@ -70,6 +328,12 @@ def save_thumbnail(image_path, annotations):
 
     # Save as a jpeg to improve loading time
     # (note file extension will not match but allows for backwards compatibility)
-    pil_image.save(thumbnail_path, "JPEG", quality=80, optimize=True, progressive=True)
+    _write_atomically(
+        thumbnail_path,
+        lambda temporary_path: pil_image.save(
+            temporary_path, "JPEG", quality=80, optimize=True, progressive=True
+        ),
+    )
+    save_variants(image_path, thumbnail=True)
 
     return pil_image
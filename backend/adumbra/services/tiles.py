@@ -0,0 +1,115 @@
+"""
+Deep-zoom tile pyramids of large images, so the annotator only loads the tiles that
+are visible at its current zoom. Level 0 is a single pixel and every level doubles the
+size of the previous one, up to the full image at the last level.
+"""
+
+import math
+import os
+import shutil
+
+from PIL import Image
+
+TILE_DIRECTORY = ".tiles"
+
+# Side of the square tiles in pixels; tiles on the right and bottom edges are smaller
+TILE_SIZE = 256
+
+
+def level_count(width, height):
+    return math.ceil(math.log2(max(width, height, 1))) + 1
+
+
+def level_size(width, height, level):
+    """Size of the image at a level of its pyramid"""
+    scale = 2 ** (level_count(width, height) - 1 - level)
+    return math.ceil(width / scale), math.ceil(height / scale)
+
+
+def tile_info(width, height):
+    """Description of the pyramid of an image, as needed by the client"""
+    return {
+        "width": width,
+        "height": height,
+        "tile_size": TILE_SIZE,
+        "levels": level_count(width, height),
+        "format": "jpg",
+    }
+
+
+def get_tile_directory(image_path):
+    """
+    Return the directory of the tile pyramid of an image, next to the image like its
+    thumbnail
+    """
+    directory, file_name = os.path.split(image_path)
+    return os.path.join(directory, TILE_DIRECTORY, file_name)
+
+
+def get_tile_path(image_path, level, column, row):
+    return os.path.join(
+        get_tile_directory(image_path), str(level), f"{column}_{row}.jpg"
+    )
+
+
+def has_tiles(image_path):
+    """Whether the pyramid of an image is built and newer than the image"""
+    directory = get_tile_directory(image_path)
+    if not os.path.isdir(directory):
+        return False
+    return os.path.getmtime(directory) >= os.path.getmtime(image_path)
+
+
+def build_tiles(image_path):
+    """
+    Build the tile pyramid of an image, from the full image down to a single pixel.
+    The pyramid is written to a temporary directory that replaces the previous one
+    when complete, so tiles are never served from a partial pyramid.
+    """
+    directory = get_tile_directory(image_path)
+    temporary_directory = f"{directory}.{os.getpid()}.tmp"
+    shutil.rmtree(temporary_directory, ignore_errors=True)
+
+    # The full resolution level needs every pixel, so the image is decoded once, in
+    # its own mode when tiles can be saved from it. Each level is reduced from the
+    # previous one, which is then released.
+    with Image.open(image_path) as pil_image:
+        if pil_image.mode not in ("L", "RGB"):
+            pil_image = pil_image.convert("RGB")
+        level = level_count(*pil_image.size) - 1
+        _save_level(pil_image, os.path.join(temporary_directory, str(level)))
+        if level > 0:
+            pil_image = pil_image.reduce(2)
+
+    for level in reversed(range(level)):
+        _save_level(pil_image, os.path.join(temporary_directory, str(level)))
+        # Sizes are rounded up, as in `level_size`
+        if level > 0:
+            pil_image = pil_image.reduce(2)
+
+    delete_tiles(image_path)
+    os.replace(temporary_directory, directory)
+
+
+def _save_level(pil_image, level_directory):
+    os.makedirs(level_directory)
+    for column in range(math.ceil(pil_image.width / TILE_SIZE)):
+        for row in range(math.ceil(pil_image.height / TILE_SIZE)):
+            left, top = column * TILE_SIZE, row * TILE_SIZE
+            tile = pil_image.crop(
+                (
+                    left,
+                    top,
+                    min(left + TILE_SIZE, pil_image.width),
+                    min(top + TILE_SIZE, pil_image.height),
+                )
+            )
+            tile.save(
+                os.path.join(level_directory, f"{column}_{row}.jpg"),
+                "JPEG",
+                quality=85,
+            )
+
+
+def delete_tiles(image_path):
+    shutil.rmtree(get_tile_directory(image_path), ignore_errors=True)
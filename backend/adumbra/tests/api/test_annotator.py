@@ -0,0 +1,191 @@
+# Redefining the name is by definition how fixtures work
+# pylint: disable=redefined-outer-name
+import pytest
+
+from adumbra.database import AnnotationModel, CategoryModel, DatasetModel
+from adumbra.webserver.api import annotator
+
+SQUARE = [
+    "CompoundPath",
+    {"children": [["Path", {"segments": [[-3, -3], [2, -3], [2, 2], [-3, 2]]}]]},
+]
+
+
+@pytest.fixture
+def image(create_dataset, monkeypatch):
+    monkeypatch.setattr(annotator.thumbnails, "generate_thumbnail", lambda image: None)
+
+    category = CategoryModel(name="annotator-test")
+    category.save()
+    _, (image,) = create_dataset(
+        "annotator-test", ["image.jpg"], categories=[category.id]
+    )
+    for _ in range(2):
+        AnnotationModel(
+            image_id=image.id, category_id=category.id, creator="user1"
+        ).save()
+
+    return image
+
+
+def _save_data(image, annotations):
+    category_id = annotations[0].category_id
+    return {
+        "image": {"id": image.id, "category_ids": [category_id]},
+        "dataset": {},
+        "categories": [
+            {
+                "id": category_id,
+                "color": "#ffffff",
+                "annotations": [
+                    {"id": annotation.id, "compoundPath": SQUARE, "color": "#000000"}
+                    for annotation in annotations
+                ],
+            }
+        ],
+    }
+
+
+class TestAnnotatorData:
+
+    def test_save(self, client, image):
+        annotations = list(AnnotationModel.objects(image_id=image.id))
+
+        response = client.post(
+            "/api/annotator/data", json=_save_data(image, annotations)
+        )
+        assert response.status_code == 200
+
+        image.reload()
+        assert image.revision == 1
+        assert image.num_annotations == 2
+        assert image.annotated
+        assert DatasetModel.objects.get(id=image.dataset_id).last_modified
+        for annotation in AnnotationModel.objects(image_id=image.id):
+            assert annotation.area > 0
+            assert annotation.color == "#000000"
+        assert CategoryModel.objects.get(id=annotations[0].category_id).color == (
+            "#ffffff"
+        )
+
+    def test_delta_save_keeps_other_annotations(self, client, image):
+        annotations = list(AnnotationModel.objects(image_id=image.id))
+        client.post("/api/annotator/data", json=_save_data(image, annotations))
+
+        # Only the first annotation changed since the last save
+        data = _save_data(image, annotations[:1])
+        data["categories"][0]["annotations"][0]["color"] = "#ff0000"
+        response = client.post("/api/annotator/data", json=data)
+        assert response.status_code == 200
+
+        image.reload()
+        assert image.revision == 2
+        assert image.num_annotations == 2
+        assert AnnotationModel.objects.get(id=annotations[0].id).color == "#ff0000"
+        assert AnnotationModel.objects.get(id=annotations[1].id).color == "#000000"
+
+    def test_stale_revision_conflicts(self, client, image):
+        annotations = list(AnnotationModel.objects(image_id=image.id))
+        data = _save_data(image, annotations)
+        for annotation in data["categories"][0]["annotations"]:
+            annotation["revision"] = 0
+
+        response = client.post("/api/annotator/data", json=data)
+        assert response.status_code == 200
+        assert set(response.json["revisions"].values()) == {1}
+
+        # Second client still holds revision 0 of the first annotation
+        data["categories"][0]["annotations"] = data["categories"][0]["annotations"][:1]
+        data["categories"][0]["annotations"][0]["color"] = "#ff0000"
+        response = client.post("/api/annotator/data", json=data)
+        assert response.status_code == 409
+        assert response.json["conflicts"] == [annotations[0].id]
+        assert AnnotationModel.objects.get(id=annotations[0].id).color == "#000000"
+
+    def test_raced_annotation_conflicts(self, client, image, monkeypatch):
+        AnnotationModel(
+            image_id=image.id, category_id=image.dataset.categories[0], creator="user1"
+        ).save()
+        annotations = list(AnnotationModel.objects(image_id=image.id))
+        data = _save_data(image, annotations)
+        for annotation in data["categories"][0]["annotations"]:
+            annotation["revision"] = 0
+
+        # Another save writes the second annotation once this one has read it
+        # pylint: disable-next=protected-access
+        annotation_update = annotator._annotation_update
+
+        def racing_update(image_id, annotation, db_annotation):
+            if annotation["id"] == annotations[1].id:
+                AnnotationModel.objects(id=annotation["id"]).update(
+                    inc__revision=1, color="#00ff00"
+                )
+            return annotation_update(image_id, annotation, db_annotation)
+
+        monkeypatch.setattr(annotator, "_annotation_update", racing_update)
+
+        response = client.post("/api/annotator/data", json=data)
+        assert response.status_code == 409
+        assert response.json["conflicts"] == [annotations[1].id]
+        assert response.json["revisions"] == {
+            str(annotations[0].id): 1,
+            str(annotations[1].id): 1,
+            str(annotations[2].id): 1,
+        }
+
+        # The other annotations and the image are saved all the same
+        assert AnnotationModel.objects.get(id=annotations[1].id).color == "#00ff00"
+        for annotation in (annotations[0], annotations[2]):
+            assert AnnotationModel.objects.get(id=annotation.id).color == "#000000"
+        image.reload()
+        assert image.revision == 1
+        assert image.num_annotations == 2
+        assert image.annotated
+
+
+class TestAnnotationRevision:
+
+    def test_put_stale_revision(self, client, image):
+        annotation = AnnotationModel.objects(image_id=image.id).first()
+        url = f"/api/annotation/{annotation.id}"
+
+        response = client.put(url, json={"category_id": 1, "revision": 0})
+        assert response.status_code == 200
+        assert response.json["revision"] == 1
+
+        response = client.put(url, json={"category_id": 2, "revision": 0})
+        assert response.status_code == 409
+        assert response.json["revision"] == 1
+
+        response = client.delete(url, query_string={"revision": 0})
+        assert response.status_code == 409
+        assert not AnnotationModel.objects.get(id=annotation.id).deleted
+
+        response = client.delete(url, query_string={"revision": 1})
+        assert response.status_code == 200
+
+
+class TestAnnotatorId:
+
+    def test_get_groups_annotations(self, client, image):
+        category = CategoryModel.objects.first()
+        other = CategoryModel(name="annotator-test-other")
+        other.save()
+        DatasetModel.objects(id=image.dataset_id).update(push__categories=other.id)
+        AnnotationModel(
+            image_id=image.id, category_id=other.id, creator="user1", paper_object=[1]
+        ).save()
+
+        response = client.get(f"/api/annotator/data/{image.id}")
+        assert response.status_code == 200
+        annotations = {c["id"]: c["annotations"] for c in response.json["categories"]}
+        assert len(annotations[category.id]) == 2
+        assert len(annotations[other.id]) == 1
+        assert annotations[other.id][0]["paper_object"] == [1]
+
+        response = client.get(
+            f"/api/annotator/data/{image.id}", query_string={"paper_object": "false"}
+        )
+        for category in response.json["categories"]:
+            for annotation in category["annotations"]:
+                assert "paper_object" not in annotation
@@ -0,0 +1,266 @@
+import io
+import json
+import os
+
+import pytest
+
+from adumbra.config import CONFIG
+from adumbra.database import (
+    AnnotationModel,
+    CategoryModel,
+    DatasetModel,
+    FolderModel,
+    ImageModel,
+    TaskModel,
+)
+from adumbra.workers import celery
+from adumbra.workers.tasks import data
+from adumbra.workers.tasks.scan import index_folders
+
+SQUARE = [[1, 1, 5, 1, 5, 5, 1, 5]]
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG, "dataset_directory", str(tmp_path))
+
+    categories = [CategoryModel(name=f"dataset-test-{i}") for i in range(2)]
+    for category in categories:
+        category.save()
+
+    dataset = DatasetModel(
+        name="dataset-test", categories=[category.id for category in categories]
+    )
+    dataset.save()
+
+    # A second dataset whose annotations must never leak into the first one
+    other = DatasetModel(name="dataset-test-other")
+    other.save()
+
+    for i in range(3):
+        image = ImageModel(
+            dataset_id=dataset.id,
+            path=f"{dataset.directory}image{i}.jpg",
+            file_name=f"image{i}.jpg",
+            width=10,
+            height=10,
+        )
+        image.save()
+        for category in categories[:i]:
+            AnnotationModel(
+                image_id=image.id,
+                category_id=category.id,
+                segmentation=SQUARE,
+                area=16,
+                creator="user1",
+            ).save()
+
+    other_image = ImageModel(
+        dataset_id=other.id,
+        path=f"{other.directory}image.jpg",
+        file_name="image.jpg",
+        width=10,
+        height=10,
+    )
+    other_image.save()
+    AnnotationModel(
+        image_id=other_image.id,
+        category_id=categories[0].id,
+        segmentation=SQUARE,
+        area=16,
+        creator="user1",
+    ).save()
+
+    yield dataset
+
+    for model in (AnnotationModel, ImageModel, CategoryModel, DatasetModel):
+        model.objects.delete()
+
+
+class TestDatasetCoco:
+
+    def test_get_invalid_id(self, client):
+        response = client.get("/api/dataset/1000/coco")
+        assert response.status_code == 400
+
+    def test_get_coco(self, client, dataset):
+        response = client.get(f"/api/dataset/{dataset.id}/coco")
+        assert response.status_code == 200
+
+        coco = json.loads(response.get_data())
+        image_ids = {image["id"] for image in coco["images"]}
+        dataset_images = ImageModel.objects(dataset_id=dataset.id)
+
+        # Image without annotations is left out
+        assert len(coco["images"]) == 2
+        assert image_ids <= set(dataset_images.distinct("id"))
+        assert len(coco["annotations"]) == 3
+        assert {annotation["image_id"] for annotation in coco["annotations"]} == (
+            image_ids
+        )
+        assert len(coco["categories"]) == 2
+
+        for annotation in coco["annotations"]:
+            assert "deleted" not in annotation
+            assert "paper_object" not in annotation
+            assert "keypoints" not in annotation
+
+
+class TestDatasetCocoImport:
+
+    def test_post_coco(self, client, dataset, monkeypatch):
+        monkeypatch.setattr(celery.conf, "task_always_eager", True)
+        monkeypatch.setattr(data, "create_socket", lambda: None)
+        coco = {
+            "categories": [{"id": 1, "name": "dataset-test-0"}],
+            "images": [{"id": 1, "file_name": "image0.jpg"}],
+            "annotations": [
+                {"id": 1, "image_id": 1, "category_id": 1, "segmentation": SQUARE}
+            ],
+        }
+
+        response = client.post(
+            f"/api/dataset/{dataset.id}/coco",
+            data={"coco": (io.BytesIO(json.dumps(coco).encode()), "coco.json")},
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 200
+        assert TaskModel.objects.get(id=response.json["id"]).completed
+
+        image = ImageModel.objects.get(dataset_id=dataset.id, file_name="image0.jpg")
+        assert AnnotationModel.objects(image_id=image.id).count() == 1
+
+        # The spooled upload is removed once imported
+        assert os.listdir(os.path.join(dataset.directory, ".imports")) == []
+        TaskModel.objects.delete()
+
+
+class TestDatasetStats:
+
+    def test_get_invalid_id(self, client):
+        response = client.get("/api/dataset/1000/stats")
+        assert response.status_code == 400
+
+    def test_get_stats(self, client, dataset):
+        dataset.update(users=["user1"])
+        ImageModel.objects(dataset_id=dataset.id, file_name="image2.jpg").update(
+            annotated=True, milliseconds=3000
+        )
+
+        response = client.get(f"/api/dataset/{dataset.id}/stats")
+        assert response.status_code == 200
+
+        stats = response.json
+        assert stats["total"]["Users"] == 1
+        assert stats["total"]["Images"] == 3
+        assert stats["total"]["Annotated Images"] == 1
+        assert stats["total"]["Annotations"] == 3
+        assert stats["total"]["Categories"] == 2
+        assert stats["total"]["Time Annotating (s)"] == 3
+        assert stats["average"]["Image Size (px)"] == 10
+        assert stats["average"]["Annotation Area (px)"] == 16
+        assert stats["average"]["Time (ms) per Image"] == 1000
+        assert stats["categories"] == {"dataset-test-0": 2, "dataset-test-1": 1}
+        assert stats["images_per_category"] == {
+            "dataset-test-0": 2,
+            "dataset-test-1": 1,
+        }
+        assert stats["users"] == {"user1": {"annotations": 3, "images": 2}}
+
+    def test_stats_refresh_after_modification(self, client, dataset):
+        response = client.get(f"/api/dataset/{dataset.id}/stats")
+        assert response.json["total"]["Annotations"] == 3
+
+        AnnotationModel.objects(dataset_id=dataset.id).first().update(deleted=True)
+        response = client.get(f"/api/dataset/{dataset.id}/stats")
+        assert response.json["total"]["Annotations"] == 3
+
+        DatasetModel.mark_modified(dataset.id)
+        response = client.get(f"/api/dataset/{dataset.id}/stats")
+        assert response.json["total"]["Annotations"] == 2
+
+
+class TestDatasetDataId:
+
+    def test_get_with_cursor(self, client, dataset):
+        url = f"/api/dataset/{dataset.id}/data"
+
+        response = client.get(url, query_string={"limit": 2})
+        assert response.status_code == 200
+        first_page = response.json
+        assert first_page["total"] == 3
+        assert [image["file_name"] for image in first_page["images"]] == [
+            "image0.jpg",
+            "image1.jpg",
+        ]
+        assert first_page["next_cursor"] is not None
+
+        response = client.get(
+            url,
+            query_string={
+                "limit": 2,
+                "cursor": first_page["next_cursor"],
+                "total": "false",
+            },
+        )
+        second_page = response.json
+        assert second_page["total"] is None
+        assert [image["file_name"] for image in second_page["images"]] == ["image2.jpg"]
+        assert second_page["next_cursor"] is None
+
+        # Same images as the page-number API
+        response = client.get(url, query_string={"limit": 2, "page": 2})
+        assert response.json["images"] == second_page["images"]
+
+    def test_get_descending_with_cursor(self, client, dataset):
+        url = f"/api/dataset/{dataset.id}/data"
+        query = {"limit": 1, "order": "-file_name"}
+
+        file_names = []
+        cursor = None
+        for _ in range(3):
+            response = client.get(url, query_string={**query, "cursor": cursor or ""})
+            file_names += [image["file_name"] for image in response.json["images"]]
+            cursor = response.json["next_cursor"]
+
+        assert file_names == ["image2.jpg", "image1.jpg", "image0.jpg"]
+        assert cursor is None
+
+    def test_get_invalid_cursor(self, client, dataset):
+        url = f"/api/dataset/{dataset.id}/data"
+        response = client.get(url, query_string={"limit": 2})
+
+        # Cursors are only valid for the order they were created with
+        response = client.get(
+            url,
+            query_string={"cursor": response.json["next_cursor"], "order": "id"},
+        )
+        assert response.status_code == 400
+
+        response = client.get(url, query_string={"cursor": "not a cursor"})
+        assert response.status_code == 400
+
+    def test_get_indexed_folders(self, client, dataset):
+        ImageModel.objects(dataset_id=dataset.id, file_name="image2.jpg").update(
+            path=f"{dataset.directory}a/image2.jpg"
+        )
+        index_folders(dataset, {"", "a/", "b/"})
+        url = f"/api/dataset/{dataset.id}/data"
+
+        # Folders come from the index, none of them exist on disk
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.json["subdirectories"] == ["a", "b"]
+        assert response.json["subdirectory_counts"] == {"a": 1, "b": 0}
+        assert response.json["total"] == 3
+
+        response = client.get(url, query_string={"folder": "a"})
+        assert [image["file_name"] for image in response.json["images"]] == [
+            "image2.jpg"
+        ]
+        assert response.json["total"] == 1
+
+        response = client.get(url, query_string={"folder": "missing"})
+        assert response.status_code == 400
+
+        FolderModel.objects.delete()
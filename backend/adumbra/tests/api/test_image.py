@@ -1,4 +1,17 @@
+# Redefining the name is by definition how fixtures work
+# pylint: disable=redefined-outer-name
+import io
 import json
+import os
+
+import pytest
+from PIL import Image
+
+from adumbra.config import CONFIG
+from adumbra.database import DatasetModel, ImageModel
+from adumbra.services.thumbnail import get_variant_path, save_variants
+from adumbra.services.tiles import build_tiles, level_size
+from adumbra.webserver.api.images import image_cache, neighbors_cache
 
 
 class TestImage:
@@ -14,8 +27,29 @@ class TestImage:
         response = client.post("/api/image/")
         assert response.status_code == 400
 
-    def test_post_images(self, client):
-        pass
+    def test_post_images(self, client, tmp_path, monkeypatch):
+        monkeypatch.setattr(CONFIG, "dataset_directory", str(tmp_path))
+        dataset = DatasetModel(name="upload-test")
+        dataset.save()
+
+        upload = io.BytesIO()
+        Image.new("RGB", (20, 10), "red").save(upload, format="PNG")
+        upload.seek(0)
+        response = client.post(
+            "/api/image/",
+            data={"dataset_id": dataset.id, "image": (upload, "image.png")},
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 200
+
+        image = ImageModel.objects.get(dataset_id=dataset.id)
+        assert (image.width, image.height) == (20, 10)
+        # Uploads invalidate the cached statistics of the dataset
+        dataset.reload()
+        assert dataset.last_modified is not None
+
+        ImageModel.objects.delete()
+        DatasetModel.objects.delete()
 
     def test_post_images_invalid(self, client):
         pass
@@ -35,3 +69,172 @@ class TestImageCoco:
     def test_get_invalid_id(self, client):
         response = client.get("/api/image/1000/coco")
         assert response.status_code == 400
+
+
+@pytest.fixture
+def images(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG, "dataset_directory", str(tmp_path))
+    neighbors_cache.clear()
+
+    dataset = DatasetModel(name="neighbors-test")
+    dataset.save()
+
+    images = []
+    for i in range(6):
+        image = ImageModel(
+            dataset_id=dataset.id,
+            path=f"{dataset.directory}image{i}.jpg",
+            file_name=f"image{i}.jpg",
+            width=10,
+            height=10,
+            annotated=i % 2 == 0,
+        )
+        image.save()
+        images.append(image)
+
+    yield images
+
+    ImageModel.objects.delete()
+    DatasetModel.objects.delete()
+
+
+class TestImageNeighbors:
+
+    def test_get_invalid_id(self, client):
+        response = client.get("/api/image/1000/neighbors")
+        assert response.status_code == 400
+
+    def test_get_window(self, client, images):
+        response = client.get(
+            f"/api/image/{images[2].id}/neighbors", query_string={"count": 2}
+        )
+        assert response.status_code == 200
+        assert [image["id"] for image in response.json["previous"]] == [
+            images[1].id,
+            images[0].id,
+        ]
+        assert [image["id"] for image in response.json["next"]] == [
+            images[3].id,
+            images[4].id,
+        ]
+
+    def test_get_filtered_descending(self, client, images):
+        response = client.get(
+            f"/api/image/{images[2].id}/neighbors",
+            query_string={"order": "-file_name", "annotated": "true"},
+        )
+        assert [image["id"] for image in response.json["previous"]] == [images[4].id]
+        assert [image["id"] for image in response.json["next"]] == [images[0].id]
+
+    def test_get_invalid_order(self, client, images):
+        response = client.get(
+            f"/api/image/{images[0].id}/neighbors", query_string={"order": "unknown"}
+        )
+        assert response.status_code == 400
+
+
+@pytest.fixture
+def image_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG, "dataset_directory", str(tmp_path))
+
+    dataset = DatasetModel(name="variants-test")
+    dataset.save()
+
+    path = f"{dataset.directory}image.png"
+    os.makedirs(dataset.directory, exist_ok=True)
+    Image.new("RGB", (600, 300), "red").save(path)
+
+    image = ImageModel(
+        dataset_id=dataset.id,
+        path=path,
+        file_name="image.png",
+        width=600,
+        height=300,
+    )
+    image.save()
+
+    yield image
+
+    ImageModel.objects.delete()
+    DatasetModel.objects.delete()
+
+
+class TestImageFile:
+
+    def test_get_original(self, client, image_file):
+        response = client.get(f"/api/image/{image_file.id}")
+        assert response.status_code == 200
+        assert response.mimetype == "image/png"
+        assert response.cache_control.max_age == CONFIG.image_cache_max_age
+
+    def test_get_variant(self, client, image_file):
+        save_variants(image_file.path)
+        variant_path = get_variant_path(image_file.path, 256)
+        with Image.open(variant_path) as variant:
+            assert variant.size == (256, 128)
+
+        # Requests fitting in a pre-generated size are answered with it
+        response = client.get(f"/api/image/{image_file.id}?width=250")
+        assert response.status_code == 200
+        with open(variant_path, "rb") as variant_file:
+            assert response.get_data() == variant_file.read()
+
+        response = client.get(
+            f"/api/image/{image_file.id}?width=250",
+            headers={"If-None-Match": response.headers["ETag"]},
+        )
+        assert response.status_code == 304
+
+    def test_get_custom_size(self, client, image_file, tmp_path, monkeypatch):
+        monkeypatch.setattr(image_cache, "directory", str(tmp_path / "cache"))
+        url = f"/api/image/{image_file.id}?width=100&height=20"
+
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.mimetype == "image/jpeg"
+        with Image.open(io.BytesIO(response.get_data())) as resized:
+            assert resized.size == (40, 20)
+
+        hits = image_cache.stats.hits
+        assert client.get(url).get_data() == response.get_data()
+        assert image_cache.stats.hits == hits + 1
+
+    def test_get_segmented(self, client, image_file):
+        response = client.get(f"/api/image/segmented/{image_file.id}")
+        assert response.status_code == 200
+        with Image.open(io.BytesIO(response.get_data())) as segmented:
+            assert segmented.size == (600, 300)
+
+
+class TestImageTiles:
+
+    def test_untiled(self, client, image_file):
+        response = client.get(f"/api/image/{image_file.id}/tiles")
+        assert response.status_code == 200
+        assert response.json == {"tiled": False}
+
+    def test_get_tiles(self, client, image_file):
+        build_tiles(image_file.path)
+
+        info = client.get(f"/api/image/{image_file.id}/tiles").json
+        assert info["tiled"]
+        assert info["levels"] == 11
+        assert level_size(600, 300, info["levels"] - 2) == (300, 150)
+
+        # The full resolution level has 3 x 2 tiles, the last ones cropped
+        url = info["url"].format(z=10, x=2, y=1)
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.cache_control.max_age == CONFIG.image_cache_max_age
+        with Image.open(io.BytesIO(response.get_data())) as tile:
+            assert tile.size == (600 - 512, 300 - 256)
+
+        response = client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+        assert response.status_code == 304
+
+        response = client.get(info["url"].format(z=10, x=3, y=0))
+        assert response.status_code == 404
+
+        response = client.get(info["url"].format(z=0, x=0, y=0))
+        with Image.open(io.BytesIO(response.get_data())) as tile:
+            assert tile.size == (1, 1)
@@ -0,0 +1,94 @@
+import gc
+
+import pytest
+
+from adumbra.config import CONFIG
+from adumbra.database import TaskLogModel, TaskModel
+from adumbra.database.tasks import flush_task_logs
+
+
+@pytest.fixture
+def task():
+    task = TaskModel(name="tasks-test", group="test")
+    task.save()
+
+    yield task
+
+    TaskLogModel.objects.delete()
+    TaskModel.objects.delete()
+
+
+class TestTaskLogs:
+
+    def test_logs_are_buffered(self, task, monkeypatch):
+        monkeypatch.setattr(CONFIG.tasks, "log_batch_size", 10)
+        monkeypatch.setattr(CONFIG.tasks, "log_flush_interval", 60)
+
+        for i in range(15):
+            task.info(f"line {i}")
+        assert TaskLogModel.objects(task_id=task.id).count() == 10
+
+        task.warning("warning")
+        task.error("error")
+        assert TaskLogModel.objects(task_id=task.id).count() == 17
+        task.reload()
+        assert (task.num_logs, task.warnings, task.errors) == (17, 1, 1)
+
+    def test_logs_are_bounded(self, task, monkeypatch):
+        monkeypatch.setattr(CONFIG.tasks, "max_log_lines", 5)
+        for i in range(8):
+            task.info(f"line {i}")
+        task.flush()
+
+        assert TaskLogModel.objects(task_id=task.id).count() == 5
+        assert task.reload().num_logs == 8
+
+    def test_dropped_documents_are_flushed(self, task, monkeypatch):
+        monkeypatch.setattr(CONFIG.tasks, "log_flush_interval", 60)
+
+        # e.g. a task document rebound to the result of `modify`
+        document = TaskModel.objects.get(id=task.id)
+        for i in range(3):
+            document.info(f"line {i}")
+        del document
+        gc.collect()
+
+        flush_task_logs()
+        assert TaskLogModel.objects(task_id=task.id).count() == 3
+        assert task.reload().num_logs == 3
+
+    def test_progress_is_throttled(self, task, monkeypatch):
+        monkeypatch.setattr(CONFIG.tasks, "progress_interval", 0)
+        task.set_progress(10)
+        task.set_progress(10.5)
+        assert task.reload().progress == 10
+
+        task.set_progress(11)
+        assert task.reload().progress == 11
+        task.set_progress(100)
+        assert task.reload().completed
+
+    def test_get_logs(self, client, task):
+        for i in range(5):
+            task.info(f"line {i}")
+        task.warning("warning")
+        task.flush()
+        url = f"/api/tasks/{task.id}/logs"
+
+        response = client.get(url, query_string={"limit": 2, "page": 2})
+        assert response.status_code == 200
+        assert [line.rsplit("] ", 1)[1] for line in response.json["logs"]] == [
+            "line 2",
+            "line 3",
+        ]
+        assert response.json["total"] == 6
+        assert response.json["pages"] == 3
+
+        response = client.get(url, query_string={"level": "WARNING"})
+        assert len(response.json["logs"]) == 1
+        assert "[WARNING] warning" in response.json["logs"][0]
+
+        assert client.delete(f"/api/tasks/{task.id}").status_code == 400
+        task.update(completed=True)
+        assert client.delete(f"/api/tasks/{task.id}").status_code == 200
+        assert TaskLogModel.objects(task_id=task.id).count() == 0
@@ -1,12 +1,21 @@
 # Redefining the name is by definition how fixtures work
 # pylint: disable=redefined-outer-name
 import json
+import os
 
 import pytest
 
 # This must be imported before the database models
 from adumbra.webserver import app  # isort:skip
 
+from adumbra.config import CONFIG  # isort:skip
+from adumbra.database import (  # isort:skip
+    AnnotationModel,
+    CategoryModel,
+    DatasetModel,
+    FolderModel,
+    ImageModel,
+)
 from adumbra.database.users import UserModel  # isort:skip
 
 
@@ -24,3 +33,41 @@ def register_user(client):
     yield json.loads(response.data)
     UserModel.objects.delete()
     print("END")
+
+
+@pytest.fixture
+def create_dataset(tmp_path, monkeypatch):
+    """
+    Factory of datasets with an image document for each of `paths`, relative to the
+    dataset directory, which is the test's temporary directory. Datasets, categories,
+    images, annotations and folders are deleted after the test.
+    """
+    monkeypatch.setattr(CONFIG, "dataset_directory", str(tmp_path))
+
+    def create(name, paths=(), categories=(), **image_fields):
+        dataset = DatasetModel(name=name, categories=list(categories))
+        dataset.save()
+
+        images = []
+        for path in paths:
+            image = ImageModel(
+                dataset_id=dataset.id,
+                path=f"{dataset.directory}{path}",
+                file_name=os.path.basename(path),
+                **{"width": 10, "height": 10, **image_fields},
+            )
+            image.save()
+            images.append(image)
+
+        return dataset, images
+
+    yield create
+
+    for model in (
+        AnnotationModel,
+        ImageModel,
+        FolderModel,
+        CategoryModel,
+        DatasetModel,
+    ):
+        model.objects.delete()
@@ -0,0 +1,76 @@
+# Redefining the name is by definition how fixtures work
+# pylint: disable=redefined-outer-name
+import pytest
+
+from adumbra.database import AnnotationModel, CategoryModel, ImageModel
+from adumbra.database.counters import (
+    add_dataset_images,
+    inc_category_counters,
+    inc_dataset_counters,
+    refresh_category_counters,
+    refresh_dataset_counters,
+    remove_dataset_image,
+)
+
+
+@pytest.fixture
+def dataset(create_dataset):
+    category = CategoryModel(name="counters-test")
+    category.save()
+    dataset, images = create_dataset(
+        "counters-test",
+        [f"image{i}.jpg" for i in range(3)],
+        categories=[category.id],
+        annotated=True,
+    )
+    images[0].update(annotated=False)
+
+    for image in images:
+        AnnotationModel(
+            image_id=image.id, category_id=category.id, creator="user1"
+        ).save()
+
+    return dataset
+
+
+class TestCounters:
+
+    def test_refresh(self, dataset):
+        refresh_dataset_counters([dataset.id])
+        refresh_category_counters(dataset.categories)
+        dataset.reload()
+
+        first = ImageModel.objects(dataset_id=dataset.id).order_by("id").first()
+        assert dataset.num_images == 3
+        assert dataset.num_annotated == 2
+        assert dataset.first_image_id == first.id
+        assert CategoryModel.objects.get(id=dataset.categories[0]).num_annotations == 3
+
+    def test_increments_skip_uncomputed_counters(self, dataset):
+        inc_dataset_counters(dataset.id, images=1)
+        inc_category_counters({dataset.categories[0]: 1})
+
+        dataset.reload()
+        assert dataset.num_images is None
+        assert (
+            CategoryModel.objects.get(id=dataset.categories[0]).num_annotations is None
+        )
+
+    def test_increments(self, dataset):
+        refresh_dataset_counters([dataset.id])
+        refresh_category_counters(dataset.categories)
+        first = ImageModel.objects(dataset_id=dataset.id).order_by("id").first()
+
+        ImageModel.objects(id=first.id).update(deleted=True)
+        remove_dataset_image(first)
+        dataset.reload()
+        assert dataset.num_images == 2
+        assert dataset.first_image_id == first.id + 1
+
+        add_dataset_images(dataset.id, [first.id], annotated=1)
+        inc_category_counters({dataset.categories[0]: -1})
+        dataset.reload()
+        assert dataset.num_images == 3
+        assert dataset.num_annotated == 3
+        assert dataset.first_image_id == first.id
+        assert CategoryModel.objects.get(id=dataset.categories[0]).num_annotations == 2
@@ -0,0 +1,70 @@
+# Redefining the name is by definition how fixtures work
+# pylint: disable=redefined-outer-name
+import pytest
+
+from adumbra.database import FolderModel, ImageModel
+from adumbra.database.counters import remove_dataset_image
+from adumbra.database.folders import folder_ancestors, folder_of, image_folders
+from adumbra.workers.tasks.scan import index_folders
+
+
+@pytest.fixture
+def dataset(create_dataset):
+    dataset, _ = create_dataset(
+        "folders-test", ["image.jpg", "a/image.jpg", "a/b/image.jpg", "c/image.jpg"]
+    )
+    return dataset
+
+
+def test_folder_paths():
+    assert folder_of("/datasets/test/", "/datasets/test/image.jpg") == ""
+    assert folder_of("/datasets/test/", "/datasets/test/a/b/image.jpg") == "a/b/"
+    assert folder_ancestors("") == [""]
+    assert folder_ancestors("a/b/") == ["", "a/", "a/b/"]
+    assert image_folders("/datasets/test", "/datasets/test/a/image.jpg") == ["", "a/"]
+
+
+class TestFolderIndex:
+
+    def test_index_folders(self, dataset):
+        assert not FolderModel.is_indexed(dataset.id)
+
+        FolderModel.add(dataset.id, ["stale/"])
+        index_folders(dataset, {"", "a/", "a/b/", "c/"})
+
+        assert FolderModel.is_indexed(dataset.id)
+        counts = {
+            folder.path: folder.num_images
+            for folder in FolderModel.objects(dataset_id=dataset.id)
+        }
+        assert counts == {"": 4, "a/": 2, "a/b/": 1, "c/": 1}
+
+        image = ImageModel.objects(path=f"{dataset.directory}a/b/image.jpg").first()
+        assert image.folders == ["", "a/", "a/b/"]
+        assert FolderModel.objects(dataset_id=dataset.id, parent="a/").first().name == (
+            "b"
+        )
+
+    def test_count_image(self, dataset):
+        index_folders(dataset, {"", "a/", "a/b/", "c/"})
+
+        image = ImageModel.objects(path=f"{dataset.directory}a/b/image.jpg").first()
+        image.update(deleted=True)
+        remove_dataset_image(image)
+
+        image = ImageModel(
+            dataset_id=dataset.id,
+            path=f"{dataset.directory}d/image.jpg",
+            file_name="image.jpg",
+            width=10,
+            height=10,
+            folders=["", "d/"],
+        )
+        image.save()
+        FolderModel.count_image(image)
+
+        counts = {
+            folder.path: folder.num_images
+            for folder in FolderModel.objects(dataset_id=dataset.id)
+        }
+        assert counts == {"": 4, "a/": 1, "a/b/": 0, "c/": 1, "d/": 1}
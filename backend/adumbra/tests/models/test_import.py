@@ -0,0 +1,97 @@
+# Redefining the name is by definition how fixtures work
+# pylint: disable=redefined-outer-name
+import json
+
+import pytest
+
+from adumbra.database import (
+    AnnotationModel,
+    CategoryModel,
+    ImageModel,
+    TaskLogModel,
+    TaskModel,
+)
+from adumbra.workers.tasks import data
+
+SQUARE = [[1, 1, 5, 1, 5, 5, 1, 5]]
+TRIANGLE = [[1, 1, 5, 1, 1, 5]]
+
+COCO = {
+    "categories": [{"id": 7, "name": "import-test-cat"}],
+    "images": [
+        {"id": 1, "file_name": "image0.jpg"},
+        {"id": 2, "file_name": "image1.jpg"},
+        {"id": 3, "file_name": "missing.jpg"},
+    ],
+    "annotations": [
+        {"id": 1, "image_id": 1, "category_id": 7, "segmentation": SQUARE, "area": 16},
+        {"id": 2, "image_id": 1, "category_id": 7, "segmentation": TRIANGLE, "area": 8},
+        # Same geometry as the first one, with integers as floats
+        {
+            "id": 3,
+            "image_id": 1,
+            "category_id": 7,
+            "segmentation": [[float(value) for value in SQUARE[0]]],
+            "area": 16,
+        },
+        {"id": 4, "image_id": 3, "category_id": 7, "segmentation": SQUARE, "area": 16},
+    ],
+}
+
+
+@pytest.fixture
+def dataset(create_dataset, monkeypatch):
+    monkeypatch.setattr(data, "create_socket", lambda: None)
+
+    dataset, _ = create_dataset("import-test", ["image0.jpg", "image1.jpg"])
+    yield dataset
+
+    TaskLogModel.objects.delete()
+    TaskModel.objects.delete()
+
+
+def run_import(dataset, tmp_path, bulk):
+    coco_path = tmp_path / "coco.json"
+    coco_path.write_text(json.dumps(COCO))
+
+    task = TaskModel(name="import-test", group="Annotation Import")
+    task.save()
+    data.import_annotations(task.id, dataset.id, str(coco_path), bulk)
+
+    assert not coco_path.exists()
+    return task.reload()
+
+
+class TestImport:
+
+    @pytest.mark.parametrize("bulk", [True, False])
+    def test_import_is_idempotent(self, dataset, tmp_path, bulk):
+        for _ in range(2):
+            task = run_import(dataset, tmp_path, bulk)
+            assert task.completed
+
+            category = CategoryModel.objects.get(name="import-test-cat")
+            assert category.id in dataset.reload().categories
+
+            annotations = AnnotationModel.objects(dataset_id=dataset.id)
+            assert annotations.count() == 2
+            assert set(annotations.scalar("category_id")) == {category.id}
+
+            images = {image.file_name: image for image in ImageModel.objects}
+            assert images["image0.jpg"].num_annotations == 2
+            assert images["image0.jpg"].annotated
+            assert images["image0.jpg"].category_ids == [category.id]
+            assert images["image1.jpg"].num_annotations == 0
+            assert not images["image1.jpg"].annotated
+
+        assert CategoryModel.objects(name="import-test-cat").count() == 1
+
+    def test_annotation_key_compares_stored_geometry(self):
+        # pylint: disable-next=protected-access
+        annotation_key = data._annotation_key
+        key = annotation_key(1, 2, SQUARE, [])
+
+        # Numbers are equal across types, as in MongoDB queries, other values are not
+        assert key == annotation_key(1, 2, [[1.0, 1, 5, 1, 5, 5, 1, 5.0]], [])
+        assert key != annotation_key(1, 2, [["1", 1, 5, 1, 5, 5, 1, 5]], [])
+        assert key != annotation_key(1, 2, [[True, 1, 5, 1, 5, 5, 1, 5]], [])
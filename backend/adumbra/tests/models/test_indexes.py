@@ -0,0 +1,90 @@
+import pytest
+from mongoengine import Q
+
+from adumbra.database import (
+    AnnotationModel,
+    CategoryModel,
+    DatasetModel,
+    ExportModel,
+    ImageModel,
+)
+from adumbra.database.indexes import MODELS, check_indexes, ensure_indexes
+
+# Queries issued by the main endpoints; each one must be answered from an index
+QUERIES = {
+    "annotator annotations": lambda: AnnotationModel.objects(image_id=1, deleted=False),
+    "dataset annotations": lambda: AnnotationModel.objects(
+        dataset_id=1, category_id=1, deleted=False
+    ),
+    "category annotations": lambda: AnnotationModel.objects(
+        category_id=1, deleted=False
+    ),
+    "annotation undo list": lambda: AnnotationModel.objects(deleted=True).order_by(
+        "-deleted_date"
+    ),
+    "dataset browser": lambda: ImageModel.objects(
+        dataset_id=1, deleted=False, path__startswith="/datasets/a/"
+    ).order_by("file_name"),
+    "scan": lambda: ImageModel.objects(dataset_id=1, path__startswith="/datasets/a/"),
+    "image by path": lambda: ImageModel.objects(path="/datasets/a/image.jpg"),
+    "image undo list": lambda: ImageModel.objects(deleted=True).order_by(
+        "-deleted_date"
+    ),
+    "user categories": lambda: CategoryModel.objects(
+        Q(id__in=[1, 2]) | Q(creator="user1")
+    ),
+    "user datasets": lambda: DatasetModel.objects(
+        Q(owner="user1") | Q(users__contains="user1")
+    ),
+    "dataset exports": lambda: ExportModel.objects(dataset_id=1).order_by(
+        "-created_at"
+    ),
+}
+
+
+def plan_stages(plan):
+    """Yields the stage names of an explain plan tree"""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+class TestIndexes:
+
+    def test_declared_indexes_exist(self):
+        ensure_indexes()
+        ensure_indexes()
+
+        assert not any(difference["missing"] for difference in check_indexes().values())
+
+    def test_indexes_are_built_in_the_background(self, monkeypatch):
+        # pylint: disable-next=protected-access
+        collection_class = type(ImageModel._get_collection())
+        create_index = collection_class.create_index  # pylint: disable=no-member
+        options = []
+
+        def recording_create_index(self, keys, **kwargs):
+            options.append(kwargs)
+            return create_index(self, keys, **kwargs)
+
+        monkeypatch.setattr(collection_class, "create_index", recording_create_index)
+        for model in MODELS:
+            model.drop_collection()
+        ensure_indexes()
+
+        assert options
+        assert all(kwargs.get("background") for kwargs in options)
+
+    @pytest.mark.parametrize("query", QUERIES.values(), ids=QUERIES.keys())
+    def test_query_uses_index(self, query):
+        ensure_indexes()
+
+        winning_plan = query().explain()["queryPlanner"]["winningPlan"]
+        stages = set(plan_stages(winning_plan))
+
+        assert "COLLSCAN" not in stages
@@ -0,0 +1,31 @@
+from adumbra.database import CategoryModel, insert_many, reserve_ids
+
+
+class TestInsertMany:
+
+    def test_reserve_ids_is_consecutive(self):
+        first = reserve_ids(CategoryModel, 3)
+        second = reserve_ids(CategoryModel, 2)
+
+        assert len(first) == 3
+        assert list(second) == [first[-1] + 1, first[-1] + 2]
+
+    def test_insert_categories(self):
+        categories = [CategoryModel(name=f"Bulk Category {i}") for i in range(3)]
+
+        ids = insert_many(CategoryModel, categories)
+
+        assert len(set(ids)) == 3
+        assert [category.id for category in categories] == ids
+        found = CategoryModel.objects(id__in=ids).order_by("id")
+        assert [category.name for category in found] == [
+            f"Bulk Category {i}" for i in range(3)
+        ]
+
+        # Sequence continues after the reserved block
+        next_category = CategoryModel(name="After Bulk")
+        next_category.save()
+        assert next_category.id > max(ids)
+
+    def test_insert_nothing(self):
+        assert insert_many(CategoryModel, []) == []
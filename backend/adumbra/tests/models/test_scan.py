@@ -0,0 +1,134 @@
+import os
+import shutil
+
+import pytest
+from PIL import Image
+
+from adumbra.config import CONFIG
+from adumbra.database import (
+    DatasetModel,
+    FolderModel,
+    ImageModel,
+    TaskLogModel,
+    TaskModel,
+)
+from adumbra.workers import celery
+from adumbra.workers.tasks import scan
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG, "dataset_directory", str(tmp_path))
+    monkeypatch.setattr(scan, "create_socket", lambda: None)
+    monkeypatch.setattr(scan, "queue_thumbnails", lambda image_ids: None)
+
+    dataset = DatasetModel(name="scan-test")
+    dataset.save()
+
+    for folder in ("", "a/", "a/b/", ".thumbnail/"):
+        (tmp_path / "scan-test" / folder).mkdir(parents=True, exist_ok=True)
+        for i in range(2):
+            path = tmp_path / "scan-test" / folder / f"image{i}.jpg"
+            Image.new("RGB", (30, 20)).save(path)
+    (tmp_path / "scan-test" / "broken.png").write_bytes(b"not an image")
+
+    yield dataset
+
+    for model in (FolderModel, ImageModel, TaskLogModel, TaskModel, DatasetModel):
+        model.objects.delete()
+
+
+def run_scan(dataset, full=False):
+    task = TaskModel(name="scan-test", group="Directory Image Scan")
+    task.save()
+    scan.scan_dataset(task.id, dataset.id, full)
+    return task.reload()
+
+
+def task_logs(task):
+    return TaskLogModel.objects(task_id=task.id).scalar("message")
+
+
+class TestScan:
+
+    def test_scan_is_incremental(self, dataset, monkeypatch):
+        monkeypatch.setattr(CONFIG.scan, "batch_size", 4)
+        task = run_scan(dataset)
+
+        images = ImageModel.objects(dataset_id=dataset.id)
+        assert images.count() == 6
+        assert {(image.width, image.height) for image in images} == {(30, 20)}
+        assert set(FolderModel.objects(dataset_id=dataset.id).scalar("path")) == {
+            "",
+            "a/",
+            "a/b/",
+        }
+        assert task.progress == 100
+        assert any("broken.png" in log for log in task_logs(task))
+
+        # Known paths are not opened again
+        opened = []
+        monkeypatch.setattr(
+            scan, "read_image", lambda path, dataset: opened.append(path)
+        )
+        run_scan(dataset)
+        assert opened == [f"{dataset.directory}broken.png"]
+        assert ImageModel.objects(dataset_id=dataset.id).count() == 6
+
+    def test_only_changed_folders_are_listed(self, dataset, monkeypatch):
+        # Snapshots are only recorded for folders not modified during the scan
+        monkeypatch.setattr(scan, "RACY_WINDOW", -1)
+        run_scan(dataset)
+        directory = dataset.directory
+
+        shutil.rmtree(f"{directory}a/b")
+        os.remove(f"{directory}a/image1.jpg")
+        Image.new("RGB", (60, 40)).save(f"{directory}a/image0.jpg")
+        Image.new("RGB", (60, 40)).save(f"{directory}image0.jpg")
+
+        task = run_scan(dataset)
+        assert any("Listed 1 of 2 folder(s)" in log for log in task_logs(task))
+
+        images = {
+            image.path: image for image in ImageModel.objects(dataset_id=dataset.id)
+        }
+        assert images[f"{directory}a/image0.jpg"].width == 60
+        assert images[f"{directory}a/image0.jpg"].regenerate_thumbnail
+        assert images[f"{directory}a/image1.jpg"].deleted
+        assert images[f"{directory}a/b/image0.jpg"].deleted
+        assert not images[f"{directory}image1.jpg"].deleted
+        assert set(FolderModel.objects(dataset_id=dataset.id).scalar("path")) == {
+            "",
+            "a/",
+        }
+        assert FolderModel.objects.get(dataset_id=dataset.id, path="").num_images == 3
+
+        # Files modified in place leave their folder unchanged, a full scan finds them
+        assert images[f"{directory}image0.jpg"].width == 30
+        run_scan(dataset, full=True)
+        assert ImageModel.objects.get(path=f"{directory}image0.jpg").width == 60
+
+    def test_scan_is_sharded(self, dataset, monkeypatch):
+        monkeypatch.setattr(CONFIG.scan, "shards", 2)
+        monkeypatch.setattr(celery.conf, "task_always_eager", True)
+        for folder in ("c", "d", "e"):
+            os.mkdir(f"{dataset.directory}{folder}")
+            Image.new("RGB", (30, 20)).save(f"{dataset.directory}{folder}/image.jpg")
+
+        task = run_scan(dataset)
+        assert task.metadata == {"shards": 2, "shards_done": 2}
+        assert task.progress == 100
+        assert ImageModel.objects(dataset_id=dataset.id).count() == 9
+        assert FolderModel.objects.get(dataset_id=dataset.id, path="").num_images == 9
+        assert FolderModel.objects(dataset_id=dataset.id).count() == 6
+
+    def test_existing_paths_are_skipped(self, dataset):
+        images = [
+            ImageModel.create_from_path(f"{dataset.directory}image{i}.jpg", dataset.id)
+            for i in range(2)
+        ]
+        images[0].save()
+
+        inserted = scan.insert_images(images)
+        assert inserted == [images[1].id]
+        assert ImageModel.objects(dataset_id=dataset.id).count() == 2
@@ -0,0 +1,95 @@
+# Redefining the name is by definition how fixtures work
+# pylint: disable=redefined-outer-name
+import os
+
+import pytest
+from PIL import Image
+
+from adumbra.database import ImageModel
+from adumbra.services.thumbnail import get_thumbnail_path
+from adumbra.workers.tasks import thumbnails
+
+
+@pytest.fixture
+def images(create_dataset):
+    _, images = create_dataset(
+        "thumbnails-test",
+        [f"image{i}.png" for i in range(3)],
+        width=40,
+        height=20,
+        regenerate_thumbnail=True,
+    )
+    for image in images:
+        Image.new("RGB", (40, 20), "red").save(image.path)
+    return images
+
+
+@pytest.fixture
+def queued(monkeypatch):
+    batches = []
+    monkeypatch.setattr(
+        thumbnails.thumbnail_generate_images,
+        "apply_async",
+        lambda args, countdown: batches.append((args[0], countdown)),
+    )
+    return batches
+
+
+class TestThumbnails:
+
+    def test_requests_are_coalesced(self, images, queued, monkeypatch):
+        monkeypatch.setattr(thumbnails.CONFIG.thumbnails, "batch_size", 2)
+        ids = [image.id for image in images]
+
+        thumbnails.queue_thumbnails(ids + ids[:1], countdown=5)
+        thumbnails.queue_thumbnails(ids[:1], countdown=5)
+        assert queued == [(ids[:2], 5), (ids[2:], 5)]
+
+        # Once a batch ran, its images can be queued again
+        thumbnails.regenerate_thumbnails(ids[:2])
+        thumbnails.queue_thumbnails(ids[:1])
+        assert queued[-1] == (ids[:1], 0)
+
+    def test_regenerate(self, images):
+        ids = [image.id for image in images]
+        images[2].update(regenerate_thumbnail=False)
+
+        assert thumbnails.regenerate_thumbnails(ids + ids) == ids[:2]
+        assert os.path.exists(get_thumbnail_path(images[0].path))
+        assert not os.path.exists(get_thumbnail_path(images[2].path))
+        assert ImageModel.objects(regenerate_thumbnail=True).count() == 0
+
+    def test_failed_render_is_retried(self, images, queued, monkeypatch):
+        monkeypatch.setattr(thumbnails.CONFIG.thumbnails, "max_attempts", 2)
+        monkeypatch.setattr(thumbnails.CONFIG.thumbnails, "retry_after", 60)
+        os.remove(images[0].path)
+
+        assert not thumbnails.regenerate_thumbnails([images[0].id])
+        assert queued == [([images[0].id], 60)]
+
+        # After `max_attempts` failures in a row, it waits to be requested again
+        assert not thumbnails.regenerate_thumbnails([images[0].id])
+        assert len(queued) == 1
+        image = ImageModel.objects.get(id=images[0].id)
+        assert image.regenerate_thumbnail
+        assert image.thumbnail_attempts == 2
+
+        Image.new("RGB", (40, 20), "red").save(images[0].path)
+        assert thumbnails.regenerate_thumbnails([images[0].id]) == [images[0].id]
+        assert ImageModel.objects.get(id=images[0].id).thumbnail_attempts == 0
+
+    @pytest.mark.usefixtures("queued")
+    def test_tiles_are_queued_without_a_thumbnail(self, images, monkeypatch):
+        tiled = []
+        monkeypatch.setattr(thumbnails.CONFIG, "tile_min_size", 40)
+        monkeypatch.setattr(
+            thumbnails.tiles_generate_single_image, "delay", tiled.append
+        )
+
+        def fail(*_):
+            raise OSError("cannot render")
+
+        monkeypatch.setattr(thumbnails, "_render", fail)
+
+        assert not thumbnails.regenerate_thumbnails([images[0].id])
+        assert tiled == [images[0].id]
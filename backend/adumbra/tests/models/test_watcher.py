@@ -0,0 +1,193 @@
+# Redefining the name is by definition how fixtures work
+# pylint: disable=redefined-outer-name
+import os
+
+import pytest
+from PIL import Image
+from watchdog.events import (
+    DirDeletedEvent,
+    DirMovedEvent,
+    FileCreatedEvent,
+    FileDeletedEvent,
+    FileModifiedEvent,
+    FileMovedEvent,
+)
+
+from adumbra import watcher
+from adumbra.config import CONFIG
+from adumbra.database import DatasetModel, FolderModel, ImageModel
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG, "dataset_directory", str(tmp_path))
+    monkeypatch.setattr(watcher, "queue_thumbnails", lambda image_ids: None)
+
+    dataset = DatasetModel(name="watcher-test")
+    dataset.save()
+
+    yield dataset
+
+    ImageModel.objects.delete()
+    FolderModel.objects.delete()
+    DatasetModel.objects.delete()
+
+
+class TestWatcher:
+
+    def test_events_are_coalesced(self, dataset):
+        handler = watcher.ImageFolderHandler()
+        path = f"{dataset.directory}image.jpg"
+
+        handler.on_any_event(FileCreatedEvent(path))
+        handler.on_any_event(FileModifiedEvent(path))
+        handler.on_any_event(FileMovedEvent(path, f"{dataset.directory}moved.jpg"))
+        handler.on_any_event(FileCreatedEvent(f"{dataset.directory}.thumbnail/a.jpg"))
+        handler.on_any_event(FileCreatedEvent(f"{dataset.directory}notes.txt"))
+        handler.on_any_event(FileDeletedEvent(f"{dataset.directory}old.jpg"))
+
+        # Events are held back while they keep coming in
+        assert handler.take(debounce=60, max_delay=60, max_size=100) is None
+
+        batch = handler.take(debounce=0, max_delay=60, max_size=100)
+        assert batch.changed == {f"{dataset.directory}moved.jpg"}
+        assert batch.deleted == {f"{dataset.directory}old.jpg"}
+        assert not batch.moved
+        assert handler.take(debounce=0, max_delay=60, max_size=100) is None
+
+    def test_hidden_directories_are_ignored(self, dataset):
+        handler = watcher.ImageFolderHandler()
+        directory = dataset.directory.rstrip("/")
+
+        handler.on_any_event(DirDeletedEvent(f"{directory}/.thumbnail"))
+        handler.on_any_event(DirMovedEvent(f"{directory}/.tiles/a", f"{directory}/.b"))
+        handler.on_any_event(DirMovedEvent(f"{directory}/a/.c", f"{directory}/a/.d"))
+        assert handler.take(debounce=0, max_delay=60, max_size=100) is None
+
+        # Moves into or out of hidden directories are deletions and creations
+        os.makedirs(f"{directory}/shown/.hidden")
+        Image.new("RGB", (30, 20)).save(f"{directory}/shown/image.jpg")
+        Image.new("RGB", (30, 20)).save(f"{directory}/shown/.hidden/image.jpg")
+        handler.on_any_event(DirMovedEvent(f"{directory}/.new", f"{directory}/shown"))
+        handler.on_any_event(DirMovedEvent(f"{directory}/a", f"{directory}/.trash"))
+        handler.on_any_event(DirMovedEvent(f"{directory}/b", f"{directory}/c"))
+
+        batch = handler.take(debounce=0, max_delay=60, max_size=100)
+        assert batch.changed == {f"{directory}/shown/image.jpg"}
+        assert batch.deleted_directories == {f"{directory}/a"}
+        assert batch.moved_directories == {f"{directory}/b": f"{directory}/c"}
+
+    def test_apply_events(self, dataset):
+        paths = [f"{dataset.directory}image{i}.jpg" for i in range(3)]
+        for path in paths:
+            Image.new("RGB", (30, 20)).save(path)
+
+        # Indexed as by a scan
+        FolderModel.add(dataset.id, [""])
+        datasets = watcher.DatasetCache()
+        watcher.apply_events(watcher.EventBatch(changed=set(paths)), datasets)
+        assert ImageModel.objects(dataset_id=dataset.id).count() == 3
+
+        os.makedirs(f"{dataset.directory}a")
+        moved = f"{dataset.directory}a/image0.jpg"
+        os.rename(paths[0], moved)
+        os.remove(paths[1])
+        Image.new("RGB", (60, 40)).save(paths[2])
+
+        batch = watcher.EventBatch()
+        batch.move(paths[0], moved)
+        batch.delete(paths[1])
+        batch.change(paths[2])
+        watcher.apply_events(batch, datasets)
+
+        images = {image.file_name: image for image in ImageModel.objects}
+        assert images["image0.jpg"].path == moved
+        assert images["image0.jpg"].folders == ["", "a/"]
+        assert images["image1.jpg"].deleted
+        assert images["image2.jpg"].width == 60
+        assert ImageModel.objects(dataset_id=dataset.id).count() == 3
+        assert {folder.path: folder.num_images for folder in FolderModel.objects} == {
+            "": 2,
+            "a/": 1,
+        }
+
+    def test_move_directories(self, dataset):
+        os.makedirs(f"{dataset.directory}a/b")
+        paths = [f"{dataset.directory}a/image.jpg", f"{dataset.directory}a/b/image.jpg"]
+        for path in paths:
+            Image.new("RGB", (30, 20)).save(path)
+
+        FolderModel.add(dataset.id, [""])
+        datasets = watcher.DatasetCache()
+        watcher.apply_events(watcher.EventBatch(changed=set(paths)), datasets)
+
+        os.rename(f"{dataset.directory}a", f"{dataset.directory}c")
+        batch = watcher.EventBatch()
+        batch.moved_directories[f"{dataset.directory}a"] = f"{dataset.directory}c"
+        watcher.apply_events(batch, datasets)
+
+        assert sorted(ImageModel.objects.scalar("path")) == [
+            f"{dataset.directory}c/b/image.jpg",
+            f"{dataset.directory}c/image.jpg",
+        ]
+        assert {folder.path: folder.num_images for folder in FolderModel.objects} == {
+            "": 2,
+            "c/": 2,
+            "c/b/": 1,
+        }
+
+        # Out of every dataset, the images are deleted like their files
+        os.rename(f"{dataset.directory}c", f"{CONFIG.dataset_directory}/c")
+        batch = watcher.EventBatch()
+        batch.moved_directories[f"{dataset.directory}c"] = (
+            f"{CONFIG.dataset_directory}/c"
+        )
+        watcher.apply_events(batch, datasets)
+
+        assert all(image.deleted for image in ImageModel.objects)
+        assert ImageModel.objects.count() == 2
+        assert {folder.path: folder.num_images for folder in FolderModel.objects} == {
+            "": 0
+        }
+        assert DatasetModel.objects.get(id=dataset.id).num_images == 0
+
+    def test_delete_directories_of_unindexed_images(self, dataset):
+        # Recorded before folders were indexed, without their `folders`
+        paths = [f"{dataset.directory}a/image.jpg", f"{dataset.directory}ab/image.jpg"]
+        for path in paths:
+            ImageModel(
+                dataset_id=dataset.id,
+                path=path,
+                file_name="image.jpg",
+                width=30,
+                height=20,
+            ).save()
+
+        batch = watcher.EventBatch()
+        batch.deleted_directories.add(f"{dataset.directory}a")
+        watcher.apply_events(batch, watcher.DatasetCache())
+
+        assert ImageModel.objects.get(path=paths[0]).deleted
+        assert not ImageModel.objects.get(path=paths[1]).deleted
+
+    def test_move_onto_recorded_image(self, dataset):
+        paths = [f"{dataset.directory}image{i}.jpg" for i in range(3)]
+        for path in paths:
+            Image.new("RGB", (30, 20)).save(path)
+
+        datasets = watcher.DatasetCache()
+        watcher.apply_events(watcher.EventBatch(changed=set(paths)), datasets)
+
+        moved = f"{dataset.directory}moved.jpg"
+        os.replace(paths[0], paths[1])
+        os.rename(paths[2], moved)
+        batch = watcher.EventBatch()
+        batch.move(paths[0], paths[1])
+        batch.move(paths[2], moved)
+        watcher.apply_events(batch, datasets)
+
+        # The image already at the destination keeps it, the other moves apply
+        assert ImageModel.objects.get(path=paths[0]).deleted
+        assert not ImageModel.objects.get(path=paths[1]).deleted
+        assert not ImageModel.objects.get(path=moved).deleted
+        assert not ImageModel.objects(path=paths[2])
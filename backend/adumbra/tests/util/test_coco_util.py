@@ -0,0 +1,86 @@
+# Redefining the name is by definition how fixtures work
+# pylint: disable=redefined-outer-name
+import json
+
+import pytest
+from mongoengine.context_managers import query_counter
+
+from adumbra.constants import COCO_PROPERTIES
+from adumbra.database import AnnotationModel, CategoryModel, ImageModel
+from adumbra.webserver.util.coco_util import get_image_coco, iter_dataset_coco
+
+SQUARE = [[1, 1, 5, 1, 5, 5, 1, 5]]
+
+
+@pytest.fixture
+def make_image(create_dataset):
+    def make(num_categories, num_annotated_categories=3):
+        categories = [
+            CategoryModel(name=f"coco-util-{num_categories}-{i}")
+            for i in range(num_categories)
+        ]
+        for category in categories:
+            category.save()
+
+        _, (image,) = create_dataset(
+            f"coco-util-{num_categories}",
+            ["image.jpg"],
+            categories=[category.id for category in categories],
+        )
+
+        for category in categories[:num_annotated_categories]:
+            AnnotationModel(
+                image_id=image.id,
+                category_id=category.id,
+                segmentation=SQUARE,
+                area=16,
+                creator="user1",
+            ).save()
+        return image
+
+    return make
+
+
+class TestGetImageCoco:
+
+    def test_only_annotated_categories(self, make_image):
+        image = make_image(num_categories=10)
+
+        coco = get_image_coco(image.id)
+
+        assert [img["id"] for img in coco["images"]] == [image.id]
+        assert len(coco["categories"]) == 3
+        assert len(coco["annotations"]) == 3
+        category_ids = {category["id"] for category in coco["categories"]}
+        assert {a["category_id"] for a in coco["annotations"]} == category_ids
+
+    def test_query_count_is_constant(self, make_image):
+        """Benchmark: queries per call must not grow with the number of categories"""
+        query_counts = []
+        for num_categories in (5, 50, 300):
+            image = make_image(num_categories=num_categories)
+
+            with query_counter() as counter:
+                get_image_coco(image.id)
+                query_counts.append(int(counter))
+
+        assert len(set(query_counts)) == 1, query_counts
+
+
+class TestDatasetCoco:
+
+    def test_only_coco_fields(self, make_image):
+        image = make_image(num_categories=3)
+        ImageModel.objects(id=image.id).update(
+            set__folders=[""], set__file_size=10, set__revision=2
+        )
+
+        coco = json.loads("".join(iter_dataset_coco(image.dataset)))
+
+        assert [set(coco_image) for coco_image in coco["images"]] == [
+            {"id", "width", "height", "file_name", "path", "dataset_id"}
+        ]
+        assert set(COCO_PROPERTIES["image"]) >= set(coco["images"][0])
+        assert len(coco["categories"]) == 3
+        for annotation in coco["annotations"]:
+            assert set(AnnotationModel.COCO_PROPERTIES) >= set(annotation)
@@ -0,0 +1,64 @@
+import math
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from adumbra.services.thumbnail import open_reduced
+
+SIZE = (4000, 3000)
+
+
+@pytest.fixture(scope="module")
+def large_images(tmp_path_factory):
+    """A synthetic set of large images: a JPEG, a flat TIFF and a pyramidal TIFF"""
+    directory = tmp_path_factory.mktemp("large")
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 64, (SIZE[1], SIZE[0], 3), dtype=np.uint8)
+    gradient = np.linspace(0, 191, SIZE[0], dtype=np.uint8)[None, :, None]
+    pil_image = Image.fromarray(noise + gradient)
+
+    paths = {"jpeg": str(directory / "large.jpg"), "tiff": str(directory / "flat.tif")}
+    pil_image.save(paths["jpeg"], quality=90)
+    pil_image.save(paths["tiff"])
+
+    paths["pyramid"] = str(directory / "pyramid.tif")
+    levels = [pil_image.resize((SIZE[0] // 4**i, SIZE[1] // 4**i)) for i in (1, 2)]
+    pil_image.save(paths["pyramid"], save_all=True, append_images=levels)
+
+    return paths
+
+
+def _decode(path, box, reduced):
+    with open_reduced(path, box) if reduced else Image.open(path) as pil_image:
+        pil_image.load()
+        decoded = pil_image.size
+        pil_image.thumbnail(box, Image.Resampling.LANCZOS)
+        return decoded, pil_image.size
+
+
+class TestReducedDecoding:
+
+    @pytest.mark.parametrize(
+        "name,decoded",
+        [("jpeg", (1000, 750)), ("tiff", SIZE), ("pyramid", (1000, 750))],
+    )
+    def test_decodes_smallest_sufficient_resolution(self, large_images, name, decoded):
+        full = _decode(large_images[name], (512, 512), reduced=False)
+        reduced = _decode(large_images[name], (512, 512), reduced=True)
+
+        assert reduced[0] == decoded
+        assert reduced[1] == full[1] == (512, 384)
+
+    def test_decodes_fewer_pixels(self, large_images):
+        pixels = {}
+        for reduced in (False, True):
+            pixels[reduced] = sum(
+                math.prod(_decode(path, (256, 256), reduced)[0])
+                for path in large_images.values()
+            )
+
+        # The JPEG at 1/8 scale and the pyramid from its 1/4 level, the flat TIFF in
+        # full: a deterministic stand-in for timing the decodes
+        assert pixels[False] == 3 * SIZE[0] * SIZE[1]
+        assert pixels[True] == 500 * 375 + 1000 * 750 + SIZE[0] * SIZE[1]
@@ -0,0 +1,70 @@
+# Redefining the name is by definition how fixtures work
+# pylint: disable=redefined-outer-name
+import os
+
+import pytest
+
+from adumbra.config import CONFIG
+from adumbra.services.image_cache import ImageCache
+
+
+def _render(content):
+    def render(path):
+        with open(path, "wb") as file:
+            file.write(content)
+
+    return render
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "image.jpg"
+    path.write_bytes(b"source")
+    return str(path)
+
+
+class TestImageCache:
+
+    def test_hit_and_miss(self, tmp_path, source):
+        cache = ImageCache(str(tmp_path / "cache"), max_size=1024)
+        key = cache.key(source, (100, 100), "JPEG", 80)
+
+        path = cache.get_or_create(key, _render(b"resized"))
+        assert cache.get_or_create(key, _render(b"other")) == path
+        with open(path, "rb") as file:
+            assert file.read() == b"resized"
+        assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+
+        # Other parameters or a modified source are different entries
+        assert cache.key(source, (200, 200), "JPEG", 80) != key
+        os.utime(source, (0, 0))
+        assert cache.key(source, (100, 100), "JPEG", 80) != key
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        cache = ImageCache(str(tmp_path / "cache"), max_size=250)
+
+        paths = []
+        for i in range(2):
+            paths.append(cache.get_or_create(f"{i:064x}", _render(b"x" * 100)))
+            os.utime(paths[-1], (i, i))
+
+        # Reading the oldest entry makes it the most recently used
+        assert cache.get_or_create(f"{0:064x}", _render(b"")) == paths[0]
+        cache.get_or_create(f"{2:064x}", _render(b"x" * 100))
+
+        assert os.path.exists(paths[0])
+        assert not os.path.exists(paths[1])
+        assert cache.stats.evictions == 1
+
+        usage = cache.usage()
+        assert usage["entries"] == 2
+        assert usage["size"] == 200
+
+
+def test_default_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG, "dataset_directory", str(tmp_path))
+    monkeypatch.setattr(CONFIG.image_cache, "directory", None)
+    assert CONFIG.get_image_cache_directory() == str(tmp_path / ".cache" / "images")
+
+    monkeypatch.setattr(CONFIG.image_cache, "directory", "/cache")
+    assert CONFIG.get_image_cache_directory() == "/cache"
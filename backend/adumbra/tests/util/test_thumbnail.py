@@ -0,0 +1,97 @@
+# Redefining the name is by definition how fixtures work
+# pylint: disable=redefined-outer-name
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+from adumbra.services.thumbnail import (
+    create_thumbnail,
+    delete_thumbnail,
+    get_image_file,
+    get_variant_path,
+    save_variants,
+)
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = str(tmp_path / "image.png")
+    Image.new("RGB", (2000, 1000), (255, 0, 0)).save(path)
+    return path
+
+
+def _annotation(category_id, segmentation, bbox, color=None):
+    return SimpleNamespace(
+        category_id=category_id,
+        segmentation=segmentation,
+        bbox=bbox,
+        area=bbox[2] * bbox[3],
+        color=color,
+    )
+
+
+class TestCreateThumbnail:
+
+    def test_draws_scaled_annotations(self, image_path):
+        categories = {1: SimpleNamespace(name="square", color="#00ff00")}
+        annotations = [
+            _annotation(
+                1, [[200, 200, 1000, 200, 1000, 800, 200, 800]], [200, 200, 800, 600]
+            ),
+            # Without a category, the annotation's own color is used
+            _annotation(
+                2, [[1400, 200, 1800, 200, 1800, 600]], [1400, 200, 400, 400], "#0000ff"
+            ),
+            _annotation(1, [], [0, 0, 0, 0]),
+        ]
+
+        pil_image = create_thumbnail(image_path, annotations, categories)
+        assert pil_image.size == (1024, 512)
+
+        # Masks are blended at half opacity, the background is left untouched
+        assert pil_image.getpixel((300, 200)) == pytest.approx((128, 128, 0), abs=2)
+        assert pil_image.getpixel((880, 150)) == pytest.approx((128, 0, 128), abs=2)
+        assert pil_image.getpixel((50, 450)) == (255, 0, 0)
+
+        # Outlines are drawn in full color
+        assert pil_image.getpixel((300, 102)) == pytest.approx((0, 255, 0), abs=2)
+
+    def test_full_size(self, image_path):
+        pil_image = create_thumbnail(image_path, [], {}, box=None)
+        assert pil_image.size == (2000, 1000)
+
+
+class TestVariants:
+
+    def test_save_variants(self, image_path, tmp_path):
+        save_variants(image_path)
+
+        for size in (256, 512, 1024):
+            with Image.open(get_variant_path(image_path, size)) as pil_image:
+                assert max(pil_image.size) == size
+        # Only the variants are left, no temporary files
+        assert len(list((tmp_path / ".variants").iterdir())) == 3
+
+        delete_thumbnail(image_path)
+        assert not list((tmp_path / ".variants").iterdir())
+
+    def test_delete_creates_no_directories(self, image_path, tmp_path):
+        delete_thumbnail(image_path)
+        assert [path.name for path in tmp_path.iterdir()] == ["image.png"]
+
+    def test_single_bound_is_not_downscaled_below(self, tmp_path):
+        path = str(tmp_path / "tall.png")
+        Image.new("RGB", (300, 1200), "red").save(path)
+
+        # The 256 wide request is met by the 1024 copy, 256 x 1024
+        variant_path = get_image_file(path, width=256)
+        assert variant_path == get_variant_path(path, 1024)
+        with Image.open(variant_path) as pil_image:
+            assert pil_image.size == (256, 1024)
+
+        # Larger requests than the copies are resized to the requested width
+        with Image.open(get_image_file(path, width=290)) as pil_image:
+            assert pil_image.size == (290, 1160)
+
+        assert get_image_file(path, height=500) == get_variant_path(path, 512)
@@ -0,0 +1,67 @@
+"""
+A small in-process cache for values that are expensive to compute but may be slightly
+stale, e.g. results of aggregation queries shown in the UI.
+"""
+
+import threading
+import time
+import typing as t
+from collections import OrderedDict
+
+Value_T = t.TypeVar("Value_T")
+
+
+class TTLCache:
+    """
+    A thread-safe mapping whose entries expire `ttl` seconds after they were set. When
+    more than `max_size` entries are stored, the least recently used ones are evicted.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[t.Hashable, tuple[float, t.Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: t.Hashable, default: t.Any = None) -> t.Any:
+        """Return the value stored for `key`, or `default` if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: t.Hashable, value: t.Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_set(self, key: t.Hashable, factory: t.Callable[[], Value_T]) -> Value_T:
+        """
+        Return the cached value for `key`, computing and storing it with `factory` when
+        there is none. `factory` runs outside the lock, so concurrent misses may both
+        compute the value.
+        """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key: t.Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
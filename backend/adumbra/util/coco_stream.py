@@ -0,0 +1,221 @@
+"""
+Functions for producing and consuming COCO documents incrementally. Images are read from
+a single cursor, their annotations are fetched in batches keyed by image id, and every
+record is encoded as soon as it is read; uploaded files are parsed section by section
+with an iterative parser. Memory stays bounded regardless of dataset size.
+"""
+
+import itertools
+import os
+import tempfile
+import typing as t
+
+import ijson
+import numpy as np
+from bson import json_util
+
+if t.TYPE_CHECKING:
+    from mongoengine import QuerySet
+
+ImageGroup = tuple[dict, list[dict]]
+
+DEFAULT_BATCH_SIZE = 500
+_SPOOL_CHUNK_SIZE = 1024 * 1024
+
+
+def rename_id(doc: dict) -> dict:
+    """
+    Return a copy of a raw mongo document with `_id` renamed to `id`, mirroring what
+    `fix_ids` does through a JSON round trip.
+    """
+    renamed = {"id": doc["_id"]} if "_id" in doc else {}
+    renamed.update((key, value) for key, value in doc.items() if key != "_id")
+    return renamed
+
+
+def dumps(doc: dict) -> str:
+    """Encode a document the same way `QuerySet.to_json` does."""
+    return json_util.dumps(doc, json_options=json_util.LEGACY_JSON_OPTIONS)
+
+
+def coco_category(doc: dict) -> dict:
+    """
+    Convert a raw category document into its COCO representation, renaming keypoint
+    fields to `keypoints`/`skeleton` when the category has keypoints.
+    """
+    category = rename_id(doc)
+    category.pop("deleted", None)
+    category.pop("deleted_date", None)
+
+    if len(category.get("keypoint_labels", [])) > 0:
+        category["keypoints"] = category.pop("keypoint_labels", [])
+        category["skeleton"] = category.pop("keypoint_edges", [])
+    else:
+        category.pop("keypoint_edges", None)
+        category.pop("keypoint_labels", None)
+
+    return category
+
+
+def coco_annotation(doc: dict) -> dict | None:
+    """
+    Convert a raw annotation document into its COCO representation. Returns None for
+    annotations with neither a segmentation nor keypoints, which COCO cannot express.
+    """
+    has_keypoints = len(doc.get("keypoints", [])) > 0
+    has_segmentation = len(doc.get("segmentation", [])) > 0
+
+    if not (has_keypoints or has_segmentation):
+        return None
+
+    annotation = rename_id(doc)
+    annotation.pop("deleted", None)
+
+    if not has_keypoints:
+        annotation.pop("keypoints", None)
+    else:
+        arr = np.array(annotation.get("keypoints", []))
+        arr = arr[2::3]
+        annotation["num_keypoints"] = int(len(arr[arr > 0]))
+
+    return annotation
+
+
+def iter_images_with_annotations(
+    images: "QuerySet",
+    annotations: "QuerySet",
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> t.Iterator[ImageGroup]:
+    """
+    Yield `(image, annotations)` pairs of raw documents for every image in `images`.
+
+    Parameters
+    ----------
+    images
+        Image queryset; it is read once, ordered by id
+    annotations
+        Annotation queryset already filtered to the wanted dataset/categories. It is
+        narrowed with `image_id__in` for every batch of images, so one query is issued
+        per `batch_size` images instead of one per image
+    batch_size
+        Number of images whose annotations are fetched together
+
+    Yields
+    ------
+    tuple[dict, list[dict]]
+        The raw image document and the raw documents of its annotations
+    """
+    # A plain generator keeps a single cursor alive; re-iterating the queryset itself
+    # would rewind it
+    image_cursor = (
+        image
+        for image in images.order_by("id")
+        .batch_size(batch_size)
+        .as_pymongo()
+        .no_cache()
+    )
+
+    while True:
+        batch = list(itertools.islice(image_cursor, batch_size))
+        if not batch:
+            return
+
+        by_image: dict[int, list[dict]] = {image["_id"]: [] for image in batch}
+        batch_annotations = annotations.filter(image_id__in=list(by_image))
+        for annotation in batch_annotations.as_pymongo().no_cache():
+            by_image[annotation["image_id"]].append(annotation)
+
+        for image in batch:
+            yield image, by_image[image["_id"]]
+
+
+def iter_coco_json(
+    categories: t.Iterable[dict],
+    image_groups: t.Iterable[ImageGroup],
+    with_empty_images: bool = False,
+    image_transform: t.Callable[[dict], dict] = rename_id,
+) -> t.Iterator[str]:
+    """
+    Encode a COCO document chunk by chunk.
+
+    Images are emitted as they are read, while their annotations are spooled to a
+    temporary file and copied after the `categories` section, so neither list has to be
+    held in memory.
+
+    Parameters
+    ----------
+    categories
+        COCO category dicts (see `coco_category`)
+    image_groups
+        `(image, annotations)` pairs of raw documents, e.g. from
+        `iter_images_with_annotations`
+    with_empty_images
+        Whether images without annotations are included
+    image_transform
+        Converts a raw image document into the dict that is written out
+
+    Yields
+    ------
+    str
+        Consecutive pieces of the JSON document
+    """
+    with tempfile.TemporaryFile(mode="w+", encoding="utf-8") as spool:
+        yield '{"images": ['
+
+        image_separator = ""
+        annotation_separator = ""
+        for image, annotations in image_groups:
+            if len(annotations) == 0 and not with_empty_images:
+                continue
+
+            for annotation in annotations:
+                coco = coco_annotation(annotation)
+                if coco is None:
+                    continue
+                spool.write(annotation_separator + dumps(coco))
+                annotation_separator = ", "
+
+            yield image_separator + dumps(image_transform(image))
+            image_separator = ", "
+
+        yield '], "categories": ['
+        yield ", ".join(dumps(category) for category in categories)
+        yield '], "annotations": ['
+
+        spool.seek(0)
+        while chunk := spool.read(_SPOOL_CHUNK_SIZE):
+            yield chunk
+
+        yield "]}"
+
+
+def write_coco(fp: t.TextIO, *args, **kwargs) -> None:
+    """Write the chunks of `iter_coco_json` to an open text file."""
+    for chunk in iter_coco_json(*args, **kwargs):
+        fp.write(chunk)
+
+
+class CocoFileReader:
+    """
+    Reads the sections of a COCO file one item at a time with `ijson`, so the file is
+    never loaded as a whole. Each call to `iter_section` makes one pass over the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = max(os.path.getsize(path), 1)
+        self.position = 0
+
+    @property
+    def fraction(self) -> float:
+        """Fraction of the file consumed by the current pass"""
+        return min(self.position / self.size, 1.0)
+
+    def iter_section(self, section: str) -> t.Iterator[dict]:
+        """Yield the items of a top-level list such as `images` or `annotations`"""
+        self.position = 0
+        with open(self.path, "rb") as fp:
+            for item in ijson.items(fp, f"{section}.item", use_float=True):
+                self.position = fp.tell()
+                yield item
+        self.position = self.size
@@ -0,0 +1,463 @@
+"""
+The file watcher, a standalone process keeping the images of datasets in line with
+their directories between scans. Filesystem events are coalesced over a debounce
+window and applied in batches, so copying thousands of images costs a few bulk writes
+and thumbnail batches rather than a query, a dataset lookup and a thumbnail per event.
+"""
+
+import datetime
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from adumbra.config import CONFIG
+from adumbra.constants import SUPPORTED_IMAGE_EXTENTIONS
+from adumbra.database import DatasetModel, FolderModel, ImageModel
+from adumbra.database.counters import refresh_dataset_counters, refresh_folder_counters
+from adumbra.database.folders import folder_of, image_folders
+from adumbra.services.thumbnail import delete_thumbnail
+from adumbra.workers.tasks.scan import create_images, refresh_images, remove_images
+from adumbra.workers.tasks.thumbnails import queue_thumbnails
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class EventBatch:
+    """Filesystem events coalesced by path, in the state they leave each path in"""
+
+    # Image files created or modified
+    changed: set = field(default_factory=set)
+    # Image files deleted
+    deleted: set = field(default_factory=set)
+    # Image files moved, from their path in the database to their new one
+    moved: dict = field(default_factory=dict)
+    # Directories deleted and moved
+    deleted_directories: set = field(default_factory=set)
+    moved_directories: dict = field(default_factory=dict)
+
+    def __len__(self):
+        return (
+            len(self.changed)
+            + len(self.deleted)
+            + len(self.moved)
+            + len(self.deleted_directories)
+            + len(self.moved_directories)
+        )
+
+    def change(self, path):
+        self.deleted.discard(path)
+        self.changed.add(path)
+
+    def delete(self, path):
+        self.changed.discard(path)
+        for source, destination in list(self.moved.items()):
+            if destination == path:
+                del self.moved[source]
+                path = source
+        self.deleted.add(path)
+
+    def move(self, source, destination):
+        self.deleted.discard(destination)
+        if source in self.changed:
+            # Not in the database yet, it is created where it ends up
+            self.changed.discard(source)
+            self.changed.add(destination)
+            return
+
+        for origin, previous in list(self.moved.items()):
+            if previous == source:
+                source = origin
+        self.moved[source] = destination
+
+
+def is_dataset_directory(path):
+    """
+    Whether `path` is a directory of a dataset, or the dataset directory itself, and
+    neither is nor is inside a hidden directory such as `.thumbnail`
+    """
+    relative = os.path.relpath(path, CONFIG.dataset_directory)
+    if relative == ".":
+        return True
+    return not relative.startswith("..") and not any(
+        part.startswith(".") for part in relative.split(os.sep)
+    )
+
+
+class ImageFolderHandler(FileSystemEventHandler):
+    """Collects the events of image files into an `EventBatch` until it is taken"""
+
+    def __init__(self, pattern=None):
+        self.pattern = pattern or SUPPORTED_IMAGE_EXTENTIONS
+        self._lock = threading.Lock()
+        self._batch = EventBatch()
+        self._first_event = None
+        self._last_event = None
+
+    def is_image(self, path):
+        """Whether `path` is an image of a dataset, outside of hidden directories"""
+        return path.lower().endswith(self.pattern) and is_dataset_directory(
+            os.path.dirname(path)
+        )
+
+    def on_any_event(self, event):
+        if event.event_type not in ("created", "modified", "deleted", "moved"):
+            return
+
+        source = os.fsdecode(event.src_path)
+        destination = os.fsdecode(event.dest_path) if event.dest_path else None
+
+        with self._lock:
+            if event.is_directory:
+                recorded = self._record_directory(event.event_type, source, destination)
+            else:
+                recorded = self._record_file(event.event_type, source, destination)
+
+            if recorded:
+                now = time.monotonic()
+                self._first_event = self._first_event or now
+                self._last_event = now
+
+    def _record_directory(self, event_type, source, destination):
+        # Some file systems don't generate per-file events when moving or deleting
+        # directories
+        if event_type == "deleted" and is_dataset_directory(source):
+            self._batch.deleted_directories.add(source)
+        elif event_type != "moved":
+            return False
+        elif is_dataset_directory(source) and is_dataset_directory(destination):
+            self._batch.moved_directories[source] = destination
+        elif is_dataset_directory(source):
+            # e.g. moved to a hidden directory
+            self._batch.deleted_directories.add(source)
+        elif is_dataset_directory(destination):
+            # Its files appear without events of their own
+            for directory, directories, files in os.walk(destination):
+                directories[:] = [name for name in directories if name[0] != "."]
+                for name in files:
+                    if self.is_image(os.path.join(directory, name)):
+                        self._batch.change(os.path.join(directory, name))
+        else:
+            return False
+        return True
+
+    def _record_file(self, event_type, source, destination):
+        if event_type == "moved":
+            if self.is_image(source) and self.is_image(destination):
+                self._batch.move(source, destination)
+            elif self.is_image(source):
+                self._batch.delete(source)
+            elif self.is_image(destination):
+                # e.g. a temporary file renamed once completely written
+                self._batch.change(destination)
+            else:
+                return False
+        elif not self.is_image(source):
+            return False
+        elif event_type == "deleted":
+            self._batch.delete(source)
+        else:
+            self._batch.change(source)
+        return True
+
+    def take(self, debounce, max_delay, max_size):
+        """
+        Returns the pending events once none arrived for `debounce` seconds, the
+        oldest waited for `max_delay` seconds or `max_size` paths are pending, and
+        starts a new batch; returns None while events are still coming in
+        """
+        with self._lock:
+            if self._last_event is None:
+                return None
+
+            now = time.monotonic()
+            if (
+                now - self._last_event < debounce
+                and now - self._first_event < max_delay
+                and len(self._batch) < max_size
+            ):
+                return None
+
+            batch = self._batch
+            self._batch = EventBatch()
+            self._first_event = self._last_event = None
+            return batch
+
+
+class DatasetCache:
+    """
+    Datasets by name, the first folder of their images' paths. Unknown names reload
+    the datasets, at most once every `max_age` seconds.
+    """
+
+    def __init__(self, max_age=10.0):
+        self.max_age = max_age
+        self._datasets = {}
+        self._loaded = None
+
+    def get(self, path):
+        relative = os.path.relpath(path, CONFIG.dataset_directory)
+        name = relative.split(os.sep, 1)[0]
+        if name not in self._datasets and (
+            self._loaded is None or time.monotonic() - self._loaded > self.max_age
+        ):
+            self.reload()
+        return self._datasets.get(name)
+
+    def reload(self):
+        self._datasets = {
+            dataset.name: dataset
+            for dataset in DatasetModel.objects(deleted=False).only(
+                "id", "name", "directory"
+            )
+        }
+        self._loaded = time.monotonic()
+
+
+def _by_dataset(datasets, paths):
+    grouped = defaultdict(list)
+    for path in paths:
+        dataset = datasets.get(path)
+        if dataset is not None:
+            grouped[dataset].append(path)
+    return grouped
+
+
+def _move_directories(datasets, moved, moved_directories):
+    """
+    Adds the images of moved directories to `moved`, returning the folders they
+    leave and the folders they join, by dataset
+    """
+    removed_folders = defaultdict(set)
+    added_folders = defaultdict(set)
+    for source, destination in moved_directories.items():
+        pattern = re.compile(f"^{re.escape(os.path.join(source, ''))}")
+        for path in ImageModel.objects(path=pattern).scalar("path"):
+            moved[path] = os.path.join(destination, os.path.relpath(path, source))
+
+        previous, dataset = datasets.get(source), datasets.get(destination)
+        if previous is not None:
+            removed_folders[previous].add(
+                folder_of(previous.directory, os.path.join(source, ""))
+            )
+        if dataset is not None:
+            added_folders[dataset].add(
+                folder_of(dataset.directory, os.path.join(destination, ""))
+            )
+
+    return removed_folders, added_folders
+
+
+def move_images(datasets, moved, moved_directories):
+    """
+    Updates the paths of moved images and of the images of moved directories with one
+    bulk write, returning the ids of the datasets they left or joined. Images moved
+    out of every dataset, or onto the path of another image, are soft-deleted, and
+    the folders of indexed datasets follow.
+    """
+    moved = dict(moved)
+    removed_folders, added_folders = _move_directories(
+        datasets, moved, moved_directories
+    )
+
+    # Paths already taken by another image keep it, as scans do; moving there
+    # removes the moved image, and the file is refreshed as a modified one
+    taken = (
+        set(ImageModel.objects(path__in=list(moved.values())).scalar("path"))
+        - moved.keys()
+    )
+
+    now = datetime.datetime.now()
+    requests, sources = [], []
+    dataset_ids = set()
+    for source, destination in moved.items():
+        previous, dataset = datasets.get(source), datasets.get(destination)
+        if dataset is None and previous is None:
+            continue
+
+        if dataset is None or destination in taken:
+            update = {"$set": {"deleted": True, "deleted_date": now}}
+        else:
+            update = {
+                "$set": {
+                    "path": destination,
+                    "file_name": os.path.basename(destination),
+                    "dataset_id": dataset.id,
+                    "folders": image_folders(dataset.directory, destination),
+                    "regenerate_thumbnail": True,
+                }
+            }
+            added_folders[dataset].add(folder_of(dataset.directory, destination))
+            dataset_ids.add(dataset.id)
+
+        requests.append(UpdateOne({"path": source}, update))
+        sources.append(source)
+        delete_thumbnail(source)
+        if previous is not None:
+            dataset_ids.add(previous.id)
+
+    for dataset, folders in removed_folders.items():
+        for folder in folders:
+            FolderModel.remove(dataset.id, folder)
+    for dataset, folders in added_folders.items():
+        if FolderModel.is_indexed(dataset.id):
+            FolderModel.add(dataset.id, folders)
+
+    if requests:
+        try:
+            # pylint: disable-next=protected-access
+            ImageModel._get_collection().bulk_write(requests, ordered=False)
+        except BulkWriteError as error:
+            # Destinations taken meanwhile, or by images moving in the same batch;
+            # the other moves are applied and scans reconcile these
+            for write_error in error.details["writeErrors"]:
+                logger.warning(
+                    "Could not move %s: %s",
+                    sources[write_error["index"]],
+                    write_error["errmsg"],
+                )
+
+    return dataset_ids
+
+
+def update_images(datasets, paths):
+    """
+    Creates the images of new files and refreshes those of modified files, grouped
+    by dataset. Returns the ids of the datasets changed.
+    """
+    dataset_ids = set()
+    for dataset, dataset_paths in _by_dataset(datasets, paths).items():
+        known = {
+            image["path"]: image
+            for image in ImageModel.objects(path__in=dataset_paths)
+            .only("path", "deleted", "file_size", "file_mtime")
+            .as_pymongo()
+        }
+
+        new, modified = [], []
+        for path in dataset_paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            image = known.get(path)
+            if image is None:
+                new.append(path)
+            elif not image.get("deleted") and (
+                image.get("file_size"),
+                image.get("file_mtime"),
+            ) != (stat.st_size, stat.st_mtime):
+                modified.append(path)
+
+        if new or modified:
+            logger.info(
+                "%s: %d new and %d modified image(s)",
+                dataset.name,
+                len(new),
+                len(modified),
+            )
+            if FolderModel.is_indexed(dataset.id):
+                FolderModel.add(
+                    dataset.id, {folder_of(dataset.directory, path) for path in new}
+                )
+            create_images(logger, dataset, new)
+            refresh_images(logger, dataset, modified)
+            dataset_ids.add(dataset.id)
+
+    return dataset_ids
+
+
+def delete_images(datasets, paths, directories):
+    """
+    Soft-deletes the images of deleted files and directories, like a scan would,
+    returning the ids of the datasets changed
+    """
+    dataset_ids = set()
+    deleted = _by_dataset(datasets, paths)
+    deleted_directories = _by_dataset(datasets, directories)
+    for dataset in deleted.keys() | deleted_directories.keys():
+        folders = [
+            folder_of(dataset.directory, os.path.join(directory, ""))
+            for directory in deleted_directories.get(dataset, [])
+        ]
+        image_ids = ImageModel.objects(
+            path__in=deleted.get(dataset, []), deleted=False
+        ).scalar("id")
+
+        removed = remove_images(dataset, list(image_ids), folders)
+        for folder in folders:
+            FolderModel.remove(dataset.id, folder)
+        if removed:
+            logger.info("%s: deleted %d image(s)", dataset.name, removed)
+            dataset_ids.add(dataset.id)
+
+    return dataset_ids
+
+
+def apply_events(batch, datasets):
+    """Applies a batch of events to the database, a few bulk writes per dataset"""
+    start = time.perf_counter()
+
+    # Files moved along with their directory may also have their own event, which
+    # finds them moved already; destinations missing from the database are created
+    moved = move_images(datasets, batch.moved, batch.moved_directories)
+    deleted = delete_images(datasets, batch.deleted, batch.deleted_directories)
+    changed = update_images(
+        datasets, batch.changed | (set(batch.moved.values()) - batch.deleted)
+    )
+
+    if moved or deleted:
+        refresh_dataset_counters(moved | deleted)
+    for dataset_id in moved | deleted | changed:
+        refresh_folder_counters(dataset_id)
+        DatasetModel.mark_modified(dataset_id)
+
+    queue_thumbnails(
+        ImageModel.objects(
+            dataset_id__in=list(moved | changed), regenerate_thumbnail=True
+        ).scalar("id")
+    )
+    logger.info("Applied %d event(s) in %.1fs", len(batch), time.perf_counter() - start)
+
+
+def run_watcher():
+    """Watches the dataset directory until interrupted"""
+    handler = ImageFolderHandler()
+    datasets = DatasetCache()
+
+    observer = Observer()
+    observer.schedule(handler, CONFIG.dataset_directory, recursive=True)
+    observer.start()
+    logger.info("Watching %s", CONFIG.dataset_directory)
+
+    settings = CONFIG.watcher
+    try:
+        while observer.is_alive():
+            time.sleep(settings.debounce / 4)
+            batch = handler.take(
+                settings.debounce, settings.max_delay, settings.batch_size
+            )
+            if not batch:
+                continue
+
+            try:
+                apply_events(batch, datasets)
+            # A failed batch must not stop the watcher, the next scan catches up
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not apply %d event(s)", len(batch))
+    finally:
+        observer.stop()
+        observer.join()
+
+
+__all__ = ["ImageFolderHandler", "run_watcher"]
@@ -0,0 +1,9 @@
+import logging
+
+from adumbra.config import CONFIG
+from adumbra.watcher import run_watcher
+
+logging.basicConfig(
+    level=CONFIG.log_level, format="[%(asctime)s] [File Watcher] %(message)s"
+)
+run_watcher()
@@ -19,6 +19,7 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 
 from adumbra.config import CONFIG
 from adumbra.database import ImageModel, connect_mongo, create_from_json
+from adumbra.database.indexes import ensure_indexes
 from adumbra.webserver.api import blueprint as api
 from adumbra.webserver.authentication import login_manager
 from adumbra.webserver.sockets import socketio
@@ -31,11 +32,6 @@ socketio = SocketIO()
 
 def create_app():
 
-    # Dunno why observer.start() does not return
-    # We disable it and see later if this is fixable
-    # if Config.FILE_WATCHER:
-    #   run_watcher()
-
     flask = Flask(
         __name__,
         # static_url_path='', # this option seem's to cause trouble with path handling
@@ -58,6 +54,9 @@ def create_app():
         cors_allowed_origins="*",
         message_queue=CONFIG.celery.broker_url,
     )
+    if CONFIG.connect_to_mongo and CONFIG.ensure_indexes:
+        ensure_indexes()
+
     # Remove all poeple who were annotating when
     # the server shutdown
     ImageModel.objects.update(annotating=[])
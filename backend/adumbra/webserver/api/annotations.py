@@ -4,7 +4,8 @@ import logging
 from flask_login import current_user, login_required
 from flask_restx import Namespace, Resource, reqparse
 
-from adumbra.database import AnnotationModel
+from adumbra.database import AnnotationModel, DatasetModel, revision_filter
+from adumbra.database.counters import inc_category_counters
 from adumbra.util import api_bridge
 
 logger = logging.getLogger("gunicorn.error")
@@ -22,6 +23,35 @@ create_annotation.add_argument("color", location="json")
 
 update_annotation = reqparse.RequestParser()
 update_annotation.add_argument("category_id", type=int, location="json")
+update_annotation.add_argument(
+    "revision", type=int, location="json", help="Revision the update is based on"
+)
+
+delete_annotation = reqparse.RequestParser()
+delete_annotation.add_argument(
+    "revision", type=int, location="args", help="Revision the delete is based on"
+)
+
+
+def _conditional_update(annotation, revision, **update):
+    """
+    Applies `update` and increments the revision, but only if the annotation is still
+    at `revision` (when given). Returns False if the annotation changed meanwhile.
+    """
+    query = AnnotationModel.objects(id=annotation.id)
+    if revision is not None:
+        query = query.filter(__raw__=revision_filter(revision))
+
+    return query.update(inc__revision=1, **update) > 0
+
+
+def _conflict(annotation):
+    current = AnnotationModel.objects(id=annotation.id).only("revision").first()
+    return {
+        "success": False,
+        "message": "Annotation was modified by another user",
+        "revision": current.revision if current else None,
+    }, 409
 
 
 @api.route("/")
@@ -70,6 +100,9 @@ class Annotation(Resource):
         except (ValueError, TypeError) as e:
             return {"message": str(e)}, 400
 
+        DatasetModel.mark_modified(image.dataset_id)
+        inc_category_counters({annotation.category_id: 1})
+
         return api_bridge.queryset_to_json(annotation)
 
 
@@ -86,6 +119,7 @@ class AnnotationId(Resource):
 
         return api_bridge.queryset_to_json(annotation)
 
+    @api.expect(delete_annotation)
     @login_required
     def delete(self, annotation_id):
         """Deletes an annotation by ID"""
@@ -94,13 +128,26 @@ class AnnotationId(Resource):
         if annotation is None:
             return {"message": "Invalid annotation id"}, 400
 
+        args = delete_annotation.parse_args()
+
+        if not _conditional_update(
+            annotation,
+            args.get("revision"),
+            set__deleted=True,
+            set__deleted_date=datetime.datetime.now(),
+        ):
+            return _conflict(annotation)
+
+        DatasetModel.mark_modified(annotation.dataset_id)
+        if not annotation.deleted:
+            inc_category_counters({annotation.category_id: -1})
+
         image = current_user.images.filter(
             id=annotation.image_id, deleted=False
         ).first()
         # Set image thumbnail to be regenerated
         image.update(regenerate_thumbnail=True)
 
-        annotation.update(set__deleted=True, set__deleted_date=datetime.datetime.now())
         return {"success": True}
 
     @api.expect(update_annotation)
@@ -115,7 +162,14 @@ class AnnotationId(Resource):
         args = update_annotation.parse_args()
 
         new_category_id = args.get("category_id")
-        annotation.update(category_id=new_category_id)
+        if not _conditional_update(
+            annotation, args.get("revision"), set__category_id=new_category_id
+        ):
+            return _conflict(annotation)
+
+        DatasetModel.mark_modified(annotation.dataset_id)
+        if not annotation.deleted and new_category_id != annotation.category_id:
+            inc_category_counters({annotation.category_id: -1, new_category_id: 1})
         logger.info(
             f"{current_user.username} has updated category for annotation (id: {annotation.id})"
         )
@@ -1,16 +1,34 @@
 import datetime
+from collections import defaultdict
 
 from flask import request
 from flask_login import current_user, login_required
-from flask_restx import Namespace, Resource
+from flask_restx import Namespace, Resource, inputs, reqparse
+from pymongo import UpdateOne
 
 from adumbra.config import CONFIG
-from adumbra.database import AnnotationModel, CategoryModel, ImageModel, SessionEvent
+from adumbra.database import (
+    AnnotationModel,
+    CategoryModel,
+    DatasetModel,
+    ImageModel,
+    SessionEvent,
+    revision_filter,
+)
+from adumbra.database.counters import inc_dataset_counters
 from adumbra.util.api_bridge import queryset_to_json
-from adumbra.webserver.util import coco_util, thumbnails
+from adumbra.webserver.util import coco_util, query_util, thumbnails
 
 api = Namespace("annotator", description="Annotator related operations")
 
+annotator_data = reqparse.RequestParser()
+annotator_data.add_argument(
+    "paper_object",
+    type=inputs.boolean,
+    default=True,
+    help="Include the paperjs objects of the annotations",
+)
+
 
 @api.route("/data")
 class AnnotatorData(Resource):
@@ -18,7 +36,17 @@ class AnnotatorData(Resource):
     @login_required
     def post(self):
         """
-        Called when saving data from the annotator client
+        Called when saving data from the annotator client.
+
+        The client may send every annotation of the image or only those that changed
+        since its last save; the image's annotation count is taken from the database
+        either way. All changes are applied with one `bulk_write` per collection and
+        geometry is only recomputed for annotations whose `compoundPath` differs from
+        the stored one. The new revisions of the sent annotations are returned.
+
+        Annotations sent with a `revision` are only updated if they still have that
+        revision; otherwise the save is rejected with a 409 listing the conflicting
+        annotations, so concurrent annotators never overwrite each other.
         """
         data = request.get_json(force=True)
         image = data.get("image")
@@ -32,122 +60,257 @@ class AnnotatorData(Resource):
 
         # Check if current user can access dataset
         db_dataset = current_user.datasets.filter(id=image_model.dataset_id).first()
-        if dataset is None:
+        if dataset is None or db_dataset is None:
             return {"success": False, "message": "Could not find associated dataset"}
 
         db_dataset.update(annotate_url=dataset.get("annotate_url", ""))
 
-        categories = CategoryModel.objects.all()
-        annotations = AnnotationModel.objects(image_id=image_id)
-
         current_user.update(preferences=data.get("user", {}))
 
-        num_annotations = 0
-        # Iterate every category passed in the data
-        for category in data.get("categories", []):
-            category_id = category.get("id")
+        categories = data.get("categories", [])
+        db_categories = CategoryModel.objects(
+            id__in=[category.get("id") for category in categories]
+        ).in_bulk([category.get("id") for category in categories])
+
+        db_annotations = {
+            annotation["_id"]: annotation
+            for annotation in AnnotationModel.objects(
+                image_id=image_id,
+                id__in=[
+                    annotation.get("id")
+                    for category in categories
+                    for annotation in category.get("annotations", [])
+                ],
+            )
+            .only("id", "width", "height", "paper_object", "revision")
+            .as_pymongo()
+        }
 
+        conflicts = _stale_annotations(categories, db_annotations)
+        if conflicts:
+            return _conflict(conflicts)
+
+        category_updates = []
+        annotation_updates = {}
+
+        # Iterate every category passed in the data
+        for category in categories:
             # Find corresponding category object in the database
-            db_category = categories.filter(id=category_id).first()
+            db_category = db_categories.get(category.get("id"))
             if db_category is None:
                 continue
 
-            category_update = {"color": category.get("color")}
-            if current_user.can_edit(db_category):
-                category_update["keypoint_edges"] = category.get("keypoint_edges", [])
-                category_update["keypoint_labels"] = category.get("keypoint_labels", [])
-                category_update["keypoint_colors"] = category.get("keypoint_colors", [])
-
-            db_category.update(**category_update)
-
-            # Iterate every annotation from the data annotations
-            for annotation in category.get("annotations", []):
-                counted = False
-                # Find corresponding annotation object in database
-                annotation_id = annotation.get("id")
-                db_annotation = annotations.filter(id=annotation_id).first()
-
-                if db_annotation is None:
-                    continue
-
-                # Paperjs objects are complex, so they will not always be passed. Therefor we update
-                # the annotation twice, checking if the paperjs exists.
-
-                # Update annotation in database
-                sessions = []
-                total_time = 0
-                for session in annotation.get("sessions", []):
-                    date = datetime.datetime.fromtimestamp(
-                        int(session.get("start")) / 1e3
-                    )
-                    model = SessionEvent(
-                        user=current_user.username,
-                        created_at=date,
-                        milliseconds=session.get("milliseconds"),
-                        tools_used=session.get("tools"),
-                    )
-                    total_time += session.get("milliseconds")
-                    sessions.append(model)
-
-                keypoints = annotation.get("keypoints", [])
-                if keypoints:
-                    counted = True
-
-                db_annotation.update(
-                    add_to_set__events=sessions,
-                    inc__milliseconds=total_time,
-                    set__isbbox=annotation.get("isbbox", False),
-                    set__keypoints=keypoints,
-                    set__metadata=annotation.get("metadata"),
-                    set__color=annotation.get("color"),
+            category_update = _category_update(category, db_category)
+            if category_update is not None:
+                category_updates.append(category_update)
+
+            # Only annotations of this image that exist in the database are updated
+            annotation_updates.update(
+                (
+                    annotation_id,
+                    _annotation_update(
+                        image_id, annotation, db_annotations[annotation_id]
+                    ),
                 )
+                for annotation in category.get("annotations", [])
+                if (annotation_id := annotation.get("id")) in db_annotations
+            )
+
+        if category_updates:
+            # pylint: disable-next=protected-access
+            CategoryModel._get_collection().bulk_write(category_updates, ordered=False)
+
+        raced = []
+        if annotation_updates:
+            # pylint: disable-next=protected-access
+            result = AnnotationModel._get_collection().bulk_write(
+                [UpdateOne(*update) for update in annotation_updates.values()],
+                ordered=False,
+            )
+
+            # Another save got in between reading and writing some of these
+            # annotations. The others are written, so the image is still updated.
+            if result.matched_count < len(annotation_updates):
+                raced = _raced_annotations(db_annotations, annotation_updates)
+
+        _save_image(image_model, image)
+        DatasetModel.mark_modified(db_dataset.id)
+
+        revisions = _annotation_revisions(db_annotations)
+        if raced:
+            return _conflict(
+                raced,
+                message="Annotations were modified by another user, "
+                "the other changes were saved",
+                revisions=revisions,
+            )
+
+        return {"success": True, "revisions": revisions}
+
+
+def _save_image(image_model, image):
+    """Updates an image, its counters and thumbnail once its annotations are saved"""
+    # Count from the database since a delta save only carries changed annotations
+    num_annotations = AnnotationModel.objects(
+        image_id=image_model.id,
+        deleted=False,
+        __raw__={"$or": [{"area": {"$gt": 0}}, {"keypoints.0": {"$exists": True}}]},
+    ).count()
+
+    was_annotated = image_model.annotated
+    image_model = ImageModel.objects(id=image_model.id).modify(
+        new=True,
+        set__metadata=image.get("metadata", {}),
+        set__annotated=(num_annotations > 0),
+        set__category_ids=image.get("category_ids", []),
+        set__regenerate_thumbnail=True,
+        set__num_annotations=num_annotations,
+        inc__revision=1,
+    )
+    if not image_model.deleted:
+        inc_dataset_counters(
+            image_model.dataset_id,
+            annotated=int(image_model.annotated) - int(was_annotated),
+        )
 
-                paperjs_object = annotation.get("compoundPath", [])
-
-                # Update paperjs if it exists
-                if len(paperjs_object) == 2:
-
-                    width = db_annotation.width
-                    height = db_annotation.height
-
-                    # Generate coco formatted segmentation data
-                    segmentation, area, bbox = coco_util.paperjs_to_coco(
-                        width, height, paperjs_object
-                    )
-
-                    db_annotation.update(
-                        set__segmentation=segmentation,
-                        set__area=area,
-                        set__isbbox=annotation.get("isbbox", False),
-                        set__bbox=bbox,
-                        set__paper_object=paperjs_object,
-                    )
-
-                    if area > 0:
-                        counted = True
-
-                if counted:
-                    num_annotations += 1
-
-        image_model.update(
-            set__metadata=image.get("metadata", {}),
-            set__annotated=(num_annotations > 0),
-            set__category_ids=image.get("category_ids", []),
-            set__regenerate_thumbnail=True,
-            set__num_annotations=num_annotations,
+    thumbnails.generate_thumbnail(image_model)
+
+
+def _stale_annotations(categories, db_annotations):
+    """Ids of the sent annotations whose revision no longer matches the database"""
+    return [
+        annotation.get("id")
+        for category in categories
+        for annotation in category.get("annotations", [])
+        if annotation.get("id") in db_annotations
+        and annotation.get("revision") is not None
+        and annotation.get("revision")
+        != db_annotations[annotation.get("id")].get("revision", 0)
+    ]
+
+
+def _raced_annotations(db_annotations, annotation_updates):
+    """
+    Ids of the annotations another save wrote first. Its revision bump looks like
+    ours, so the fields written are compared too.
+    """
+    written = {
+        annotation["_id"]: annotation
+        for annotation in AnnotationModel.objects(
+            id__in=list(annotation_updates)
+        ).as_pymongo()
+    }
+    return [
+        annotation_id
+        for annotation_id, (_, update) in annotation_updates.items()
+        if (annotation := written.get(annotation_id)) is None
+        or annotation.get("revision", 0)
+        != db_annotations[annotation_id].get("revision", 0) + 1
+        or any(annotation.get(key) != value for key, value in update["$set"].items())
+    ]
+
+
+def _annotation_revisions(annotation_ids):
+    """Maps annotation ids to their current revision"""
+    return {
+        annotation["_id"]: annotation.get("revision", 0)
+        for annotation in AnnotationModel.objects(id__in=list(annotation_ids))
+        .only("id", "revision")
+        .as_pymongo()
+    }
+
+
+def _conflict(
+    annotation_ids, message="Annotations were modified by another user", **extra
+):
+    """Response for a save rejected, fully or partially, because of stale revisions"""
+    return {
+        "success": False,
+        "message": message,
+        "conflicts": annotation_ids,
+        **extra,
+    }, 409
+
+
+def _category_update(category, db_category):
+    """Update for a category sent by the annotator client, None if unchanged"""
+    update = {"color": category.get("color")}
+    if current_user.can_edit(db_category):
+        update["keypoint_edges"] = category.get("keypoint_edges", [])
+        update["keypoint_labels"] = category.get("keypoint_labels", [])
+        update["keypoint_colors"] = category.get("keypoint_colors", [])
+
+    if all(db_category[key] == value for key, value in update.items()):
+        return None
+
+    return UpdateOne({"_id": db_category.id}, {"$set": update})
+
+
+def _annotation_update(image_id, annotation, db_annotation):
+    """
+    Builds the query and update for one annotation sent by the annotator client. The
+    coco segmentation is only recomputed when the paperjs object has changed, and
+    the write only matches if the annotation is still at the revision the client sent.
+    """
+    sessions = []
+    total_time = 0
+    for session in annotation.get("sessions", []):
+        date = datetime.datetime.fromtimestamp(int(session.get("start")) / 1e3)
+        model = SessionEvent(
+            user=current_user.username,
+            created_at=date,
+            milliseconds=session.get("milliseconds"),
+            tools_used=session.get("tools"),
+        )
+        total_time += session.get("milliseconds")
+        sessions.append(model.to_mongo())
+
+    update = {
+        "$set": {
+            "isbbox": annotation.get("isbbox", False),
+            "keypoints": annotation.get("keypoints", []),
+            "metadata": annotation.get("metadata"),
+            "color": annotation.get("color"),
+        },
+        "$inc": {"milliseconds": total_time, "revision": 1},
+    }
+    if sessions:
+        update["$addToSet"] = {"events": {"$each": sessions}}
+
+    paperjs_object = annotation.get("compoundPath", [])
+
+    # Paperjs objects are complex, so they will not always be passed. Unchanged ones
+    # keep their stored segmentation.
+    if len(paperjs_object) == 2 and paperjs_object != db_annotation.get("paper_object"):
+        # Generate coco formatted segmentation data
+        segmentation, area, bbox = coco_util.paperjs_to_coco(
+            db_annotation.get("width"), db_annotation.get("height"), paperjs_object
+        )
+        update["$set"].update(
+            {
+                "segmentation": segmentation,
+                "area": int(area),
+                "bbox": [float(value) for value in bbox],
+                "paper_object": paperjs_object,
+            }
         )
 
-        thumbnails.generate_thumbnail(image_model)
+    query = {"_id": db_annotation["_id"], "image_id": image_id}
+    if annotation.get("revision") is not None:
+        query.update(revision_filter(annotation.get("revision")))
 
-        return {"success": True}
+    return query, update
 
 
 @api.route("/data/<int:image_id>")
 class AnnotatorId(Resource):
 
+    @api.expect(annotator_data)
     @login_required
     def get(self, image_id):
         """Called when loading from the annotator client"""
+        args = annotator_data.parse_args()
+
         image = ImageModel.objects(id=image_id).exclude("events").first()
 
         if image is None:
@@ -160,16 +323,11 @@ class AnnotatorId(Resource):
                 "message": "Could not find associated dataset",
             }, 400
 
-        categories = (
-            CategoryModel.objects(deleted=False).in_bulk(dataset.categories).items()
-        )
+        categories = CategoryModel.objects(deleted=False, id__in=dataset.categories)
 
         # Get next and previous image
         images = ImageModel.objects(dataset_id=dataset.id, deleted=False)
-        pre = (
-            images.filter(file_name__lt=image.file_name).order_by("-file_name").first()
-        )
-        nex = images.filter(file_name__gt=image.file_name).order_by("file_name").first()
+        pre, nex = query_util.image_neighbors(images, image, "file_name", 1)
 
         preferences = {}
         if not CONFIG.login_disabled:
@@ -187,29 +345,25 @@ class AnnotatorId(Resource):
             },
         }
 
-        data["image"]["previous"] = pre.id if pre else None
-        data["image"]["next"] = nex.id if nex else None
+        data["image"]["previous"] = pre[0]["id"] if pre else None
+        data["image"]["next"] = nex[0]["id"] if nex else None
 
-        # Optimize query: query all annotation of specific image,
-        # and then categorize them according to the categories.
-        all_annotations = (
-            AnnotationModel.objects(image_id=image_id, deleted=False)
-            .exclude("events")
-            .all()
-        )
-
-        for category in categories:
-            category = queryset_to_json(category[1])
-            category_id = category.get("id")
+        # Query all annotations of the image, serialize them at once and then bucket
+        # them by category
+        all_annotations = AnnotationModel.objects(
+            image_id=image_id, deleted=False
+        ).exclude("events")
+        if not args.get("paper_object"):
+            all_annotations = all_annotations.exclude("paper_object")
 
-            annotations = []
-            for annotation in all_annotations:
-                if annotation["category_id"] == category_id:
-                    annotations.append(queryset_to_json(annotation))
+        annotations_by_category = defaultdict(list)
+        for annotation in queryset_to_json(all_annotations):
+            annotations_by_category[annotation["category_id"]].append(annotation)
 
+        for category in queryset_to_json(categories):
             category["show"] = True
             category["visualize"] = False
-            category["annotations"] = [] if annotations is None else annotations
+            category["annotations"] = annotations_by_category[category.get("id")]
             data["categories"].append(category)
 
         return data
@@ -4,7 +4,8 @@ from flask_login import current_user, login_required
 from flask_restx import Namespace, Resource, reqparse
 from mongoengine.errors import NotUniqueError
 
-from adumbra.database import AnnotationModel, CategoryModel
+from adumbra.database import CategoryModel
+from adumbra.database.counters import missing_counters, refresh_category_counters
 from adumbra.util.api_bridge import Pagination, queryset_to_json
 
 api = Namespace("category", description="Category related operations")
@@ -180,10 +181,18 @@ class CategoriesData(Resource):
         )
         categories = queryset_to_json(pagination.slice_objects(categories))
 
+        # Counters are computed the first time a category is listed
+        missing = missing_counters(categories, "num_annotations")
+        if missing:
+            refresh_category_counters(missing)
+            counts = dict(
+                CategoryModel.objects(id__in=missing).scalar("id", "num_annotations")
+            )
+            for category in categories:
+                category.setdefault("num_annotations", counts.get(category["id"], 0))
+
         for category in categories:
-            category["numberAnnotations"] = AnnotationModel.objects(
-                deleted=False, category_id=category.get("id")
-            ).count()
+            category["numberAnnotations"] = category["num_annotations"]
 
         return {
             "pagination": pagination.to_dict(),
@@ -1,26 +1,28 @@
 import datetime
-import json
 import os
 from threading import Thread
 
-from flask import request
+from flask import Response, request, stream_with_context
 from flask_login import current_user, login_required
 from flask_restx import Namespace, Resource, inputs, reqparse
 from google_images_download import google_images_download as gid
 from mongoengine.errors import NotUniqueError
-from mongoengine.queryset.visitor import Q
 from werkzeug.datastructures import FileStorage
 
+from adumbra.config import CONFIG
 from adumbra.database import (
     AnnotationModel,
     CategoryModel,
     DatasetModel,
     ExportModel,
+    FolderModel,
     ImageModel,
 )
+from adumbra.database.counters import refresh_dataset_counters
 from adumbra.database.users import get_dataset_users
 from adumbra.util import api_bridge
-from adumbra.webserver.util import coco_util
+from adumbra.util.cache import TTLCache
+from adumbra.webserver.util import coco_util, query_util, stats_util
 from adumbra.workers.tasks.helpers.utils import export_coco, import_coco, scan
 
 api = Namespace("dataset", description="Dataset related operations")
@@ -41,6 +43,17 @@ page_data.add_argument("page", default=1, type=int)
 page_data.add_argument("limit", default=20, type=int)
 page_data.add_argument("folder", default="", help="Folder for data")
 page_data.add_argument("order", default="file_name", help="Order to display images")
+page_data.add_argument(
+    "cursor", help="Cursor returned as next_cursor; takes precedence over page"
+)
+page_data.add_argument(
+    "total",
+    default=True,
+    type=inputs.boolean,
+    help="Count the matching images; the count may be cached briefly",
+)
+
+image_count_cache = TTLCache(CONFIG.count_cache_ttl)
 
 delete_data = reqparse.RequestParser()
 delete_data.add_argument(
@@ -91,6 +104,15 @@ dataset_generate.add_argument(
     "limit", location="json", type=int, default=100, help="Number of images per keyword"
 )
 
+scan_args = reqparse.RequestParser()
+scan_args.add_argument(
+    "full",
+    type=inputs.boolean,
+    default=False,
+    location="args",
+    help="List every folder instead of only those changed since the last scan",
+)
+
 share = reqparse.RequestParser()
 share.add_argument(
     "users", location="json", type=list, default=[], help="List of users"
@@ -213,67 +235,7 @@ class DatasetStats(Resource):
         if dataset is None:
             return {"message": "Invalid dataset id"}, 400
 
-        images = ImageModel.objects(dataset_id=dataset.id, deleted=False)
-        annotated_images = images.filter(annotated=True)
-        annotations = AnnotationModel.objects(dataset_id=dataset_id, deleted=False)
-
-        # Calculate annotation counts by category in this dataset
-        category_count = {}
-        image_category_count = {}
-
-        user_stats = {}
-
-        for user in get_dataset_users(dataset):
-            user_annots = AnnotationModel.objects(
-                dataset_id=dataset_id, deleted=False, creator=user.username
-            )
-            image_count = {}
-            for annot in user_annots:
-                image_count[annot.image_id] = image_count.get(annot.image_id, 0) + 1
-
-            user_stats[user.username] = {
-                "annotations": len(user_annots),
-                "images": len(image_count),
-            }
-
-        for category in dataset.categories:
-
-            # Calculate the annotation count in the current category in this dataset
-            cat_name = CategoryModel.objects(id=category).first()["name"]
-            cat_count = AnnotationModel.objects(
-                dataset_id=dataset_id, category_id=category, deleted=False
-            ).count()
-            category_count.update({str(cat_name): cat_count})
-
-            # Calculate the annotated images count in the current category in this dataset
-            image_count = len(
-                AnnotationModel.objects(
-                    dataset_id=dataset_id, category_id=category, deleted=False
-                ).distinct("image_id")
-            )
-            image_category_count.update({str(cat_name): image_count})
-
-        stats = {
-            "total": {
-                "Users": get_dataset_users(dataset).count(),
-                "Images": images.count(),
-                "Annotated Images": annotated_images.count(),
-                "Annotations": annotations.count(),
-                "Categories": len(dataset.categories),
-                "Time Annotating (s)": (images.sum("milliseconds") or 0) / 1000,
-            },
-            "average": {
-                "Image Size (px)": images.average("width"),
-                "Image Height (px)": images.average("height"),
-                "Annotation Area (px)": annotations.average("area"),
-                "Time (ms) per Image": images.average("milliseconds") or 0,
-                "Time (ms) per Annotation": annotations.average("milliseconds") or 0,
-            },
-            "categories": category_count,
-            "images_per_category": image_category_count,
-            "users": user_stats,
-        }
-        return stats
+        return stats_util.get_dataset_stats(dataset)
 
 
 @api.route("/<int:dataset_id>")
@@ -366,21 +328,26 @@ class DatasetData(Resource):
         pagination = api_bridge.Pagination.from_count_and_page(
             datasets.count(), page_size=limit, page=page
         )
-        datasets = pagination.slice_objects(datasets)
+        datasets = list(pagination.slice_objects(datasets))
+
+        # Counters are computed the first time a dataset is listed
+        missing = [dataset.id for dataset in datasets if dataset.num_images is None]
+        if missing:
+            refresh_dataset_counters(missing)
+            refreshed = DatasetModel.objects.in_bulk(missing)
+            datasets = [refreshed.get(dataset.id, dataset) for dataset in datasets]
 
         datasets_json = []
         for dataset in datasets:
             dataset: DatasetModel
             dataset_json = api_bridge.queryset_to_json(dataset)
-            images = ImageModel.objects(dataset_id=dataset.id, deleted=False)
 
-            dataset_json["numberImages"] = images.count()
-            dataset_json["numberAnnotated"] = images.filter(annotated=True).count()
+            dataset_json["numberImages"] = dataset.num_images
+            dataset_json["numberAnnotated"] = dataset.num_annotated
             dataset_json["permissions"] = dataset.permissions(current_user)
 
-            first = images.first()
-            if first is not None:
-                dataset_json["first_image_id"] = images.first().id
+            if dataset.first_image_id is not None:
+                dataset_json["first_image_id"] = dataset.first_image_id
             datasets_json.append(dataset_json)
 
         return {
@@ -415,90 +382,63 @@ class DatasetDataId(Resource):
             return {"message", "Invalid dataset id"}, 400
 
         # Make sure folder starts with is in proper format
-        if len(folder) > 0:
-            folder = folder[0].strip("/") + folder[1:]
-            if folder[-1] != "/":
-                folder = folder + "/"
+        folder = query_util.normalize_folder(folder)
 
-        # Get directory
+        # Get directory, from the folder index once the dataset has been scanned
         directory = os.path.join(dataset.directory, folder)
-        if not os.path.exists(directory):
+        folder_model = None
+        if FolderModel.is_indexed(dataset_id):
+            folder_model = FolderModel.objects(
+                dataset_id=dataset_id, path=folder
+            ).first()
+            if folder_model is None:
+                return {"message": "Directory does not exist."}, 400
+        elif not os.path.exists(directory):
             return {"message": "Directory does not exist."}, 400
 
-        # Remove parsed arguments
-        for key in parsed_args:
-            args.pop(key, None)
-
         # Generate query from remaining arugments
-        query = {}
-        for key, value in args.items():
-            lower = value.lower()
-            if lower in ["true", "false"]:
-                value = json.loads(lower)
-
-            if len(lower) != 0:
-                query[key] = value
-
-        # Change category_ids__in to list
-        if "category_ids__in" in query.keys():
-            query["category_ids__in"] = [
-                int(x) for x in query["category_ids__in"].split(",")
-            ]
-
-        # Initialize mongo query with required elements:
-        query_build = Q(dataset_id=dataset_id)
-        query_build &= Q(path__startswith=directory)
-        query_build &= Q(deleted=False)
-
-        # Define query names that should use complex logic:
-        complex_query = ["annotated", "category_ids__in"]
-
-        # Add additional 'and' arguments to mongo query that do not require complex_query logic
-        for key in query.keys():
-            if key not in complex_query:
-                query_dict = {}
-                query_dict[key] = query[key]
-                query_build &= Q(**query_dict)
-
-        # Add additional arguments to mongo query that require more complex logic to construct
-        if "annotated" in query.keys():
-
-            if "category_ids__in" in query.keys() and query["annotated"]:
-
-                # Only show annotated images with selected category_ids
-                query_dict = {}
-                query_dict["category_ids__in"] = query["category_ids__in"]
-                query_build &= Q(**query_dict)
-
-            else:
-
-                # Only show non-annotated images
-                query_dict = {}
-                query_dict["annotated"] = query["annotated"]
-                query_build &= Q(**query_dict)
-
-        elif "category_ids__in" in query.keys():
-
-            # Ahow annotated images with selected category_ids or non-annotated images
-            query_dict_1 = {}
-            query_dict_1["category_ids__in"] = query["category_ids__in"]
-
-            query_dict_2 = {}
-            query_dict_2["annotated"] = False
-            query_build &= Q(**query_dict_1) | Q(**query_dict_2)
+        query = query_util.image_filters(args, parsed_args)
 
         # Perform mongodb query
         images = (
-            current_user.images.filter(query_build)
-            .order_by(order)
-            .only("id", "file_name", "annotating", "annotated", "num_annotations")
+            current_user.images.filter(
+                query_util.image_query(
+                    dataset_id,
+                    directory,
+                    query,
+                    folder=folder if folder_model is not None else None,
+                )
+            )
+            .order_by(*query_util.image_order(order))
+            .only(
+                "id",
+                "file_name",
+                "annotating",
+                "annotated",
+                "num_annotations",
+                "revision",
+                order.lstrip("-"),
+            )
         )
 
-        total = images.count()
-        pages = int(total / per_page) + 1
+        total = pages = None
+        if parsed_args.get("total"):
+            # Unfiltered folders are counted by the folder index
+            if folder_model is not None and not query:
+                total = folder_model.num_images
+            else:
+                total = image_count_cache.get_or_set(
+                    (dataset.id, dataset.last_modified, directory, str(query)),
+                    images.count,
+                )
+            pages = int(total / per_page) + 1
 
-        images = images.skip(page * per_page).limit(per_page)
-        images_json = api_bridge.queryset_to_json(images)
+        try:
+            images_json, next_cursor = query_util.paginate(
+                images, order, per_page, page=page, cursor=parsed_args.get("cursor")
+            )
+        except ValueError:
+            return {"message": "Invalid cursor"}, 400
 
         # TODO: investigate additional metadata for image json response
         # for image in images:
@@ -513,11 +453,7 @@ class DatasetDataId(Resource):
 
         #     images_json.append(image_json)
 
-        subdirectories = [
-            f
-            for f in sorted(os.listdir(directory))
-            if os.path.isdir(directory + f) and not f.startswith(".")
-        ]
+        subdirectories, subdirectory_counts = _subdirectories(folder_model, directory)
 
         categories = CategoryModel.objects(id__in=dataset.categories).only("id", "name")
 
@@ -527,14 +463,36 @@ class DatasetDataId(Resource):
             "pages": pages,
             "page": page,
             "images": images_json,
+            "next_cursor": next_cursor,
             "folder": folder,
             "directory": directory,
             "dataset": api_bridge.queryset_to_json(dataset),
             "categories": api_bridge.queryset_to_json(categories),
             "subdirectories": subdirectories,
+            "subdirectory_counts": subdirectory_counts,
         }
 
 
+def _subdirectories(folder_model, directory):
+    """
+    Names of the subfolders shown by the dataset browser, with their image counts when
+    listed from the folder index rather than the filesystem
+    """
+    if folder_model is None:
+        subdirectories = [
+            f
+            for f in sorted(os.listdir(directory))
+            if os.path.isdir(directory + f) and not f.startswith(".")
+        ]
+        return subdirectories, None
+
+    subfolders = FolderModel.objects(
+        dataset_id=folder_model.dataset_id, parent=folder_model.path
+    ).order_by("name")
+    counts = {subfolder.name: subfolder.num_images for subfolder in subfolders}
+    return list(counts), counts
+
+
 @api.route("/<int:dataset_id>/exports")
 class DatasetExports(Resource):
 
@@ -607,7 +565,7 @@ class DatasetExport(Resource):
         if dataset is None:
             return {"message": "Invalid dataset ID"}, 400
 
-        return import_coco(dataset, json.load(coco))
+        return import_coco(dataset, coco)
 
 
 @api.route("/<int:dataset_id>/coco")
@@ -626,7 +584,10 @@ class DatasetCoco(Resource):
                 "message": "You do not have permission to download the dataset's annotations"
             }, 403
 
-        return coco_util.get_dataset_coco(dataset)
+        return Response(
+            stream_with_context(coco_util.iter_dataset_coco(dataset)),
+            mimetype="application/json",
+        )
 
     @api.expect(coco_upload)
     @login_required
@@ -639,7 +600,7 @@ class DatasetCoco(Resource):
         if dataset is None:
             return {"message": "Invalid dataset ID"}, 400
 
-        return import_coco(dataset, json.load(coco))
+        return import_coco(dataset, coco)
 
 
 # TODO: CocoImportModel is not defined, determine what to do with this api
@@ -662,12 +623,14 @@ class DatasetCoco(Resource):
 @api.route("/<int:dataset_id>/scan")
 class DatasetScan(Resource):
 
+    @api.expect(scan_args)
     @login_required
     def get(self, dataset_id):
+        args = scan_args.parse_args()
 
         dataset = DatasetModel.objects(id=dataset_id).first()
 
         if not dataset:
             return {"message": "Invalid dataset ID"}, 400
 
-        return scan(dataset)
+        return scan(dataset, full=args["full"])
@@ -2,17 +2,27 @@ import datetime
 import io
 import os
 
-from flask import send_file
+from flask import request, send_file
 from flask_login import current_user, login_required
-from flask_restx import Namespace, Resource, reqparse
+from flask_restx import Namespace, Resource, inputs, reqparse
 from mongoengine.errors import NotUniqueError
 from PIL import Image
 from werkzeug.datastructures import FileStorage
 
-from adumbra.database import AnnotationModel, DatasetModel, ImageModel
-from adumbra.services.thumbnail import open_thumbnail
-from adumbra.util import api_bridge
-from adumbra.webserver.util import coco_util
+from adumbra.config import CONFIG
+from adumbra.database import (
+    AnnotationModel,
+    DatasetModel,
+    FolderModel,
+    ImageModel,
+    revision_filter,
+)
+from adumbra.database.counters import add_dataset_images, remove_dataset_image
+from adumbra.services.image_cache import ImageCache
+from adumbra.services.thumbnail import get_image_file
+from adumbra.services.tiles import get_tile_path, has_tiles, tile_info
+from adumbra.util.cache import TTLCache
+from adumbra.webserver.util import coco_util, query_util
 from adumbra.webserver.util.images import (
     copy_image_annotations,
     generate_segmented_image,
@@ -25,6 +35,12 @@ image_all = reqparse.RequestParser()
 image_all.add_argument("fields", required=False, type=str)
 image_all.add_argument("page", default=1, type=int)
 image_all.add_argument("per_page", default=50, type=int, required=False)
+image_all.add_argument(
+    "cursor", help="Cursor returned as next_cursor; takes precedence over page"
+)
+image_all.add_argument(
+    "total", default=True, type=inputs.boolean, help="Count all images"
+)
 
 image_upload = reqparse.RequestParser()
 image_upload.add_argument(
@@ -49,6 +65,25 @@ copy_annotations.add_argument(
     default=None,
     help="Categories to copy",
 )
+copy_annotations.add_argument(
+    "revision",
+    location="json",
+    type=int,
+    required=False,
+    help="Revision of the target image the copy is based on",
+)
+
+image_neighbors = reqparse.RequestParser()
+image_neighbors.add_argument(
+    "count", default=5, type=int, help="Number of neighbors on each side"
+)
+image_neighbors.add_argument("folder", default="", help="Folder being browsed")
+image_neighbors.add_argument("order", default="file_name", help="Order of the images")
+
+neighbors_cache = TTLCache(CONFIG.neighbor_cache_ttl)
+image_cache = ImageCache(
+    CONFIG.get_image_cache_directory(), CONFIG.image_cache.max_size
+)
 
 
 @api.route("/")
@@ -63,21 +98,31 @@ class Images(Resource):
         page = args["page"] - 1
         fields = args.get("fields", "")
 
-        images = current_user.images.filter(deleted=False)
-        total = images.count()
-        pages = int(total / per_page) + 1
+        images = current_user.images.filter(deleted=False).order_by("id")
+
+        total = pages = None
+        if args.get("total"):
+            total = images.count()
+            pages = int(total / per_page) + 1
 
-        images = images.skip(page * per_page).limit(per_page)
         if fields:
             images = images.only(*fields.split(","))
 
+        try:
+            images_json, next_cursor = query_util.paginate(
+                images, "id", per_page, page=page, cursor=args.get("cursor")
+            )
+        except ValueError:
+            return {"message": "Invalid cursor"}, 400
+
         return {
             "total": total,
             "pages": pages,
             "page": page,
             "fields": fields,
             "per_page": per_page,
-            "images": api_bridge.queryset_to_json(images.all()),
+            "images": images_json,
+            "next_cursor": next_cursor,
         }
 
     @api.expect(image_upload)
@@ -106,7 +151,12 @@ class Images(Resource):
         image.close()
         pil_image.close()
         try:
-            db_image = ImageModel.create_from_path(path, dataset_id).save()
+            db_image = ImageModel.create_from_path(
+                path, dataset_id, directory=directory
+            ).save()
+            add_dataset_images(dataset_id, [db_image.id])
+            FolderModel.count_image(db_image)
+            DatasetModel.mark_modified(dataset_id)
         except NotUniqueError:
             db_image = ImageModel.objects.get(path=path)
         return db_image.id
@@ -163,33 +213,27 @@ class ImageId(Resource):
         if image is None:
             return {"success": False}, 400
 
-        width = args.get("width")
-        height = args.get("height")
-
-        if not width:
-            width = image.width
-        if not height:
-            height = image.height
-
         # Show thumbnail if available and requested
         # Otherwise show full image
-        if thumbnail:
-            image_thumbnail = open_thumbnail(image.path)
-            if image_thumbnail is not None:
-                pil_image = image_thumbnail
-            else:
-                pil_image = Image.open(image.path)
-        else:
-            pil_image = Image.open(image.path)
-
-        pil_image.thumbnail((width, height), Image.Resampling.LANCZOS)
-        image_io = io.BytesIO()
-        pil_image = pil_image.convert("RGB")
-        pil_image.save(image_io, "JPEG", quality=90)
-        image_io.seek(0)
+        path = get_image_file(
+            image.path,
+            args.get("width"),
+            args.get("height"),
+            thumbnail=thumbnail,
+            cache=image_cache,
+            image_size=(image.width, image.height),
+        )
 
+        # Files are validated by their modification time and size (ETag and
+        # Last-Modified), so unchanged images are answered with a 304. Thumbnails are
+        # redrawn as annotations change and always revalidate.
         return send_file(
-            image_io, download_name=image.file_name, as_attachment=as_attachment
+            path,
+            download_name=image.file_name,
+            as_attachment=as_attachment,
+            # Thumbnails and resized copies are always JPEGs
+            mimetype=None if path == image.path else "image/jpeg",
+            max_age=None if thumbnail else CONFIG.image_cache_max_age,
         )
 
     @login_required
@@ -203,6 +247,8 @@ class ImageId(Resource):
             return {"message": "You do not have permission to download the image"}, 403
 
         image.update(set__deleted=True, set__deleted_date=datetime.datetime.now())
+        DatasetModel.mark_modified(image.dataset_id)
+        remove_dataset_image(image)
         return {"success": True}
 
 
@@ -232,11 +278,117 @@ class ImageCopyAnnotations(Resource):
                 DatasetModel.objects(id=image_from.dataset_id).first().categories
             )
 
+        # Claim the target image's next revision, so a client working from a stale
+        # view of it gets a conflict instead of silently mixing annotations
+        target = ImageModel.objects(id=image_to.id)
+        if args.get("revision") is not None:
+            target = target.filter(__raw__=revision_filter(args.get("revision")))
+        image_to = target.modify(new=True, inc__revision=1)
+        if image_to is None:
+            return {
+                "success": False,
+                "message": "Image was modified by another user",
+            }, 409
+
         query = AnnotationModel.objects(
             image_id=image_from.id, category_id__in=category_ids, deleted=False
         )
 
-        return {"annotations_created": copy_image_annotations(image_to, query)}
+        annotations_created = copy_image_annotations(image_to, query)
+        DatasetModel.mark_modified(image_to.dataset_id)
+
+        return {
+            "annotations_created": annotations_created,
+            "version": image_to.revision,
+        }
+
+
+@api.route("/<int:image_id>/neighbors")
+class ImageNeighbors(Resource):
+
+    @api.expect(image_neighbors)
+    @login_required
+    def get(self, image_id):
+        """
+        Returns the images before and after this one, nearest first, as shown by the
+        dataset browser. Extra arguments are applied as the browser's filters.
+        """
+        args = image_neighbors.parse_args()
+        count = min(max(args.get("count"), 1), 100)
+        order = args.get("order")
+        folder = query_util.normalize_folder(args.get("folder"))
+        filters = query_util.image_filters(dict(request.args), args)
+
+        # pylint: disable-next=no-member
+        if order.lstrip("-") not in ImageModel._fields:
+            return {"message": "Invalid order"}, 400
+
+        image = current_user.images.filter(id=image_id, deleted=False).first()
+        if image is None:
+            return {"message": "Invalid image id"}, 400
+
+        dataset = DatasetModel.objects(id=image.dataset_id).only("directory").first()
+        directory = os.path.join(dataset.directory, folder)
+
+        if FolderModel.is_indexed(image.dataset_id):
+            query = query_util.image_query(
+                image.dataset_id, directory, filters, folder=folder
+            )
+        else:
+            query = query_util.image_query(image.dataset_id, directory, filters)
+
+        def find_neighbors():
+            images = current_user.images.filter(query)
+            previous, following = query_util.image_neighbors(
+                images, image, order, count
+            )
+            return {"previous": previous, "next": following}
+
+        key = (current_user.username, image_id, count, order, directory, str(filters))
+        return neighbors_cache.get_or_set(key, find_neighbors)
+
+
+@api.route("/<int:image_id>/tiles")
+class ImageTiles(Resource):
+
+    @login_required
+    def get(self, image_id):
+        """
+        Describes the tile pyramid of an image, or reports that it has none yet (small
+        images, or a pyramid still being built) and must be loaded whole
+        """
+        image = current_user.images.filter(id=image_id, deleted=False).first()
+        if image is None:
+            return {"message": "Invalid image id"}, 400
+
+        if not has_tiles(image.path):
+            return {"tiled": False}
+
+        return {
+            "tiled": True,
+            "url": f"/api/image/{image.id}/tiles/{{z}}/{{x}}/{{y}}",
+            **tile_info(image.width, image.height),
+        }
+
+
+@api.route("/<int:image_id>/tiles/<int:level>/<int:column>/<int:row>")
+class ImageTile(Resource):
+
+    @login_required
+    def get(self, image_id, level, column, row):
+        """Returns one tile of the pyramid of an image"""
+        image = current_user.images.filter(id=image_id, deleted=False).first()
+        if image is None:
+            return {"message": "Invalid image id"}, 400
+
+        path = get_tile_path(image.path, level, column, row)
+        if not os.path.isfile(path):
+            return {"message": "Tile does not exist"}, 404
+
+        # Tiles only change with the image, which changes their ETag
+        return send_file(
+            path, mimetype="image/jpeg", max_age=CONFIG.image_cache_max_age
+        )
 
 
 @api.route("/<int:image_id>/coco")
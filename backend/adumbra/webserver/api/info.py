@@ -1,7 +1,9 @@
+from flask_login import login_required
 from flask_restx import Namespace, Resource
 
 from adumbra.config import CONFIG
 from adumbra.database import TaskModel, UserModel
+from adumbra.webserver.api.images import image_cache
 from adumbra.workers.tasks import long_task
 
 api = Namespace("info", description="Software related operations")
@@ -24,6 +26,15 @@ class Info(Resource):
         }
 
 
+@api.route("/image_cache")
+class InfoImageCache(Resource):
+
+    @login_required
+    def get(self):
+        """Returns the usage of the resized image cache and its hit/miss counters"""
+        return image_cache.usage()
+
+
 @api.route("/long_task")
 class TaskTest(Resource):
     def get(self):
@@ -1,11 +1,22 @@
+import math
+
 from flask_login import login_required
-from flask_restx import Namespace, Resource
+from flask_restx import Namespace, Resource, reqparse
 
-from adumbra.database import TaskModel
+from adumbra.database import TaskLogModel, TaskModel
 from adumbra.util import api_bridge
 
 api = Namespace("tasks", description="Task related operations")
 
+page_logs = reqparse.RequestParser()
+page_logs.add_argument(
+    "level",
+    choices=("INFO", "WARNING", "ERROR"),
+    help="Only return the log lines of this level",
+)
+page_logs.add_argument("page", default=1, type=int)
+page_logs.add_argument("limit", default=1000, type=int)
+
 
 @api.route("/")
 class Task(Resource):
@@ -46,11 +57,42 @@ class TaskId(Resource):
 
 @api.route("/<int:task_id>/logs")
 class TaskIdLogs(Resource):
+    @api.expect(page_logs)
     @login_required
     def get(self, task_id):
-        """Deletes task"""
-        task = TaskModel.objects(id=task_id).first()
+        """Returns a page of the log lines of a task, oldest first"""
+        args = page_logs.parse_args()
+        page = max(args["page"], 1)
+        limit = max(args["limit"], 1)
+
+        task = TaskModel.objects(id=task_id).only("id", "logs").first()
         if task is None:
             return {"message": "Invalid task id"}, 400
 
-        return {"logs": task.logs}
+        if task.logs:
+            # Tasks created before logs had their own collection
+            logs = (
+                [line for line in task.logs if f"[{args['level']}]" in line]
+                if args["level"]
+                else task.logs
+            )
+            total = len(logs)
+            logs = logs[(page - 1) * limit : page * limit]
+        else:
+            lines = TaskLogModel.objects(task_id=task_id)
+            if args["level"]:
+                lines = lines.filter(level=args["level"])
+            total = lines.count()
+            logs = (
+                lines.order_by("id")
+                .skip((page - 1) * limit)
+                .limit(limit)
+                .scalar("message")
+            )
+
+        return {
+            "logs": list(logs),
+            "total": total,
+            "page": page,
+            "pages": math.ceil(total / limit),
+        }
@@ -5,7 +5,14 @@ import shutil
 from flask_login import login_required
 from flask_restx import Namespace, Resource, reqparse
 
-from adumbra.database import AnnotationModel, CategoryModel, DatasetModel, ImageModel
+from adumbra.database import (
+    AnnotationModel,
+    CategoryModel,
+    DatasetModel,
+    FolderModel,
+    ImageModel,
+)
+from adumbra.database.counters import add_dataset_images, inc_category_counters
 
 api = Namespace("undo", description="Undo related operations")
 
@@ -80,6 +87,20 @@ class UndoRoot(Resource):
 
         model_object.update(set__deleted=False)
 
+        # Restored images and annotations count towards their dataset again
+        if getattr(model_object, "dataset_id", None) is not None:
+            DatasetModel.mark_modified(model_object.dataset_id)
+
+        if model_object.deleted and isinstance(model_object, ImageModel):
+            add_dataset_images(
+                model_object.dataset_id,
+                [model_object.id],
+                annotated=int(model_object.annotated),
+            )
+            FolderModel.count_image(model_object)
+        elif model_object.deleted and isinstance(model_object, AnnotationModel):
+            inc_category_counters({model_object.category_id: 1})
+
         return {"success": True}
 
     @api.expect(model_data)
@@ -1,14 +1,18 @@
+from collections import defaultdict
+
 import numpy as np
 from pycocotools import mask
 from shapely.geometry import LineString
 
+from adumbra.config import CONFIG
+from adumbra.constants import COCO_PROPERTIES
 from adumbra.database import (
     AnnotationModel,
     CategoryModel,
     DatasetModel,
     ImageModel,
-    fix_ids,
 )
+from adumbra.util import coco_stream
 
 
 def paperjs_to_coco(image_width, image_height, paperjs):
@@ -221,132 +225,93 @@ def get_annotations_iou(annotation_a, annotation_b):
 
 def get_image_coco(image_id):
     """
-    Generates coco for an image
+    Generates coco for an image. The image's annotations are fetched with one query
+    and bucketed by category in memory, so the number of queries does not depend on
+    how many categories the dataset has.
 
     :param image: ImageModel
     :return: Coco in dictionary format
     """
-    image = ImageModel.objects(id=image_id).only(*ImageModel.COCO_PROPERTIES)
-
-    image = fix_ids(image)[0]
-    dataset = DatasetModel.objects(id=image.get("dataset_id")).first()
+    image = (
+        ImageModel.objects(id=image_id)
+        .only(*COCO_PROPERTIES["image"])
+        .as_pymongo()
+        .first()
+    )
+    image = coco_stream.rename_id(image)
+    dataset = (
+        DatasetModel.objects(id=image.get("dataset_id")).only("categories").first()
+    )
 
-    bulk_categories = CategoryModel.objects(
-        id__in=dataset.categories, deleted=False
-    ).only(*CategoryModel.COCO_PROPERTIES)
+    db_annotations = AnnotationModel.objects(deleted=False, image_id=image_id).only(
+        *AnnotationModel.COCO_PROPERTIES
+    )
 
-    print(bulk_categories)
+    annotations_by_category = defaultdict(list)
+    for annotation in db_annotations.as_pymongo():
+        annotations_by_category[annotation.get("category_id")].append(annotation)
+
+    # Only categories of the dataset that have annotations on this image are serialized
+    category_ids = [
+        category_id
+        for category_id in dataset.categories
+        if category_id in annotations_by_category
+    ]
+    bulk_categories = CategoryModel.objects(id__in=category_ids, deleted=False).only(
+        *CategoryModel.COCO_PROPERTIES
+    )
+    categories_by_id = {
+        category["_id"]: category for category in bulk_categories.as_pymongo()
+    }
 
-    db_annotations = AnnotationModel.objects(deleted=False, image_id=image_id)
     categories = []
     annotations = []
 
-    for category in fix_ids(bulk_categories):
-
-        category_annotations = db_annotations.filter(
-            category_id=category.get("id")
-        ).only(*AnnotationModel.COCO_PROPERTIES)
-
-        if category_annotations.count() == 0:
+    for category_id in category_ids:
+        category = categories_by_id.get(category_id)
+        if category is None:
             continue
 
-        category_annotations = fix_ids(category_annotations)
-        for annotation in category_annotations:
-
-            has_segmentation = len(annotation.get("segmentation", [])) > 0
-            has_keypoints = len(annotation.get("keypoints", [])) > 0
-
-            if has_segmentation or has_keypoints:
-
-                if has_keypoints:
-                    arr = np.array(annotation.get("keypoints", []))
-                    arr = arr[2::3]
-                    annotation["num_keypoints"] = len(arr[arr > 0])
-
+        for annotation in annotations_by_category[category_id]:
+            annotation = coco_stream.coco_annotation(annotation)
+            if annotation is not None:
                 annotations.append(annotation)
 
-        if len(category.get("keypoint_labels")) > 0:
-            category["keypoints"] = category.pop("keypoint_labels")
-            category["skeleton"] = category.pop("keypoint_edges")
-        else:
-            del category["keypoint_edges"]
-            del category["keypoint_labels"]
-
-        categories.append(category)
+        categories.append(coco_stream.coco_category(category))
 
     coco = {"images": [image], "categories": categories, "annotations": annotations}
 
     return coco
 
 
-def get_dataset_coco(dataset):
+def iter_dataset_coco(dataset):
     """
-    Generates coco for all images in dataset
+    Generates coco for all images in dataset. Annotations are scoped to the dataset and
+    fetched in batches of images, and the document is produced piece by piece so it can
+    be streamed to the client.
 
     :param dataset: DatasetModel
-    :return: Coco in dictionary format
+    :return: Iterator over chunks of the coco document in JSON format
     """
-
+    # Only the COCO fields, like exports, so internal fields are never serialized
     categories = (
-        CategoryModel.objects(deleted=False)
-        .exclude("deleted_date")
-        .in_bulk(dataset.categories)
-        .items()
+        CategoryModel.objects(id__in=dataset.categories, deleted=False)
+        .only(*CategoryModel.COCO_PROPERTIES)
+        .as_pymongo()
     )
-
-    dataset = fix_ids(dataset)
-
-    images = ImageModel.objects(deleted=False, dataset_id=dataset.get("id")).exclude(
-        "deleted_date"
+    images = ImageModel.objects(deleted=False, dataset_id=dataset.id).only(
+        *COCO_PROPERTIES["image"]
     )
-    all_annotations = AnnotationModel.objects(deleted=False).exclude(
-        "deleted_date", "paper_object"
+    annotations = AnnotationModel.objects(deleted=False, dataset_id=dataset.id).only(
+        *AnnotationModel.COCO_PROPERTIES
     )
 
-    coco = {"images": [], "categories": [], "annotations": []}
-
-    for category in categories:
-        category = fix_ids(category[1])
-
-        del category["deleted"]
-        if len(category.get("keypoint_labels", [])) > 0:
-            category["keypoints"] = category.pop("keypoint_labels")
-            category["skeleton"] = category.pop("keypoint_edges")
-        else:
-            del category["keypoint_edges"]
-            del category["keypoint_labels"]
-
-        coco.get("categories").append(category)
-
-    for image in images:
-        annotations = all_annotations.filter(image_id=image.id)
-        if annotations.count() == 0:
-            continue
-
-        annotations = fix_ids(annotations.all())
-
-        for annotation in annotations:
-
-            has_keypoints = len(annotation.get("keypoints", [])) > 0
-            has_segmentation = len(annotation.get("segmentation", [])) > 0
-
-            if has_keypoints or has_segmentation:
-                del annotation["deleted"]
-
-                if not has_keypoints:
-                    del annotation["keypoints"]
-                else:
-                    arr = np.array(annotation.get("keypoints", []))
-                    arr = arr[2::3]
-                    annotation["num_keypoints"] = len(arr[arr > 0])
-
-                coco.get("annotations").append(annotation)
-
-        image = fix_ids(image)
-        del image["deleted"]
-        coco.get("images").append(image)
-
-    return coco
+    return coco_stream.iter_coco_json(
+        [coco_stream.coco_category(category) for category in categories],
+        coco_stream.iter_images_with_annotations(
+            images, annotations, batch_size=CONFIG.coco.export_batch_size
+        ),
+    )
 
 
 def _fit(value, max_value, min_value):
@@ -1,3 +1,7 @@
+from collections import Counter
+
+from adumbra.database.categories import CategoryModel
+from adumbra.database.counters import inc_category_counters
 from adumbra.database.images import AnnotationModel
 from adumbra.services.thumbnail import create_thumbnail
 
@@ -6,8 +10,13 @@ def generate_segmented_image(image):
     """
     Generates segmented image
     """
-    annotations = AnnotationModel.objects(image_id=image.id, deleted=False).all()
-    pil_image = create_thumbnail(image.path, annotations)
+    annotations = AnnotationModel.objects(image_id=image.id, deleted=False).only(
+        "category_id", "color", "segmentation", "bbox", "area"
+    )
+    categories = CategoryModel.objects.only("name", "color").in_bulk(
+        annotations.distinct("category_id")
+    )
+    pil_image = create_thumbnail(image.path, annotations, categories, box=None)
     pil_image = pil_image.convert("RGB")
 
     return pil_image
@@ -23,6 +32,7 @@ def copy_image_annotations(image, annotations):
         "events"
     )
 
+    copied = Counter()
     for annotation in annotations:
         if annotation.area > 0 or len(annotation.keypoints) > 0:
             clone = annotation.clone()
@@ -31,5 +41,8 @@ def copy_image_annotations(image, annotations):
             clone.image_id = image.id
 
             clone.save(copy=True)
+            copied[clone.category_id] += 1
+
+    inc_category_counters(copied)
 
     return annotations.count()
@@ -0,0 +1,256 @@
+import base64
+import binascii
+import json
+import typing as t
+
+from bson import json_util
+from mongoengine import Q
+
+from adumbra.util.api_bridge import queryset_to_json
+
+if t.TYPE_CHECKING:
+    from mongoengine import QuerySet
+
+    from adumbra.database import ImageModel
+
+
+def normalize_folder(folder: str) -> str:
+    """Strips the leading slash of a dataset folder and makes it end with one"""
+    if len(folder) > 0:
+        folder = folder[0].strip("/") + folder[1:]
+        if folder[-1] != "/":
+            folder = folder + "/"
+    return folder
+
+
+def image_filters(args: dict, parsed_args: t.Iterable[str]) -> dict:
+    """
+    Collects the image filters of the dataset browser from request arguments, i.e.
+    every argument that is not in `parsed_args`
+    """
+    query = {}
+    for key, value in args.items():
+        if key in parsed_args:
+            continue
+
+        lower = value.lower()
+        if lower in ["true", "false"]:
+            value = json.loads(lower)
+
+        if len(lower) != 0:
+            query[key] = value
+
+    # Change category_ids__in to list
+    if "category_ids__in" in query:
+        query["category_ids__in"] = [
+            int(x) for x in query["category_ids__in"].split(",")
+        ]
+
+    return query
+
+
+def image_query(
+    dataset_id: int, directory: str, query: dict, folder: t.Optional[str] = None
+) -> Q:
+    """
+    Builds the mongo query selecting the images shown by the dataset browser. Images
+    are matched on their indexed `folders` when `folder` is given, and by path prefix
+    otherwise (datasets whose folders were not indexed yet).
+    """
+    # Initialize mongo query with required elements:
+    query_build = Q(dataset_id=dataset_id)
+    if folder is not None:
+        query_build &= Q(folders=folder)
+    else:
+        query_build &= Q(path__startswith=directory)
+    query_build &= Q(deleted=False)
+
+    # Define query names that should use complex logic:
+    complex_query = ["annotated", "category_ids__in"]
+
+    # Add additional 'and' arguments to mongo query that do not require complex_query logic
+    for key in query.keys():
+        if key not in complex_query:
+            query_dict = {}
+            query_dict[key] = query[key]
+            query_build &= Q(**query_dict)
+
+    # Add additional arguments to mongo query that require more complex logic to construct
+    if "annotated" in query.keys():
+
+        if "category_ids__in" in query.keys() and query["annotated"]:
+
+            # Only show annotated images with selected category_ids
+            query_dict = {}
+            query_dict["category_ids__in"] = query["category_ids__in"]
+            query_build &= Q(**query_dict)
+
+        else:
+
+            # Only show non-annotated images
+            query_dict = {}
+            query_dict["annotated"] = query["annotated"]
+            query_build &= Q(**query_dict)
+
+    elif "category_ids__in" in query.keys():
+
+        # Ahow annotated images with selected category_ids or non-annotated images
+        query_dict_1 = {}
+        query_dict_1["category_ids__in"] = query["category_ids__in"]
+
+        query_dict_2 = {}
+        query_dict_2["annotated"] = False
+        query_build &= Q(**query_dict_1) | Q(**query_dict_2)
+
+    return query_build
+
+
+def image_order(order: str) -> tuple[str, ...]:
+    """
+    Sort keys for an image ordering; ties are broken by id in the same direction so the
+    order is total and usable for keyset navigation
+    """
+    if order.lstrip("-") == "id":
+        return (order,)
+    return order, "-id" if order.startswith("-") else "id"
+
+
+def keyset_filter(order: str, value: t.Any, last_id: int, after: bool = True) -> Q:
+    """
+    Matches the documents sorted (see `image_order`) after, or before, the document with
+    sort key `value` and id `last_id`
+    """
+    field = order.lstrip("-")
+    if order.startswith("-"):
+        after = not after
+
+    operator = "gt" if after else "lt"
+    if field == "id":
+        return Q(**{f"id__{operator}": last_id})
+
+    return Q(**{f"{field}__{operator}": value}) | Q(
+        **{field: value, f"id__{operator}": last_id}
+    )
+
+
+def encode_cursor(order: str, doc: dict) -> str:
+    """
+    Opaque cursor pointing after `doc`, a JSON document as returned by
+    `queryset_to_json`, in a listing sorted by `order`
+    """
+    key = {"o": order, "v": doc.get(order.lstrip("-")), "i": doc["id"]}
+    return base64.urlsafe_b64encode(json_util.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str, order: str) -> tuple[t.Any, int]:
+    """
+    Sort key and id encoded by `encode_cursor`. Raises `ValueError` if the cursor is
+    malformed or was created for another order.
+    """
+    try:
+        key = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+    if not isinstance(key, dict) or key.get("o") != order or "i" not in key:
+        raise ValueError("Invalid cursor")
+
+    return key.get("v"), key["i"]
+
+
+def paginate(
+    objects: "QuerySet",
+    order: str,
+    per_page: int,
+    page: int = 0,
+    cursor: str | None = None,
+) -> tuple[list[dict], str | None]:
+    """
+    Returns one page of `objects`, already sorted by `image_order(order)`, as JSON.
+
+    With a `cursor` the page continues right after the document the cursor points
+    to, which an index answers directly; otherwise the first `page * per_page`
+    documents are skipped, which gets slower the deeper the page.
+
+    Parameters
+    ----------
+    objects
+        Sorted queryset to paginate; it must load the `order` field
+    order
+        Field the queryset is sorted by, prefixed with `-` for descending order
+    per_page
+        Number of documents in a page
+    page
+        0-indexed page number, used when there is no cursor
+    cursor
+        Cursor returned for the previous page
+
+    Returns
+    -------
+    tuple[list[dict], str | None]
+        The documents of the page and the cursor of the next page, None on the last
+        page
+
+    Raises
+    ------
+    ValueError
+        If the cursor is invalid for `order`
+    """
+    if cursor:
+        value, last_id = decode_cursor(cursor, order)
+        objects = objects.filter(keyset_filter(order, value, last_id))
+    else:
+        objects = objects.skip(page * per_page)
+
+    # One extra document tells whether there is a next page
+    docs = queryset_to_json(objects.limit(per_page + 1))
+    if len(docs) <= per_page:
+        return docs, None
+
+    docs = docs[:per_page]
+    return docs, encode_cursor(order, docs[-1])
+
+
+def image_neighbors(
+    images: "QuerySet", image: "ImageModel", order: str, count: int
+) -> tuple[list[dict], list[dict]]:
+    """
+    Finds up to `count` images before and after `image` in `images` sorted by `order`.
+
+    Rather than counting or skipping through the sorted images, each side is fetched
+    with one range query starting at the image's sort key, which an index on the
+    filtered and sorted fields can answer directly.
+
+    Parameters
+    ----------
+    images
+        Queryset of the images to navigate, e.g. filtered with `image_query`
+    image
+        The current image; it does not need to match `images`
+    order
+        Field to sort by, prefixed with `-` for descending order
+    count
+        Number of neighbors to return on each side
+
+    Returns
+    -------
+    tuple[list[dict], list[dict]]
+        The previous and next images as `{"id": ..., "file_name": ...}`, nearest first
+    """
+    value = image[order.lstrip("-")]
+    after = keyset_filter(order, value, image.id)
+    before = keyset_filter(order, value, image.id, after=False)
+
+    reverse = order[1:] if order.startswith("-") else f"-{order}"
+
+    def fetch(query, sort):
+        found = (
+            images.filter(query)
+            .order_by(*image_order(sort))
+            .only("id", "file_name")
+            .limit(count)
+            .as_pymongo()
+        )
+        return [{"id": doc["_id"], "file_name": doc.get("file_name")} for doc in found]
+
+    return fetch(before, reverse), fetch(after, order)
@@ -0,0 +1,148 @@
+from adumbra.config import CONFIG
+from adumbra.database import AnnotationModel, CategoryModel, ImageModel
+from adumbra.database.users import get_dataset_users
+from adumbra.util.cache import TTLCache
+
+stats_cache = TTLCache(CONFIG.stats_cache_ttl, max_size=256)
+
+
+def _per_image_counts(key):
+    """
+    Pipeline counting annotations and distinct images for every value of `key`, without
+    collecting the image ids of a group into one array
+    """
+    return [
+        {
+            "$group": {
+                "_id": {"key": f"${key}", "image_id": "$image_id"},
+                "count": {"$sum": 1},
+            }
+        },
+        {
+            "$group": {
+                "_id": "$_id.key",
+                "annotations": {"$sum": "$count"},
+                "images": {"$sum": 1},
+            }
+        },
+    ]
+
+
+def _image_totals(dataset):
+    return next(
+        ImageModel.objects(dataset_id=dataset.id, deleted=False).aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": None,
+                        "count": {"$sum": 1},
+                        "annotated": {
+                            "$sum": {"$cond": [{"$eq": ["$annotated", True]}, 1, 0]}
+                        },
+                        "milliseconds": {"$sum": "$milliseconds"},
+                        "average_milliseconds": {"$avg": "$milliseconds"},
+                        "average_width": {"$avg": "$width"},
+                        "average_height": {"$avg": "$height"},
+                    }
+                }
+            ]
+        ),
+        {},
+    )
+
+
+def _annotation_totals(dataset):
+    facets = next(
+        AnnotationModel.objects(dataset_id=dataset.id, deleted=False).aggregate(
+            [
+                {
+                    "$facet": {
+                        "total": [
+                            {
+                                "$group": {
+                                    "_id": None,
+                                    "count": {"$sum": 1},
+                                    "average_area": {"$avg": "$area"},
+                                    "average_milliseconds": {"$avg": "$milliseconds"},
+                                }
+                            }
+                        ],
+                        "categories": _per_image_counts("category_id"),
+                        "users": _per_image_counts("creator"),
+                    }
+                }
+            ],
+            allowDiskUse=True,
+        )
+    )
+    totals = facets["total"][0] if facets["total"] else {}
+    totals["categories"] = {group["_id"]: group for group in facets["categories"]}
+    totals["users"] = {group["_id"]: group for group in facets["users"]}
+    return totals
+
+
+def compute_dataset_stats(dataset):
+    """
+    Computes the statistics shown on the dataset page with one aggregation over the
+    dataset's images and one over its annotations
+    """
+    images = _image_totals(dataset)
+    annotations = _annotation_totals(dataset)
+    users = list(get_dataset_users(dataset).only("username"))
+    category_names = {
+        category["_id"]: category["name"]
+        for category in CategoryModel.objects(id__in=dataset.categories)
+        .only("id", "name")
+        .as_pymongo()
+    }
+
+    empty = {"annotations": 0, "images": 0}
+
+    # Calculate annotation counts by category in this dataset
+    category_count = {}
+    image_category_count = {}
+    for category in dataset.categories:
+        if category not in category_names:
+            continue
+
+        counts = annotations["categories"].get(category, empty)
+        category_count[str(category_names[category])] = counts["annotations"]
+        image_category_count[str(category_names[category])] = counts["images"]
+
+    user_stats = {}
+    for user in users:
+        counts = annotations["users"].get(user.username, empty)
+        user_stats[user.username] = {
+            "annotations": counts["annotations"],
+            "images": counts["images"],
+        }
+
+    return {
+        "total": {
+            "Users": len(users),
+            "Images": images.get("count", 0),
+            "Annotated Images": images.get("annotated", 0),
+            "Annotations": annotations.get("count", 0),
+            "Categories": len(dataset.categories),
+            "Time Annotating (s)": (images.get("milliseconds") or 0) / 1000,
+        },
+        "average": {
+            "Image Size (px)": images.get("average_width") or 0,
+            "Image Height (px)": images.get("average_height") or 0,
+            "Annotation Area (px)": annotations.get("average_area") or 0,
+            "Time (ms) per Image": images.get("average_milliseconds") or 0,
+            "Time (ms) per Annotation": annotations.get("average_milliseconds") or 0,
+        },
+        "categories": category_count,
+        "images_per_category": image_category_count,
+        "users": user_stats,
+    }
+
+
+def get_dataset_stats(dataset):
+    """
+    Returns the dataset's statistics, reusing the last result until the dataset is
+    modified or the cache entry expires
+    """
+    key = (dataset.id, dataset.last_modified)
+    return stats_cache.get_or_set(key, lambda: compute_dataset_stats(dataset))
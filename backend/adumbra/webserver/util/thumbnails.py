@@ -1,5 +1,6 @@
+from adumbra.config import CONFIG
 from adumbra.database import ImageModel
-from adumbra.workers.tasks.thumbnails import thumbnail_generate_single_image
+from adumbra.workers.tasks.thumbnails import queue_thumbnails
 
 
 def generate_thumbnails():
@@ -9,9 +10,12 @@ def generate_thumbnails():
         flush=True,
     )
 
-    for image in ImageModel.objects(regenerate_thumbnail=True).all():
-        generate_thumbnail(image)
+    queue_thumbnails(ImageModel.objects(regenerate_thumbnail=True).scalar("id"))
 
 
 def generate_thumbnail(image):
-    thumbnail_generate_single_image.delay(image.id)
+    """
+    Queues the thumbnail of an image after the debounce delay, coalescing requests
+    made before it is rendered
+    """
+    queue_thumbnails([image.id], countdown=CONFIG.thumbnails.debounce)
@@ -1,7 +1,9 @@
 from celery import Celery
+from celery.signals import task_postrun
 
 from adumbra.config import CONFIG
 from adumbra.database import connect_mongo
+from adumbra.database.tasks import flush_task_logs
 
 connect_mongo("Celery_Worker")
 
@@ -11,5 +13,11 @@ celery = Celery(
 celery.autodiscover_tasks(["adumbra.workers.tasks"])
 
 
+@task_postrun.connect
+def _flush_task_logs(**_):
+    # Log lines are buffered, write what is left once a task returns or raises
+    flush_task_logs()
+
+
 if __name__ == "__main__":
     celery.start()
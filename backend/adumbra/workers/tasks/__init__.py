@@ -1,3 +1,4 @@
+from adumbra.workers.tasks.counters import *
 from adumbra.workers.tasks.data import *
 from adumbra.workers.tasks.scan import *
 from adumbra.workers.tasks.test import *
@@ -0,0 +1,36 @@
+from adumbra.database import CategoryModel, DatasetModel
+from adumbra.database.counters import (
+    refresh_category_counters,
+    refresh_dataset_counters,
+    refresh_folder_counters,
+)
+from adumbra.workers import celery
+
+RECONCILE_CHUNK_SIZE = 100
+
+
+@celery.task
+def reconcile_counters(dataset_ids=None, category_ids=None):
+    """
+    Recomputes the denormalized dataset, folder and category counters, repairing any drift
+    from writes that bypassed the incremental updates. Without arguments every
+    dataset and category is reconciled.
+    """
+    if dataset_ids is None:
+        dataset_ids = DatasetModel.objects(deleted=False).distinct("id")
+    if category_ids is None:
+        category_ids = CategoryModel.objects(deleted=False).distinct("id")
+
+    for i in range(0, len(dataset_ids), RECONCILE_CHUNK_SIZE):
+        refresh_dataset_counters(dataset_ids[i : i + RECONCILE_CHUNK_SIZE])
+
+    for dataset_id in dataset_ids:
+        refresh_folder_counters(dataset_id)
+
+    for i in range(0, len(category_ids), RECONCILE_CHUNK_SIZE):
+        refresh_category_counters(category_ids[i : i + RECONCILE_CHUNK_SIZE])
+
+    return {"datasets": len(dataset_ids), "categories": len(category_ids)}
+
+
+__all__ = ["reconcile_counters"]
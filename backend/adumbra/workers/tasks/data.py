@@ -1,10 +1,11 @@
+import hashlib
 import json
 import os
 import time
 
-import numpy as np
-from mongoengine import Q
+from pymongo import UpdateOne
 
+from adumbra.config import CONFIG
 from adumbra.constants import COCO_PROPERTIES
 from adumbra.database import (
     AnnotationModel,
@@ -13,8 +14,13 @@ from adumbra.database import (
     ExportModel,
     ImageModel,
     TaskModel,
-    fix_ids,
+    insert_many,
 )
+from adumbra.database.counters import (
+    refresh_category_counters,
+    refresh_dataset_counters,
+)
+from adumbra.util import coco_stream
 from adumbra.workers import celery
 from adumbra.workers.socket import create_socket
 
@@ -38,80 +44,46 @@ def export_annotations(task_id, dataset_id, categories, with_empty_images=False)
     db_images = ImageModel.objects(deleted=False, dataset_id=dataset.id).only(
         *COCO_PROPERTIES["image"]
     )
-    db_annotations = AnnotationModel.objects(deleted=False, category_id__in=categories)
-
-    total_items = db_categories.count()
+    db_annotations = AnnotationModel.objects(
+        deleted=False, dataset_id=dataset.id, category_id__in=categories
+    ).only(*AnnotationModel.COCO_PROPERTIES)
 
-    coco = {"images": [], "categories": [], "annotations": []}
-
-    total_items += db_images.count()
+    total_items = db_categories.count() + db_images.count()
     progress = 0
 
-    # iterate though all categoires and upsert
-    category_names = []
-    for category in fix_ids(db_categories):
-
-        if len(category.get("keypoint_labels", [])) > 0:
-            category["keypoints"] = category.pop("keypoint_labels", [])
-            category["skeleton"] = category.pop("keypoint_edges", [])
-        else:
-            if "keypoint_edges" in category:
-                del category["keypoint_edges"]
-            if "keypoint_labels" in category:
-                del category["keypoint_labels"]
+    coco_categories = []
+    for category in db_categories.as_pymongo():
+        category = coco_stream.coco_category(category)
 
         task.info(f"Adding category: {category.get('name')}")
-        coco.get("categories").append(category)
-        category_names.append(category.get("name"))
+        coco_categories.append(category)
 
         progress += 1
         task.set_progress((progress / total_items) * 100, socket=socket)
 
-    total_annotations = db_annotations.count()
-    total_images = db_images.count()
-    for image in db_images:
-        image = fix_ids(image)
+    category_names = [category.get("name") for category in coco_categories]
+    counts = {"images": 0, "annotations": 0}
 
-        progress += 1
-        task.set_progress((progress / total_items) * 100, socket=socket)
-
-        annotations = db_annotations.filter(image_id=image.get("id")).only(
-            *AnnotationModel.COCO_PROPERTIES
+    def tracked_image_groups():
+        nonlocal progress
+        image_groups = coco_stream.iter_images_with_annotations(
+            db_images, db_annotations, batch_size=CONFIG.coco.export_batch_size
         )
-        annotations = fix_ids(annotations)
-
-        if len(annotations) == 0:
-            if with_empty_images:
-                coco.get("images").append(image)
-            continue
-
-        num_annotations = 0
-        for annotation in annotations:
-
-            has_keypoints = len(annotation.get("keypoints", [])) > 0
-            has_segmentation = len(annotation.get("segmentation", [])) > 0
-
-            if has_keypoints or has_segmentation:
+        for image, annotations in image_groups:
+            progress += 1
+            task.set_progress((progress / total_items) * 100, socket=socket)
 
-                if not has_keypoints:
-                    if "keypoints" in annotation:
-                        del annotation["keypoints"]
-                else:
-                    arr = np.array(annotation.get("keypoints", []))
-                    arr = arr[2::3]
-                    annotation["num_keypoints"] = len(arr[arr > 0])
+            if len(annotations) > 0 or with_empty_images:
+                counts["images"] += 1
+                counts["annotations"] += len(annotations)
 
-                num_annotations += 1
-                coco.get("annotations").append(annotation)
+            if progress % CONFIG.coco.export_batch_size == 0:
+                task.info(
+                    f"Exported {counts['annotations']} annotations "
+                    f"from {counts['images']} images so far"
+                )
 
-        task.info(
-            f"Exporting {num_annotations} annotations for image {image.get('id')}"
-        )
-        coco.get("images").append(image)
-
-    task.info(
-        f"Done export {total_annotations} annotations and {total_images} images from {dataset.name}"
-    )
+            yield image, annotations
 
     timestamp = time.time()
     directory = f"{dataset.directory}.exports/"
@@ -122,7 +94,17 @@ def export_annotations(task_id, dataset_id, categories, with_empty_images=False)
 
     task.info(f"Writing export to file {file_path}")
     with open(file_path, mode="w", encoding="utf-8") as fp:
-        json.dump(coco, fp)
+        coco_stream.write_coco(
+            fp,
+            coco_categories,
+            tracked_image_groups(),
+            with_empty_images=with_empty_images,
+        )
+
+    task.info(
+        f"Done export {counts['annotations']} annotations and {counts['images']} "
+        f"images from {dataset.name}"
+    )
 
     task.info("Creating export object")
     export = ExportModel(
@@ -134,7 +116,14 @@ def export_annotations(task_id, dataset_id, categories, with_empty_images=False)
 
 
 @celery.task
-def import_annotations(task_id, dataset_id, coco_json):
+def import_annotations(task_id, dataset_id, coco_path, bulk=None):
+    """
+    Imports a COCO file previously spooled to disk. The file is parsed incrementally,
+    one section at a time, and removed once the import is over.
+    """
+
+    if bulk is None:
+        bulk = CONFIG.coco.import_bulk
 
     task = TaskModel.objects.get(id=task_id)
     dataset = DatasetModel.objects.get(id=dataset_id)
@@ -144,28 +133,43 @@ def import_annotations(task_id, dataset_id, coco_json):
 
     task.info("Beginning Import")
 
-    images = ImageModel.objects(dataset_id=dataset.id)
-    categories = CategoryModel.objects
+    try:
+        _import_coco_file(task, socket, dataset, coco_path, bulk)
+    finally:
+        if os.path.exists(coco_path):
+            os.remove(coco_path)
+        DatasetModel.mark_modified(dataset.id)
 
-    coco_images = coco_json.get("images", [])
-    coco_annotations = coco_json.get("annotations", [])
-    coco_categories = coco_json.get("categories", [])
+    # Bulk writes are counted once at the end rather than per annotation
+    refresh_dataset_counters([dataset.id])
+    refresh_category_counters(DatasetModel.objects.get(id=dataset.id).categories)
 
-    task.info(
-        f"Importing {len(coco_categories)} categories, "
-        f"{len(coco_images)} images, and "
-        f"{len(coco_annotations)} annotations"
-    )
+    task.set_progress(100, socket=socket)
 
-    total_items = sum([len(coco_categories), len(coco_annotations), len(coco_images)])
-    progress = 0
+
+def _import_coco_file(task, socket, dataset, coco_path, bulk):
+    categories = CategoryModel.objects
+    reader = coco_stream.CocoFileReader(coco_path)
+    sections = ["categories", "images", "annotations"]
+    last_progress = 0
+
+    def read_section(section):
+        """Yields the items of a section, reporting progress through the file"""
+        nonlocal last_progress
+        for item in reader.iter_section(section):
+            yield item
+            passes = sections.index(section) + reader.fraction
+            percent = int(passes / len(sections) * 100)
+            if percent > last_progress:
+                last_progress = percent
+                task.set_progress(percent, socket=socket)
 
     task.info("===== Importing Categories =====")
     # category id mapping  ( file : database )
     categories_id = {}
 
     # Create any missing categories
-    for category in coco_categories:
+    for category in read_section("categories"):
 
         category_name = category.get("name")
         category_id = category.get("id")
@@ -188,44 +192,60 @@ def import_annotations(task_id, dataset_id, coco_json):
         # map category ids
         categories_id[category_id] = category_model.id
 
-        # update progress
-        progress += 1
-        task.set_progress((progress / total_items) * 100, socket=socket)
-
     dataset.update(set__categories=dataset.categories)
 
     task.info("===== Loading Images =====")
+    # Map every file name of the dataset to its image with a single query
+    images_by_name = {}
+    duplicate_names = set()
+    dataset_images = ImageModel.objects(dataset_id=dataset.id).only(
+        "id", "file_name", "width", "height", "dataset_id", "category_ids"
+    )
+    for image in dataset_images.as_pymongo().no_cache():
+        file_name = image.get("file_name")
+        if file_name in images_by_name:
+            duplicate_names.add(file_name)
+        images_by_name[file_name] = image
+
     # image id mapping ( file: database )
     images_id = {}
-    categories_by_image = {}
+    num_images = 0
 
     # Find all images
-    for image in coco_images:
+    for image in read_section("images"):
         image_id = image.get("id")
         image_filename = image.get("file_name")
+        num_images += 1
 
-        # update progress
-        progress += 1
-        task.set_progress((progress / total_items) * 100, socket=socket)
-
-        image_model = images.filter(file_name__exact=image_filename).all()
-
-        if len(image_model) == 0:
+        if image_filename not in images_by_name:
             task.warning(f"Could not find image {image_filename}")
             continue
 
-        if len(image_model) > 1:
+        if image_filename in duplicate_names:
             task.error(
                 f"Too many images found with the same file name: {image_filename}"
             )
             continue
 
-        task.info(f"Image {image_filename} found")
-        image_model = image_model[0]
-        images_id[image_id] = image_model
-        categories_by_image[image_id] = []
+        images_id[image_id] = images_by_name[image_filename]
+
+    task.info(f"Found {len(images_id)} of {num_images} images")
 
     task.info("===== Import Annotations =====")
+    coco_annotations = read_section("annotations")
+    if bulk:
+        _bulk_import_annotations(
+            task, dataset, coco_annotations, images_id, categories_id
+        )
+    else:
+        _import_annotations(task, coco_annotations, images_id, categories_id)
+
+    task.info("===== Updating Images =====")
+    _update_image_annotation_stats(dataset, images_id.values())
+
+
+def _import_annotations(task, coco_annotations, images_id, categories_id):
+    """Creates annotations one at a time, querying for an existing copy of each"""
     for annotation in coco_annotations:
 
         image_id = annotation.get("image_id")
@@ -237,9 +257,6 @@ def import_annotations(task_id, dataset_id, coco_json):
         bbox = annotation.get("bbox", [0, 0, 0, 0])
         isbbox = annotation.get("isbbox", False)
 
-        progress += 1
-        task.set_progress((progress / total_items) * 100, socket=socket)
-
         has_segmentation = len(segmentation) > 0
         has_keypoints = len(keypoints) > 0
         if not has_segmentation and not has_keypoints:
@@ -249,9 +266,8 @@ def import_annotations(task_id, dataset_id, coco_json):
             continue
 
         try:
-            image_model = images_id[image_id]
+            image = images_id[image_id]
             category_model_id = categories_id[category_id]
-            image_categories = categories_by_image[image_id]
         except KeyError:
             task.warning(
                 f"Could not find image assoicated with annotation {annotation.get('id')}"
@@ -259,7 +275,7 @@ def import_annotations(task_id, dataset_id, coco_json):
             continue
 
         annotation_model = AnnotationModel.objects(
-            image_id=image_model.id,
+            image_id=image["_id"],
             category_id=category_model_id,
             segmentation=segmentation,
             keypoints=keypoints,
@@ -268,7 +284,7 @@ def import_annotations(task_id, dataset_id, coco_json):
         if annotation_model is None:
             task.info(f"Creating annotation data ({image_id}, {category_id})")
 
-            annotation_model = AnnotationModel(image_id=image_model.id)
+            annotation_model = AnnotationModel.for_image(image)
             annotation_model.category_id = category_model_id
 
             annotation_model.color = annotation.get("color")
@@ -284,30 +300,204 @@ def import_annotations(task_id, dataset_id, coco_json):
 
             annotation_model.isbbox = isbbox
             annotation_model.save()
-
-            image_categories.append(category_id)
         else:
             annotation_model.update(deleted=False, isbbox=isbbox)
             task.info(f"Annotation already exists (i:{image_id}, c:{category_id})")
 
-    for image_id, image_model in images_id.items():
-        category_ids = categories_by_image[image_id]
-        all_category_ids = list(image_model.category_ids)
-        all_category_ids += category_ids
-
-        num_annotations = AnnotationModel.objects(
-            Q(image_id=image_id)
-            & Q(deleted=False)
-            & (Q(area__gt=0) | Q(keypoints__size__gt=0))
-        ).count()
-
-        image_model.update(
-            set__annotated=True,
-            set__category_ids=list(set(all_category_ids)),
-            set__num_annotations=num_annotations,
+
+def _bulk_import_annotations(task, dataset, coco_annotations, images_id, categories_id):
+    """
+    Creates annotations in batches. Duplicates are detected by comparing hashes against
+    the annotations already in the dataset (loaded with one query), new annotations are
+    written with `insert_many` and existing ones are restored with `bulk_write`.
+    """
+    chunk_size = CONFIG.coco.import_chunk_size
+
+    existing = {}
+    dataset_annotations = AnnotationModel.objects(dataset_id=dataset.id).only(
+        "id", "image_id", "category_id", "segmentation", "keypoints"
+    )
+    for db_annotation in dataset_annotations.as_pymongo().no_cache():
+        key = _annotation_key(
+            db_annotation.get("image_id"),
+            db_annotation.get("category_id"),
+            db_annotation.get("segmentation", []),
+            db_annotation.get("keypoints", []),
+        )
+        existing[key] = db_annotation["_id"]
+
+    task.info(f"Loaded {len(existing)} existing annotations for duplicate detection")
+
+    new_annotations = []
+    restore_operations = []
+    pending = set()
+    counts = {"created": 0, "restored": 0, "skipped": 0}
+
+    def flush():
+        if new_annotations:
+            insert_many(AnnotationModel, new_annotations)
+            counts["created"] += len(new_annotations)
+            new_annotations.clear()
+        if restore_operations:
+            # pylint: disable-next=protected-access
+            AnnotationModel._get_collection().bulk_write(
+                restore_operations, ordered=False
+            )
+            counts["restored"] += len(restore_operations)
+            restore_operations.clear()
+        task.info(
+            f"Created {counts['created']} and restored {counts['restored']} "
+            "annotations so far"
         )
 
-    task.set_progress(100, socket=socket)
+    for annotation in coco_annotations:
+
+        image_id = annotation.get("image_id")
+        category_id = annotation.get("category_id")
+        segmentation = annotation.get("segmentation", [])
+        keypoints = annotation.get("keypoints", [])
+        isbbox = annotation.get("isbbox", False)
+
+        has_segmentation = len(segmentation) > 0
+        has_keypoints = len(keypoints) > 0
+        if not has_segmentation and not has_keypoints:
+            task.warning(
+                f"Annotation {annotation.get('id')} has no segmentation or keypoints"
+            )
+            continue
+
+        try:
+            image = images_id[image_id]
+            category_model_id = categories_id[category_id]
+        except KeyError:
+            task.warning(
+                f"Could not find image assoicated with annotation {annotation.get('id')}"
+            )
+            continue
+
+        key = _annotation_key(image["_id"], category_model_id, segmentation, keypoints)
+
+        if key in pending:
+            counts["skipped"] += 1
+            continue
+
+        if key in existing:
+            restore_operations.append(
+                UpdateOne(
+                    {"_id": existing[key]},
+                    {"$set": {"deleted": False, "isbbox": isbbox}},
+                )
+            )
+        else:
+            annotation_model = AnnotationModel.for_image(
+                image,
+                category_id=category_model_id,
+                color=annotation.get("color"),
+                isbbox=isbbox,
+            )
+
+            if has_segmentation:
+                annotation_model.segmentation = segmentation
+                annotation_model.area = annotation.get("area", 0)
+                annotation_model.bbox = annotation.get("bbox", [0, 0, 0, 0])
+
+            if has_keypoints:
+                annotation_model.keypoints = keypoints
+
+            annotation_model.set_defaults(dataset.default_annotation_metadata)
+            new_annotations.append(annotation_model)
+            pending.add(key)
+
+        if len(new_annotations) + len(restore_operations) >= chunk_size:
+            flush()
+
+    flush()
+
+    if counts["skipped"]:
+        task.info(f"Skipped {counts['skipped']} duplicate annotations in the file")
+
+
+def _annotation_key(image_id, category_id, segmentation, keypoints) -> bytes:
+    """
+    Hash identifying an annotation by image, category and geometry as stored. Like
+    MongoDB's array equality, integers and integral floats are the same number while
+    other values are only equal to themselves.
+    """
+
+    def as_stored(value):
+        if isinstance(value, (list, tuple)):
+            return [as_stored(item) for item in value]
+        if isinstance(value, dict):
+            return {key: as_stored(item) for key, item in value.items()}
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        return value
+
+    payload = json.dumps(
+        [image_id, category_id, as_stored(segmentation), as_stored(keypoints)],
+        separators=(",", ":"),
+    )
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).digest()
+
+
+def _update_image_annotation_stats(dataset, images):
+    """
+    Recomputes `num_annotations`, `category_ids` and `annotated` of the given images
+    from one aggregation over the dataset's annotations.
+    """
+    pipeline = [
+        {
+            "$match": {
+                "dataset_id": dataset.id,
+                "deleted": False,
+                "$or": [{"area": {"$gt": 0}}, {"keypoints.0": {"$exists": True}}],
+            }
+        },
+        {
+            "$group": {
+                "_id": "$image_id",
+                "count": {"$sum": 1},
+                "category_ids": {"$addToSet": "$category_id"},
+            }
+        },
+    ]
+    stats = {
+        row["_id"]: row
+        for row in AnnotationModel.objects.aggregate(pipeline, allowDiskUse=True)
+    }
+
+    operations = []
+    updated = set()
+    for image in images:
+        if image["_id"] in updated:
+            continue
+        updated.add(image["_id"])
+
+        image_stats = stats.get(image["_id"], {})
+        num_annotations = image_stats.get("count", 0)
+        category_ids = set(image.get("category_ids", []))
+        category_ids.update(image_stats.get("category_ids", []))
+
+        operations.append(
+            UpdateOne(
+                {"_id": image["_id"]},
+                {
+                    "$set": {
+                        "annotated": num_annotations > 0,
+                        "category_ids": list(category_ids),
+                        "num_annotations": num_annotations,
+                    }
+                },
+            )
+        )
+        if len(operations) >= CONFIG.coco.import_chunk_size:
+            # pylint: disable-next=protected-access
+            ImageModel._get_collection().bulk_write(operations, ordered=False)
+            operations.clear()
+
+    if operations:
+        # pylint: disable-next=protected-access
+        ImageModel._get_collection().bulk_write(operations, ordered=False)
 
 
 __all__ = ["export_annotations", "import_annotations"]
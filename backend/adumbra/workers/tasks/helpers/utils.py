@@ -1,9 +1,12 @@
+import os
+import tempfile
+
 from adumbra.database.tasks import TaskModel
 from adumbra.workers.tasks.data import export_annotations, import_annotations
 from adumbra.workers.tasks.scan import scan_dataset
 
 
-def scan(dataset):
+def scan(dataset, full=False):
     task = TaskModel(
         name=f"Scanning {dataset.name} for new images",
         dataset_id=dataset.id,
@@ -11,12 +14,22 @@ def scan(dataset):
     )
     task.save()
 
-    cel_task = scan_dataset.delay(task.id, dataset.id)
+    cel_task = scan_dataset.delay(task.id, dataset.id, full)
 
     return {"celery_id": cel_task.id, "id": task.id, "name": task.name}
 
 
-def import_coco(dataset, coco_json):
+def import_coco(dataset, coco_file):
+    """
+    Spools an uploaded COCO file into the dataset's `.imports/` directory and queues
+    its import; only the file path is sent to the worker.
+    """
+    directory = os.path.join(dataset.directory, ".imports")
+    os.makedirs(directory, exist_ok=True)
+    fd, coco_path = tempfile.mkstemp(dir=directory, prefix="coco-", suffix=".json")
+    with os.fdopen(fd, "wb") as spool:
+        coco_file.save(spool)
+
     task = TaskModel(
         name=f"Importing COCO annotations into {dataset.name}",
         dataset_id=dataset.id,
@@ -24,7 +37,7 @@ def import_coco(dataset, coco_json):
     )
     task.save()
 
-    cel_task = import_annotations.delay(task.id, dataset.id, coco_json)
+    cel_task = import_annotations.delay(task.id, dataset.id, coco_path)
 
     return {"celery_id": cel_task.id, "id": task.id, "name": task.name}
 
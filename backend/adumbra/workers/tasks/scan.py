@@ -1,62 +1,501 @@
+import datetime
 import os
+import re
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
+from celery import chord, group
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from adumbra.config import CONFIG
 from adumbra.constants import SUPPORTED_IMAGE_EXTENTIONS
-from adumbra.database import DatasetModel, ImageModel, TaskModel
+from adumbra.database import (
+    DatasetModel,
+    FolderModel,
+    ImageModel,
+    TaskModel,
+    insert_many,
+)
+from adumbra.database.counters import (
+    add_dataset_images,
+    refresh_dataset_counters,
+    refresh_folder_counters,
+)
+from adumbra.database.folders import image_folders
 from adumbra.workers import celery
 from adumbra.workers.socket import create_socket
-from adumbra.workers.tasks.thumbnails import thumbnail_generate_single_image
+from adumbra.workers.tasks.thumbnails import queue_thumbnails
+
+# Folders modified this close to a scan are listed again by the next one, as files
+# added within the same modification time tick would go unnoticed
+RACY_WINDOW = 2.0
+
+# Folders whose images are loaded by one query when comparing them with the disk
+FOLDERS_PER_QUERY = 100
+
+
+@dataclass
+class ScanChanges:
+    """What changed in a dataset directory since its previous scan"""
+
+    # Every folder of the dataset, listed or not
+    folders: set = field(default_factory=set)
+    # Modification time (None if too recent to rely on) and entry count of the
+    # folders that were listed
+    snapshots: dict = field(default_factory=dict)
+    # Size and modification time of the image files of the listed folders
+    files: dict = field(default_factory=dict)
+    # Folders of the previous scan that no longer exist
+    removed_folders: set = field(default_factory=set)
+    # Entries of the folders skipped because they did not change
+    skipped: int = 0
+    # Subfolders deeper than the walk's `max_depth`, which were not visited
+    deferred: set = field(default_factory=set)
+
+    new: list = field(default_factory=list)
+    modified: list = field(default_factory=list)
+    removed: list = field(default_factory=list)
+    # Known images whose size and modification time were never recorded
+    unrecorded: list = field(default_factory=list)
+
+
+def walk_dataset(directory, snapshots=None, full=False, roots=("",), max_depth=None):
+    """
+    Lists the folders of a dataset directory whose modification time changed since
+    their `snapshots` (documents of `FolderModel`), walking through the others by
+    their known subfolders without listing them. Adding, removing or renaming an
+    entry changes a folder's modification time, so only the folders where that
+    happened are listed; `full` lists every folder. Hidden folders, which hold
+    thumbnails, resized copies and tiles, are skipped.
+
+    The walk starts from the `roots` folders and stops at folders `max_depth` levels
+    deep (the dataset root being level 0), leaving their subfolders `deferred`.
+    """
+    snapshots = snapshots or {}
+    subfolders = defaultdict(set)
+    for path, snapshot in snapshots.items():
+        if snapshot.get("parent") is not None:
+            subfolders[snapshot["parent"]].add(path)
+
+    changes = ScanChanges()
+    now = time.time()
+    pending = list(roots)
+
+    def visit(folders):
+        for folder in folders:
+            if max_depth is not None and folder.count("/") > max_depth:
+                changes.deferred.add(folder)
+            else:
+                pending.append(folder)
+
+    while pending:
+        folder = pending.pop()
+        try:
+            mtime = os.stat(os.path.join(directory, folder)).st_mtime
+        except FileNotFoundError:
+            changes.removed_folders.add(folder)
+            continue
+
+        changes.folders.add(folder)
+        snapshot = snapshots.get(folder, {})
+        if not full and snapshot.get("mtime") == mtime:
+            changes.skipped += snapshot.get("entries") or 0
+            visit(subfolders[folder])
+            continue
+
+        with os.scandir(os.path.join(directory, folder)) as entries:
+            entries = list(entries)
+
+        listed = set()
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith("."):
+                    listed.add(f"{folder}{entry.name}/")
+            elif entry.name.endswith(SUPPORTED_IMAGE_EXTENTIONS):
+                stat = entry.stat()
+                changes.files[entry.path] = (stat.st_size, stat.st_mtime)
+
+        changes.snapshots[folder] = (
+            mtime if now - mtime > RACY_WINDOW else None,
+            len(entries),
+        )
+        changes.removed_folders |= subfolders[folder] - listed
+        visit(listed)
+
+    return changes
+
+
+def diff_images(dataset, changes):
+    """
+    Compares the image files of the listed folders with the images of the database,
+    filling in the new, modified and removed images of `changes`. Soft-deleted images
+    are left alone, even when their file is still there.
+    """
+    folders = sorted(changes.snapshots)
+    known = set()
+    for i in range(0, len(folders), FOLDERS_PER_QUERY):
+        patterns = [
+            re.compile(f"^{re.escape(dataset.directory + folder)}[^/]+$")
+            for folder in folders[i : i + FOLDERS_PER_QUERY]
+        ]
+        for image in (
+            ImageModel.objects(
+                dataset_id=dataset.id, __raw__={"path": {"$in": patterns}}
+            )
+            .only("id", "path", "deleted", "file_size", "file_mtime")
+            .as_pymongo()
+        ):
+            path = image["path"]
+            known.add(path)
+            if image.get("deleted"):
+                continue
+
+            if path not in changes.files:
+                changes.removed.append(image["_id"])
+            elif image.get("file_size") is None:
+                size, mtime = changes.files[path]
+                changes.unrecorded.append(
+                    UpdateOne(
+                        {"_id": image["_id"]},
+                        {"$set": {"file_size": size, "file_mtime": mtime}},
+                    )
+                )
+            elif changes.files[path] != (image["file_size"], image.get("file_mtime")):
+                changes.modified.append(path)
+
+    changes.new = [path for path in changes.files if path not in known]
+    return changes
+
+
+def read_image(path, dataset):
+    try:
+        return ImageModel.create_from_path(
+            path, dataset.id, directory=dataset.directory
+        )
+    # TODO: This is a broad exception, should be narrowed down as we see more errors
+    except Exception as e:  # pylint: disable=broad-except
+        print(e)
+        return None
+
+
+def insert_images(images):
+    """
+    Inserts new images with one `insert_many`, returning the ids of those inserted.
+    Images whose path is already in the database (e.g. added by the file watcher
+    meanwhile) are skipped.
+    """
+    if not images:
+        return []
+
+    try:
+        return insert_many(ImageModel, images)
+    except BulkWriteError as error:
+        skipped = {write_error["index"] for write_error in error.details["writeErrors"]}
+        return [image.id for i, image in enumerate(images) if i not in skipped]
+
+
+def create_images(log, dataset, paths, progress=None):
+    """
+    Creates the images of new files in batches, reading their headers in a thread
+    pool, and returns the ids of those created. Messages go to `log`, the scan's
+    `TaskModel` or a logger; `progress` is called with the fraction of files read
+    after each batch.
+    """
+    start = time.perf_counter()
+    image_ids = []
+    batch_size = CONFIG.scan.batch_size
+    with ThreadPoolExecutor(max_workers=CONFIG.scan.threads) as executor:
+        for i in range(0, len(paths), batch_size):
+            batch = paths[i : i + batch_size]
+            images = list(executor.map(lambda path: read_image(path, dataset), batch))
+            for path, image in zip(batch, images):
+                if image is None:
+                    log.warning(f"Could not read {path}")
+
+            inserted = insert_images([image for image in images if image is not None])
+            add_dataset_images(dataset.id, inserted)
+            image_ids.extend(inserted)
+
+            done = i + len(batch)
+            elapsed = time.perf_counter() - start
+            log.info(
+                f"Read {done}/{len(paths)} new file(s), "
+                f"{done / max(elapsed, 1e-6):.0f} file(s)/s"
+            )
+            if progress is not None:
+                progress(done / len(paths))
+
+    return image_ids
+
+
+def refresh_images(log, dataset, paths):
+    """Reads the dimensions of modified files again and regenerates their thumbnails"""
+    if not paths:
+        return
+
+    with ThreadPoolExecutor(max_workers=CONFIG.scan.threads) as executor:
+        images = list(executor.map(lambda path: read_image(path, dataset), paths))
+
+    requests = []
+    for path, image in zip(paths, images):
+        if image is None:
+            log.warning(f"Could not read {path}")
+            continue
+
+        requests.append(
+            UpdateOne(
+                {"path": path},
+                {
+                    "$set": {
+                        "width": image.width,
+                        "height": image.height,
+                        "file_size": image.file_size,
+                        "file_mtime": image.file_mtime,
+                        "regenerate_thumbnail": True,
+                    }
+                },
+            )
+        )
+
+    if requests:
+        # pylint: disable-next=protected-access
+        ImageModel._get_collection().bulk_write(requests, ordered=False)
+
+
+def remove_images(dataset, image_ids, folders):
+    """
+    Soft-deletes the images of removed files and of the removed `folders`, so they
+    can still be restored from the undo list. Returns the number of images removed.
+    Folders are matched by path, which images recorded before their folders were
+    indexed also have.
+    """
+    if not image_ids and not folders:
+        return 0
+
+    patterns = [
+        re.compile(f"^{re.escape(dataset.directory + folder)}") for folder in folders
+    ]
+    images = ImageModel.objects(
+        dataset_id=dataset.id,
+        deleted=False,
+        __raw__={
+            "$or": [{"_id": {"$in": list(image_ids)}}, {"path": {"$in": patterns}}]
+        },
+    )
+    return images.update(set__deleted=True, set__deleted_date=datetime.datetime.now())
+
+
+def load_snapshots(dataset, roots=("",)):
+    """Snapshots of the folders of a dataset under `roots`, by path"""
+    folders = FolderModel.objects(dataset_id=dataset.id)
+    if "" not in roots:
+        folders = folders.filter(
+            __raw__={
+                "path": {"$in": [re.compile(f"^{re.escape(root)}") for root in roots]}
+            }
+        )
+
+    return {
+        folder["path"]: folder
+        for folder in folders.only("path", "parent", "mtime", "entries").as_pymongo()
+    }
+
+
+def apply_changes(task, dataset, changes, progress=None):
+    """
+    Creates, refreshes and soft-deletes the images of the `changes` found by
+    `diff_images`, returning a summary that `finish_scan` merges with other shards'
+    """
+    image_ids = create_images(task, dataset, changes.new, progress)
+    refresh_images(task, dataset, changes.modified)
+    if changes.unrecorded:
+        # pylint: disable-next=protected-access
+        ImageModel._get_collection().bulk_write(changes.unrecorded, ordered=False)
+    removed = remove_images(dataset, changes.removed, changes.removed_folders)
+
+    return {
+        "folders": sorted(changes.folders),
+        "snapshots": changes.snapshots,
+        "listed": len(changes.snapshots),
+        "skipped": changes.skipped,
+        "created": len(image_ids),
+        "modified": len(changes.modified),
+        "removed": removed,
+    }
+
+
+def scan_folders(task, dataset, roots, full=False, progress=None):
+    """Scans the `roots` folders of a dataset and their subfolders"""
+    start = time.perf_counter()
+    changes = diff_images(
+        dataset,
+        walk_dataset(dataset.directory, load_snapshots(dataset, roots), full, roots),
+    )
+    task.info(
+        f"Listed {len(changes.snapshots)} of {len(changes.folders)} folder(s) "
+        f"under {', '.join(root or '/' for root in roots)} in "
+        f"{time.perf_counter() - start:.1f}s: {len(changes.new)} new, "
+        f"{len(changes.modified)} modified and {len(changes.removed)} removed "
+        f"file(s), {len(changes.removed_folders)} removed folder(s)"
+    )
+    return apply_changes(task, dataset, changes, progress)
+
+
+def finish_scan(task, dataset, summaries, socket=None):
+    """
+    Indexes the folders of a dataset from the summaries of its scanned shards,
+    refreshes its counters and queues the thumbnails of new and modified images
+    """
+    summary = {"folders": set(), "snapshots": {}}
+    for shard in summaries:
+        summary["folders"].update(shard["folders"])
+        summary["snapshots"].update(shard["snapshots"])
+        for key in ("listed", "skipped", "created", "modified", "removed"):
+            summary[key] = summary.get(key, 0) + shard[key]
+
+    if summary["removed"]:
+        refresh_dataset_counters([dataset.id])
+
+    queue_thumbnails(
+        ImageModel.objects(dataset_id=dataset.id, regenerate_thumbnail=True).scalar(
+            "id"
+        )
+    )
+
+    if summary["created"] or summary["modified"] or summary["removed"]:
+        DatasetModel.mark_modified(dataset.id)
+
+    index_folders(dataset, summary["folders"], summary["snapshots"])
+    task.info(
+        f"Listed {summary['listed']} of {len(summary['folders'])} folder(s), "
+        f"skipping {summary['skipped']} entries of unchanged folders: created "
+        f"{summary['created']}, refreshed {summary['modified']} and deleted "
+        f"{summary['removed']} image(s)"
+    )
+    task.set_progress(100, socket=socket)
 
 
 @celery.task
-def scan_dataset(task_id, dataset_id):
+def scan_dataset(task_id, dataset_id, full=False):
+    """
+    Brings the images of a dataset in line with its directory: files are added,
+    modified files have their dimensions and thumbnails refreshed and removed files
+    are soft-deleted. Only the folders that changed since the previous scan are
+    listed (every folder if `full`), and only new or modified files are opened,
+    reading just their headers in a thread pool.
 
+    The top-level folders are split into at most `CONFIG.scan.shards` groups scanned
+    by `scan_shard` subtasks in parallel, whose summaries `scan_finish` merges.
+    """
     task = TaskModel.objects.get(id=task_id)
     dataset = DatasetModel.objects.get(id=dataset_id)
 
     task.update(status="PROGRESS")
     socket = create_socket()
+    task.info(f"Scanning {dataset.directory}" + (" (full)" if full else ""))
 
-    directory = dataset.directory
-    toplevel = list(os.listdir(directory))
-    task.info(f"Scanning {directory}")
+    # The dataset root's own files, its subfolders are left to the shards
+    changes = walk_dataset(
+        dataset.directory, load_snapshots(dataset), full, max_depth=0
+    )
+    summary = apply_changes(task, dataset, diff_images(dataset, changes))
+    toplevel = sorted(changes.deferred)
+    shards = [
+        toplevel[i :: CONFIG.scan.shards]
+        for i in range(min(CONFIG.scan.shards, len(toplevel)))
+    ]
+    task.set_progress(10, socket=socket)
 
-    count = 0
-    for root, _, files in os.walk(directory):
+    if len(shards) <= 1:
+        summaries = [summary]
+        if toplevel:
+            summaries.append(
+                scan_folders(
+                    task,
+                    dataset,
+                    toplevel,
+                    full,
+                    lambda done: task.set_progress(10 + 85 * done, socket=socket),
+                )
+            )
+        finish_scan(task, dataset, summaries, socket)
+        return
 
-        try:
-            youarehere = toplevel.index(root.split("/")[-1])
-            progress = int(((youarehere) / len(toplevel)) * 100)
-            task.set_progress(progress, socket=socket)
-        # TODO: This is a broad exception, should be narrowed down as we see more errors
-        except Exception as e:  # pylint: disable=broad-except
-            print(e)
-
-        if root.split("/")[-1].startswith("."):
-            continue
+    task.info(f"Scanning {len(toplevel)} top-level folder(s) in {len(shards)} shards")
+    task.update(set__metadata__shards=len(shards), set__metadata__shards_done=0)
+    task.flush()
+    chord(
+        group(
+            scan_shard.s(task_id, dataset_id, roots, full).set(queue=CONFIG.scan.queue)
+            for roots in shards
+        ),
+        scan_finish.s(task_id, dataset_id, summary).on_error(scan_failed.s(task_id)),
+    ).apply_async()
 
-        for file in files:
-            path = os.path.join(root, file)
 
-            if path.endswith(SUPPORTED_IMAGE_EXTENTIONS):
-                db_image = ImageModel.objects(path=path).first()
+@celery.task
+def scan_shard(task_id, dataset_id, roots, full=False):
+    """Scans some top-level folders of a dataset, as part of `scan_dataset`"""
+    task = TaskModel.objects.get(id=task_id)
+    dataset = DatasetModel.objects.get(id=dataset_id)
 
-                if db_image is not None:
-                    continue
+    summary = scan_folders(task, dataset, roots, full)
+    task.flush()
 
-                try:
-                    ImageModel.create_from_path(path, dataset.id).save()
-                    count += 1
-                    task.info(f"New file found: {path}")
-                # TODO: This is a broad exception, should be narrowed down as we see more errors
-                except Exception as e:  # pylint: disable=broad-except
-                    print(e)
-                    task.warning(f"Could not read {path}")
+    task = TaskModel.objects(id=task_id).modify(inc__metadata__shards_done=1, new=True)
+    task.set_progress(
+        10 + 85 * task.metadata["shards_done"] / task.metadata["shards"],
+        socket=create_socket(),
+    )
+    return summary
 
-    for image in ImageModel.objects(regenerate_thumbnail=True).all():
-        thumbnail_generate_single_image.delay(image.id)
 
-    task.info(f"Created {count} new image(s)")
-    task.set_progress(100, socket=socket)
+@celery.task
+def scan_finish(summaries, task_id, dataset_id, summary):
+    """Completes a sharded `scan_dataset` once every `scan_shard` is done"""
+    task = TaskModel.objects.get(id=task_id)
+    dataset = DatasetModel.objects.get(id=dataset_id)
+    finish_scan(task, dataset, [summary, *summaries], create_socket())
+
+
+@celery.task
+def scan_failed(request, exc, traceback, task_id):
+    """Marks a sharded scan as failed when one of its shards raised"""
+    del request, traceback
+    task = TaskModel.objects.get(id=task_id)
+    task.error(f"Scan failed: {exc}")
+    task.update(status="FAILED", failed=True)
+
+
+def index_folders(dataset, folders, snapshots=None):
+    """
+    Replaces the folder index of a dataset with the scanned `folders`, records the
+    `snapshots` of the listed folders for the next scan, fills in the folders of images
+    created before folders were indexed and recounts the images
+    """
+    FolderModel.add(dataset.id, folders)
+    FolderModel.objects(dataset_id=dataset.id, path__nin=list(folders) + [""]).delete()
+    FolderModel.snapshot(dataset.id, snapshots or {})
+
+    requests = [
+        UpdateOne(
+            {"_id": image["_id"]},
+            {"$set": {"folders": image_folders(dataset.directory, image["path"])}},
+        )
+        for image in ImageModel.objects(
+            dataset_id=dataset.id, __raw__={"folders.0": {"$exists": False}}
+        )
+        .only("id", "path")
+        .as_pymongo()
+    ]
+    if requests:
+        # pylint: disable-next=protected-access
+        ImageModel._get_collection().bulk_write(requests, ordered=False)
+
+    refresh_folder_counters(dataset.id)
 
 
 __all__ = ["scan_dataset"]
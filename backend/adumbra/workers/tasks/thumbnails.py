@@ -1,19 +1,169 @@
-from adumbra.database import ImageModel
+import datetime
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from mongoengine import Q
+
+from adumbra.config import CONFIG
+from adumbra.database import CategoryModel, ImageModel
 from adumbra.database.images import AnnotationModel
-from adumbra.services.thumbnail import save_thumbnail
+from adumbra.services.thumbnail import save_thumbnail, save_variants
+from adumbra.services.tiles import build_tiles, has_tiles
 from adumbra.workers import celery
 
 
+def queue_thumbnails(image_ids, countdown=0):
+    """
+    Queues the thumbnails of images to be regenerated in batches. Images that already
+    have a batch queued are skipped, so requests made while a batch waits for its
+    `countdown` are coalesced into it.
+    """
+    now = datetime.datetime.utcnow()
+    stale = now - datetime.timedelta(seconds=CONFIG.thumbnails.requeue_after)
+    unqueued = Q(thumbnail_queued_at=None) | Q(thumbnail_queued_at__lt=stale)
+
+    batch_size = CONFIG.thumbnails.batch_size
+    image_ids = list(dict.fromkeys(image_ids))
+    for i in range(0, len(image_ids), batch_size):
+        images = ImageModel.objects(unqueued, id__in=image_ids[i : i + batch_size])
+        batch = images.distinct("id")
+        if not batch:
+            continue
+
+        ImageModel.objects(id__in=batch).update(set__thumbnail_queued_at=now)
+        thumbnail_generate_images.apply_async([batch], countdown=countdown)
+
+
+def _render(image, annotations, categories):
+    save_thumbnail(image.path, annotations, categories)
+    save_variants(image.path)
+
+
+def regenerate_thumbnails(image_ids):
+    """
+    Regenerates the thumbnails of the given images that still need it, rendering them
+    in a thread pool. Annotations and categories are loaded with one query each.
+    """
+    image_ids = list(dict.fromkeys(image_ids))
+    ImageModel.objects(id__in=image_ids).update(unset__thumbnail_queued_at=True)
+
+    images = list(
+        ImageModel.objects(id__in=image_ids, regenerate_thumbnail=True).only(
+            "id", "path", "width", "height"
+        )
+    )
+    if not images:
+        return []
+
+    # Claim the images before rendering, so a save made meanwhile queues a new render
+    # instead of being overwritten when this one completes
+    ImageModel.objects(id__in=[image.id for image in images]).update(
+        set__regenerate_thumbnail=False
+    )
+
+    # Tiles do not depend on the thumbnail, so a large image that fails to render
+    # one can still be annotated
+    _queue_tiles(images)
+
+    annotations = defaultdict(list)
+    for annotation in AnnotationModel.objects(
+        image_id__in=[image.id for image in images], deleted=False
+    ).only("image_id", "category_id", "color", "segmentation", "bbox", "area"):
+        annotations[annotation.image_id].append(annotation)
+
+    categories = CategoryModel.objects.only("name", "color").in_bulk(
+        list(
+            {
+                annotation.category_id
+                for image_annotations in annotations.values()
+                for annotation in image_annotations
+            }
+        )
+    )
+
+    generated, failed = [], []
+    try:
+        with ThreadPoolExecutor(max_workers=CONFIG.thumbnails.threads) as executor:
+            futures = [
+                (
+                    image,
+                    executor.submit(_render, image, annotations[image.id], categories),
+                )
+                for image in images
+            ]
+            for image, future in futures:
+                try:
+                    future.result()
+                    generated.append(image.id)
+                # Missing or unreadable images
+                except (OSError, ValueError) as e:
+                    print(f"could not generate thumbnail for {image.id}: {e}")
+                    failed.append(image.id)
+    finally:
+        # Images not rendered still need a thumbnail, even after an unexpected error
+        ImageModel.objects(
+            id__in=[image.id for image in images if image.id not in generated]
+        ).update(set__regenerate_thumbnail=True)
+
+    ImageModel.objects(id__in=generated, thumbnail_attempts__gt=0).update(
+        set__thumbnail_attempts=0
+    )
+    if failed:
+        _retry_thumbnails(failed)
+
+    return generated
+
+
+def _queue_tiles(images):
+    """Queues the tile pyramids of the large images that have none or a stale one"""
+    for image in images:
+        if (
+            max(image.width, image.height) >= CONFIG.tile_min_size
+            and os.path.isfile(image.path)
+            and not has_tiles(image.path)
+        ):
+            tiles_generate_single_image.delay(image.id)
+
+
+def _retry_thumbnails(image_ids):
+    """
+    Queues the thumbnails that could not be rendered again after a delay, unless they
+    failed `max_attempts` times in a row; those are tried again when next requested
+    """
+    ImageModel.objects(id__in=image_ids).update(inc__thumbnail_attempts=1)
+    queue_thumbnails(
+        ImageModel.objects(
+            id__in=image_ids, thumbnail_attempts__lt=CONFIG.thumbnails.max_attempts
+        ).distinct("id"),
+        countdown=CONFIG.thumbnails.retry_after,
+    )
+
+
+@celery.task
+def thumbnail_generate_images(image_ids):
+    generated = regenerate_thumbnails(image_ids)
+    print(f"generated {len(generated)} of {len(image_ids)} thumbnail(s)")
+    return generated
+
+
 @celery.task
 def thumbnail_generate_single_image(image_id):
-    print("will generate thumbnails in worker")
-    image = ImageModel.objects(id=image_id).first()
-    if image.regenerate_thumbnail:
-        print(f"regenerating thumbnail for {image_id}")
-        annotations = AnnotationModel.objects(image_id=image_id, deleted=False).all()
-        save_thumbnail(image.path, annotations)
-        image.update(regenerate_thumbnail=False)
-    print(f"skip thumbnail generation for {image_id}")
+    return regenerate_thumbnails([image_id])
+
+
+@celery.task
+def tiles_generate_single_image(image_id):
+    """Builds the tile pyramid the annotator uses for a large image"""
+    image = ImageModel.objects(id=image_id).only("path").first()
+    if image is None or has_tiles(image.path):
+        return
+    print(f"building tiles for {image_id}")
+    build_tiles(image.path)
 
 
-__all__ = ["thumbnail_generate_single_image"]
+__all__ = [
+    "thumbnail_generate_images",
+    "thumbnail_generate_single_image",
+    "tiles_generate_single_image",
+]
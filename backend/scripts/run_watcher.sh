@@ -0,0 +1 @@
+python -m adumbra.watcher
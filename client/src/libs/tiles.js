@@ -0,0 +1,89 @@
+import paper from "paper";
+
+// Side of the preview loaded under the tiles of a tiled image
+export const PREVIEW_SIZE = 2048;
+
+/**
+ * Shows the tiles of a deep-zoom pyramid (see `/api/image/<id>/tiles`) that are
+ * visible in the paper view, at the level matching its zoom. The image is centered
+ * on the origin, like the annotator's raster.
+ */
+export class TileLayer {
+  constructor(info, below) {
+    this.info = info;
+    this.group = new paper.Group();
+    this.group.insertAbove(below);
+    this.tiles = new Map();
+    this.level = null;
+    this.bounds = null;
+  }
+
+  levelForZoom(zoom) {
+    // Level whose pixels are at least as dense as the screen's
+    const last = this.info.levels - 1;
+    const level = last - Math.floor(Math.log2(1 / zoom));
+    return Math.max(0, Math.min(last, level));
+  }
+
+  update(view) {
+    const level = this.levelForZoom(view.zoom);
+    const bounds = view.bounds;
+    if (level === this.level && this.bounds && this.bounds.contains(bounds)) {
+      return;
+    }
+    if (level !== this.level) {
+      this.clear();
+      this.level = level;
+    }
+    this.bounds = bounds;
+
+    const { width, height, tile_size: tileSize, levels } = this.info;
+    const scale = 2 ** (levels - 1 - level);
+    const size = tileSize * scale;
+    const left = -width / 2;
+    const top = -height / 2;
+
+    const firstColumn = Math.max(0, Math.floor((bounds.left - left) / size));
+    const lastColumn = Math.min(
+      Math.ceil(width / size) - 1,
+      Math.floor((bounds.right - left) / size)
+    );
+    const firstRow = Math.max(0, Math.floor((bounds.top - top) / size));
+    const lastRow = Math.min(
+      Math.ceil(height / size) - 1,
+      Math.floor((bounds.bottom - top) / size)
+    );
+
+    for (let column = firstColumn; column <= lastColumn; column++) {
+      for (let row = firstRow; row <= lastRow; row++) {
+        const key = `${column}_${row}`;
+        if (this.tiles.has(key)) continue;
+
+        const url = this.info.url
+          .replace("{z}", level)
+          .replace("{x}", column)
+          .replace("{y}", row);
+        const tile = new paper.Raster(url);
+        tile.onLoad = () => {
+          tile.scale(scale, tile.bounds.topLeft);
+          tile.bounds.topLeft = new paper.Point(
+            left + column * size,
+            top + row * size
+          );
+        };
+        this.group.addChild(tile);
+        this.tiles.set(key, tile);
+      }
+    }
+  }
+
+  clear() {
+    this.group.removeChildren();
+    this.tiles.clear();
+  }
+
+  remove() {
+    this.group.remove();
+    this.tiles.clear();
+  }
+}
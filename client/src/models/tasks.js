@@ -16,7 +16,7 @@ export default {
         throw error;
     }
   },
-  getLogs(id) {
-    return axios.get(baseURL + id + "/logs");
+  getLogs(id, level) {
+    return axios.get(baseURL + id + "/logs", { params: { level } });
   }
 };